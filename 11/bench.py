@@ -0,0 +1,165 @@
+"""
+Benchmarks for the Jack compiler
+
+author: Arpon Sarker
+date: 17-12-2024
+"""
+
+import cmd
+import contextlib
+import importlib.util
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import compiler
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+REPEATS = 5 # runs of each measurement, the fastest is reported
+
+
+def jackSources(directory) -> list:
+    """ The .jack files of a directory, 12/ and 9/HelloWorld by default """
+    if directory:
+        directories = [directory]
+    else:
+        directories = [os.path.join(ROOT, "12"), os.path.join(ROOT, "9", "HelloWorld")]
+    return [os.path.join(path, name) for path in directories for name in sorted(os.listdir(path)) if name.endswith(".jack")]
+
+
+def peakMemory(function) -> int:
+    """ Peak bytes allocated by one call, as traced by tracemalloc """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def fastest(function) -> float:
+    """ Seconds of the fastest of REPEATS calls """
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+class BENCH_CLI(cmd.Cmd):
+    prompt = "bench> "
+    intro = "Benchmarks for the Jack compiler"
+
+    def do_tokens(self, line):
+        """tokens [dir]: tokens per second of the tokenizer alone and of whole compiles, with and without XxxT.xml"""
+        sources = jackSources(line.strip())
+        with tempfile.TemporaryDirectory() as work:
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                names = []
+                for source in sources:
+                    shutil.copy(source, os.path.basename(source))
+                    names.append(os.path.basename(source))
+                count = sum(len(compiler.JackTokenizer(name).tokens) for name in names)
+                print(f"{len(names)} files, {count} tokens")
+                print(f"{'phase':<36} {'seconds':>8} {'tokens/s':>10}")
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    rows = [("tokenize", fastest(lambda: [compiler.JackTokenizer(name) for name in names])),
+                            ("tokenize, write XxxT.xml", fastest(lambda: [compiler.JackTokenizer(name, True) for name in names])),
+                            ("compile to .vm", fastest(lambda: [compiler.JackAnalyzer(name) for name in names])),
+                            ("compile to .vm, write XxxT.xml", fastest(lambda: [compiler.JackAnalyzer(name, True) for name in names]))]
+                for phase, seconds in rows:
+                    print(f"{phase:<36} {seconds:>8.4f} {count / seconds:>10.0f}")
+            finally:
+                os.chdir(cwd)
+
+    def do_vm(self, line):
+        """vm [dir]: tokens per second and peak memory of compiles that build the Xxx.xml parse tree and of VM-only compiles"""
+        sources = jackSources(line.strip())
+        with tempfile.TemporaryDirectory() as work:
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                names = []
+                for source in sources:
+                    shutil.copy(source, os.path.basename(source))
+                    names.append(os.path.basename(source))
+                count = sum(len(compiler.JackTokenizer(name).tokens) for name in names)
+                print(f"{len(names)} files, {count} tokens")
+                print(f"{'mode':<24} {'seconds':>8} {'tokens/s':>10} {'peak KiB':>9}")
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    modes = [("compile, write Xxx.xml", lambda: [compiler.JackAnalyzer(name) for name in names]),
+                             ("compile VM only", lambda: [compiler.JackAnalyzer(name, vm_only=True) for name in names])]
+                    rows = [(mode, fastest(function), peakMemory(function)) for mode, function in modes]
+                for mode, seconds, peak in rows:
+                    print(f"{mode:<24} {seconds:>8.4f} {count / seconds:>10.0f} {peak / 1024:>9.0f}")
+            finally:
+                os.chdir(cwd)
+
+    def do_phases(self, line):
+        """phases [dir]: seconds and tokens per second of each compiler pass, tokenize, parse, parse tree XML,
+        constant folding and VM code, then the VM code with and without folding and strength reduction"""
+        sources = jackSources(line.strip())
+        texts = []
+        for source in sources:
+            with open(source, "r") as file:
+                texts.append(file.read())
+        token_lists = [compiler.tokenize(text) for text in texts]
+        parse = lambda: [compiler.Parser(tokens).parseClass() for tokens in token_lists]
+        trees = parse()
+        unfolded = [parse() for _ in range(REPEATS)] # folding works in place, each run gets its own trees
+        folded = parse()
+        for tree in folded:
+            compiler.ExpressionFolder().foldClass(tree)
+        count = sum(len(tokens) for tokens in token_lists)
+        print(f"{len(sources)} files, {count} tokens")
+        print(f"{'phase':<16} {'seconds':>8} {'tokens/s':>10}")
+        rows = [("tokenize", fastest(lambda: [compiler.tokenize(text) for text in texts])),
+                ("parse", fastest(parse)),
+                ("parse tree XML", fastest(lambda: [compiler.ParseTreeWriter().write(tree) for tree in trees])),
+                ("fold constants", fastest(lambda: [compiler.ExpressionFolder().foldClass(tree) for tree in unfolded.pop()])),
+                ("VM code", fastest(lambda: [compiler.CodeGenerator(os.devnull).compileClass(tree) for tree in folded]))]
+        for phase, seconds in rows:
+            print(f"{phase:<16} {seconds:>8.4f} {count / seconds:>10.0f}")
+        total = rows[0][1] + rows[1][1] + rows[3][1] + rows[4][1]
+        print(f"{'to .vm in total':<16} {total:>8.4f} {count / total:>10.0f}")
+        print(f"{'VM code':<16} {'commands':>8} {'Math.multiply':>14} {'Math.divide':>12}")
+        for mode, code in (("not optimized", [compiler.CodeGenerator(os.devnull, False).compileClass(tree) for tree in trees]),
+                           ("optimized", [compiler.CodeGenerator(os.devnull).compileClass(tree) for tree in folded])):
+            code = "".join(code)
+            print(f"{mode:<16} {code.count(chr(10)):>8} {code.count('call Math.multiply'):>14} {code.count('call Math.divide'):>12}")
+
+    def do_validate(self, line):
+        """validate [dir]: compares the XxxT.xml of every file with the line based tokenizer kept in 10/compiler.py"""
+        spec = importlib.util.spec_from_file_location("reference", os.path.join(ROOT, "10", "compiler.py"))
+        reference = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(reference)
+        with tempfile.TemporaryDirectory() as work:
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                for source in jackSources(line.strip()):
+                    name = os.path.basename(source)
+                    shutil.copy(source, name)
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                        reference.JackTokenizer(name)
+                    with open(name[:-5] + "T.xml") as file:
+                        expected = file.read()
+                    tokens = compiler.JackTokenizer(name)
+                    print(f"{name:<16} {len(tokens.tokens):>6} tokens {'same' if tokens.xml() == expected else 'DIFFERENT'}")
+            finally:
+                os.chdir(cwd)
+
+    def do_quit(self, line):
+        """Exit the CLI."""
+        return True
+
+
+if __name__ == "__main__":
+    BENCH_CLI().cmdloop()
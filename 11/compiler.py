@@ -7,6 +7,7 @@ date: 17-12-2024
 
 import cmd
 import os
+import re
 from enum import Enum
 from os.path import isdir
 
@@ -45,6 +46,29 @@ class KEYWORD(Enum):
     NULL = 19,
     THIS = 20
 
+TAGS = {TOKEN_TYPE.KEYWORD: "keyword", TOKEN_TYPE.SYMBOL: "symbol", TOKEN_TYPE.IDENTIFIER: "identifier",
+        TOKEN_TYPE.INT_CONST: "integerConstant", TOKEN_TYPE.STRING_CONST: "stringConstant"} # XML element of each type
+XML_ESCAPES = {"<": "&lt;", ">": "&gt;", "&": "&amp;", "\"": "&quot;"}
+
+
+class Token:  # one lexical element, in the order of the source
+    __slots__ = ("kind", "value", "line", "column")
+
+    def __init__(self, kind, value: str, line: int, column: int):
+        self.kind = kind # TOKEN_TYPE
+        self.value = value # the text, without quotes for a string constant
+        self.line = line
+        self.column = column
+
+    def __repr__(self):
+        return f"Token({self.kind.name}, {self.value!r}, {self.line}:{self.column})"
+
+    def xml(self) -> str:
+        tag = TAGS[self.kind]
+        return "<" + tag + ">" + (XML_ESCAPES.get(self.value, self.value) if self.kind == TOKEN_TYPE.SYMBOL else self.value) + \
+            "</" + tag + ">\n"
+
+
 class CLI(cmd.Cmd):
     prompt = "prompt> "
     intro = "Compiler for the Jack Language"
@@ -54,17 +78,24 @@ class CLI(cmd.Cmd):
         return super().do_help(arg)
 
     def do_j(self, line):
-        """Converts .jack files into .vm files"""
-        input_file = line
+        """Converts .jack files into .vm files, j <file or dir> -x also writes the XxxT.xml token file,
+        -v writes only the .vm file without building the Xxx.xml parse tree, -n turns off constant folding
+        and strength reduction, -i leaves products with constants to the translator's -i"""
+        words = line.split()
+        write_xml = "-x" in words
+        vm_only = "-v" in words
+        optimize = "-n" not in words
+        intrinsics = "-i" in words
+        input_file = [word for word in words if word not in ("-x", "-v", "-n", "-i")][0] if words else ""
         if os.path.isdir(input_file):
             # directory given
             dir_files = os.listdir(input_file)
             for dir_file in dir_files:
                 if dir_file[-5:] == ".jack":
-                    # opens file, creates corresponding tokenizer file in cwd not dir itself
-                    JackAnalyzer(input_file + dir_file)
+                    # opens file, creates corresponding output files in cwd not dir itself
+                    JackAnalyzer(input_file + dir_file, write_xml, vm_only, optimize, intrinsics)
         else:
-            JackAnalyzer(input_file)
+            JackAnalyzer(input_file, write_xml, vm_only, optimize, intrinsics)
     
     def do_q(self, line):
         """Exit the CLI"""
@@ -102,7 +133,7 @@ class symbolTable:
         if name_contents == None:
             return None
         else:
-            return name_contents[1] 
+            return name_contents[0] 
     
     def indexOf(self, name:str) -> int:
         name_contents = self.table.get(name)
@@ -113,990 +144,1012 @@ class symbolTable:
 
 class VMWriter:
     output_stream = ""
-    commands = ""
+    commands = None # lines of VM code, joined once by text()
 
     def __init__(self, output_stream) -> None:
         self.output_stream = output_stream
+        self.commands = []
 
     def writePush(self, segment, index: int):
-        self.commands += f"push {segment} {index}\n" 
+        self.commands.append(f"push {segment} {index}\n")
 
     def writePop(self, segment, index: int):
-        self.commands += f"pop {segment} {index}\n"
+        self.commands.append(f"pop {segment} {index}\n")
 
     def writeArithmetic(self, command):
-        self.commands += f"{command}\n"
+        self.commands.append(f"{command}\n")
 
     def writeLabel(self, label):
-        self.commands += f"label {label}\n"
+        self.commands.append(f"label {label}\n")
 
     def writeGoto(self, label):
-        self.commands += f"goto {label}\n"
+        self.commands.append(f"goto {label}\n")
 
     def writeIf(self, label):
-        self.commands += f"if-goto {label}\n"
+        self.commands.append(f"if-goto {label}\n")
 
     def writeCall(self, name, nArgs):
-        self.commands += f"call {name} {nArgs}\n"
+        self.commands.append(f"call {name} {nArgs}\n")
 
     def writeFunction(self, name, nLocals):
-        self.commands += f"function {name} {nLocals}\n"
+        self.commands.append(f"function {name} {nLocals}\n")
 
     def writeReturn(self):
-        self.commands += "return\n"
+        self.commands.append("return\n")
+
+    def text(self) -> str:
+        return "".join(self.commands)
 
     def close(self):
         with open(self.output_stream, "w") as file:
-            file.write(self.commands)
+            file.write(self.text())
 
     def debug(self, line):
-        self.commands += f"{line}\n"
+        self.commands.append(f"{line}\n")
 
         
 
+KEYWORDS = frozenset(("class", "method", "function", "constructor", "int", "boolean", "char", "void", "var", "static",
+                      "field", "let", "do", "if", "else", "while", "return", "true", "false", "null", "this"))
+# one alternative per lexical element, tried at each position of the whole file; whitespace and both comment
+# forms are skipped, an unterminated /* comment runs to the end of the file
+TOKEN_PATTERN = re.compile(r"""
+    (?P<skip>\s+|//[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<symbol>[{}()\[\].,;+\-*/&|<>=~])
+  | (?P<integer>\d+)
+  | (?P<string>"[^"\n]*")
+  | (?P<word>[A-Za-z_]\w*)
+  | (?P<error>.)
+""", re.VERBOSE | re.DOTALL)
+
+
+def tokenize(source: str, file_name: str = "") -> list:
+    """ Token records of a whole .jack file in one pass of TOKEN_PATTERN """
+    tokens = []
+    append = tokens.append
+    line, line_start = 1, 0 # line number and offset of its first character
+    for match in TOKEN_PATTERN.finditer(source):
+        group = match.lastgroup
+        start = match.start()
+        if group == "skip":
+            newlines = source.count("\n", start, match.end())
+            if newlines:
+                line += newlines
+                line_start = source.rindex("\n", start, match.end()) + 1
+            continue
+        text = match.group()
+        if group == "symbol":
+            append(Token(TOKEN_TYPE.SYMBOL, text, line, start - line_start + 1))
+        elif group == "word":
+            append(Token(TOKEN_TYPE.KEYWORD if text in KEYWORDS else TOKEN_TYPE.IDENTIFIER, text, line, start - line_start + 1))
+        elif group == "integer":
+            append(Token(TOKEN_TYPE.INT_CONST, str(int(text)), line, start - line_start + 1))
+        elif group == "string":
+            append(Token(TOKEN_TYPE.STRING_CONST, text[1:-1], line, start - line_start + 1))
+        else:
+            print(f"ERROR: NOT VALID TOKEN at {file_name}:{line}:{start - line_start + 1}: ", text)
+    return tokens
+
+
 class JackTokenizer:
-    list_tokens = [] # lists all tokens in line - used as a stack
-    current_token = ""
-    line = ""
-    current_comment = False 
-    commands = "<tokens>\n" # text to be written to token file
-    is_string = False
-
-    token_type = None
-    key_word = None
-    sym = ''
-    id = ""
-    int_val = None 
-    string_val = ""
-
-
-    def __init__(self, input_file):
-
-        dir_index = input_file.find("/")
-        ext_index = input_file.find(".")
-        output_file_name = input_file[dir_index+1:ext_index]
-        token_output_file = open(output_file_name+"T.xml", "w")
-        comp_output_file = open(output_file_name+".xml", "w")
-        comp_commands = ""
-        symbol_list = ['{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*', '/', '&', '|', '<', '>', '=', '~']
+    tokens = None # Token records of the whole file, what CompilationEngine reads
 
+    def __init__(self, input_file, write_xml=False):
         with open(input_file, "r") as file:
-            for line in file:
-                # for each line, loop through all tokens as current_token then move to next line
-                self.line = line
-                if self.hasMoreTokens(): # self.line contains code
-                    if len(self.line) > 1:
-                        i = 0
-                        while i < len(self.line):
-                            if self.line[i] in symbol_list:
-                                if i == len(self.line)-1:
-                                    # last character aka ;
-                                    last_symbol = self.line[i]
-                                    if self.line[-2] != ' ':
-                                        self.line = self.line[:-1] + " " + last_symbol
-                                    break
-                                else:
-
-                                    # len of line keeps incrementing 
-                                    if self.line[i-1] != ' ' and self.line[i+1] != ' ':
-                                        self.line = self.line[:i] + " " + self.line[i] + " " + self.line[i+1:]
-                                        i += 2
-                                    elif self.line[i-1] != ' ':
-                                        self.line = self.line[:i] + " " + self.line[i] + self.line[i+1:]
-                                        i += 2
-                                    elif self.line[i+1] != ' ':
-                                        self.line = self.line[:i+1] + " " + self.line[i+1:]
-                                        i += 1
-                            i += 1
-
-                    i = 0
-                    if self.line.count("\"") > 0:
-                        while i < self.line.count("\""):
-                            # Put stuff before string into list_tokens
-                            str_index = self.line.find("\"")
-                            process_part = self.line[:str_index]
-                            self.line = self.line[str_index+1:] # removes first quote
-                            self.list_tokens += process_part.split()
-
-                            # Put entire string into list_tokens
-                            str_index = self.line.find("\"") # finds 2nd quote of pair
-                            process_part = "\"" + self.line[:str_index+1]
-                            self.line = self.line[str_index+1:]
-                            self.list_tokens += [process_part]
- 
-                            
-                            i += 2
-
-                        self.list_tokens += self.line.split()
-                    else:
-                        self.list_tokens = self.line.split(" ")
-                    if '' in self.list_tokens:
-                        self.list_tokens.remove('')
-                    while len(self.list_tokens) > 0:
-                        self.advance() 
-                        self.tokenType() 
-                        if self.token_type == TOKEN_TYPE.KEYWORD:
-                            self.commands += "<keyword>" + str(self.key_word) + "</keyword>\n"
-                        elif self.token_type == TOKEN_TYPE.SYMBOL:
-                            self.commands += "<symbol>" + self.sym + "</symbol>\n"
-                        elif self.token_type == TOKEN_TYPE.IDENTIFIER:
-                            self.commands += "<identifier>" + self.id + "</identifier>\n"
-                        elif self.token_type == TOKEN_TYPE.INT_CONST:
-                            self.commands += "<integerConstant>" + str(self.int_val) + "</integerConstant>\n"
-                        elif self.token_type == TOKEN_TYPE.STRING_CONST:
-                            self.commands += "<stringConstant>" + self.string_val[1:-1] + "</stringConstant>\n"
-                        else:
-                            print("ERROR: TOKEN TYPE INVALID FOR WRITING")
-
-
-        self.commands += "</tokens>"
-        token_output_file.write(self.commands)
-        token_output_file.close()
-
-    # Comments come in: // Foo\n | /* Foo... */ | /** Foo... */
-    def hasMoreTokens(self) -> bool: # ignores whitespace and comments
-        self.line = self.line.strip() # removes leading and trailing whitespaces
-        comment_index = -1
-        if "//" in self.line:
-            comment_index = self.line.find("//")
-        elif ("/*" in self.line or "/**" in self.line) and "*/" in self.line:
-            comment_index = self.line.find("/*")
-        elif "/*" in self.line or "/**" in self.line:
-            self.current_comment = True
-            comment_index = self.line.find("/*")
-        elif "*/" in self.line:
-            self.current_comment = False
-            comment_index = self.line.find("*/")
-            while (comment_index < len(self.line) - 1):
-                comment_index += 1
-                if self.line[comment_index] == ' ':
-                    continue
-                else:
-                    self.line = self.line[comment_index:]
-                    self.line = self.line.strip()
-                    comment_index = -1
-                    break
-        elif self.current_comment == True:
-            return False
-        
-        if comment_index != -1:
-            self.line = self.line[:comment_index] # if comment type 1 -> len = 0 now
-            self.line = self.line.strip()
-        if self.line == "/":
-            self.line = ""
+            self.tokens = tokenize(file.read(), input_file)
 
-        if len(self.line) > 0:
-            return True
-        else:
-            return False
+        if write_xml:
+            dir_index = input_file.find("/")
+            ext_index = input_file.find(".")
+            output_file_name = input_file[dir_index+1:ext_index]
+            with open(output_file_name + "T.xml", "w") as token_output_file:
+                token_output_file.write(self.xml())
 
-    def advance(self):
-        """ Pops list_tokens[0] as current_token"""
-        self.current_token = self.list_tokens[0]
-        self.list_tokens = self.list_tokens[1:]
-
-    def tokenType(self):
-        """ Gets type from current_token and sets corresponding fields"""
-        keyword = ["class", "method", "function", "constructor", "int", "boolean", "char", "void",
-                   "var", "static", "field", "let", "do", "if", "else", "while", "return", "true",
-                   "false", "null", "this"]
-        symbol_list = ['{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*', '/', '&', '|',
-                       '<', '>', '=', '~']
-        if self.current_token in keyword:
-            self.token_type = TOKEN_TYPE.KEYWORD
-            self.keyWord()
-        elif self.current_token in symbol_list:
-            self.token_type = TOKEN_TYPE.SYMBOL
-            self.symbol()
-        elif self.current_token[0].isalpha() or self.current_token[0] == '_':
-            self.token_type = TOKEN_TYPE.IDENTIFIER
-            self.identifier()
-        elif self.current_token.isnumeric():
-            self.token_type = TOKEN_TYPE.INT_CONST
-            self.intVal()
-        elif self.current_token[0] == "\"" and self.current_token[-1] == "\"":
-            self.token_type = TOKEN_TYPE.STRING_CONST
-            self.stringVal()
-        else:
-            print("ERROR: NOT VALID TOKEN")
-
-    def keyWord(self):
-        keyword = ["class", "method", "function", "constructor", "int", "boolean", "char", "void",
-                   "var", "static", "field", "let", "do", "if", "else", "while", "return", "true",
-                   "false", "null", "this"]
-        for word in keyword:
-            if self.current_token == word:
-                self.key_word = word
-
-    def symbol(self):
-        symbol_list = ['{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*', '/', '&', '|',
-                       '<', '>', '=', '~']
-        for symbol in symbol_list:
-            if self.current_token == symbol:
-                if symbol == '<':
-                    self.sym = "&lt;"
-                elif symbol == '>':
-                    self.sym = "&gt;"
-                elif symbol == '\"':
-                    self.sym = "&quot;"
-                elif symbol == '&':
-                    self.sym = "&amp;"
-                else:
-                    self.sym = symbol
-                break
-
-    def identifier(self):
-        self.id = self.current_token
-
-    def intVal(self):
-        self.int_val = int(self.current_token)
-
-    def stringVal(self):
-        self.string_val = self.current_token # includes quotes here
-
-class CompilationEngine:
-    input_file = ""
-    output_file = ""
-    commands = ""
-    current_token = ""
-    next_token = ""
-    filtered_line = ""
-
-    line_num = 0
-    token_lines = None
-    keyword = ["class", "method", "function", "constructor", "int", "boolean", "char", "void",
-               "var", "static", "field", "let", "do", "if", "else", "while", "return", "true",
-               "false", "null", "this"]
-    symbol_list = ['{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*', '/', '&', '|',
-                   '<', '>', '=', '~']
+    def xml(self) -> str:
+        """ The XxxT.xml text of the tokens """
+        return "<tokens>\n" + "".join(token.xml() for token in self.tokens) + "</tokens>"
 
-    class_table = None
-    subroutine_table = None
-    var_name = ""
-    id_type = "" # 'int', 'char', 'boolean', className
-    kind = "" # STATIC, FIELD, ARG, VAR
-    subroutine_keyword = ""
-    added_this = False
-    class_name = ""
-    if_index = 0 # for unique branching labels
-    while_index = 0 # for unique branching labels
+OPS = frozenset(("+", "-", "*", "/", "&", "|", "<", ">", "="))
+OP_COMMANDS = {"+": "add", "-": "sub", "&": "and", "|": "or", "<": "lt", ">": "gt", "=": "eq"} # "*" and "/" are calls of Math.multiply and Math.divide
+SEGMENTS = {"static": "static", "field": "this", "argument": "argument", "var": "local"} # symbol kind: VM segment
+KEYWORD_VALUES = {"true": -1, "false": 0, "null": 0} # keyword constants that fold like integers
+SMALL_MULTIPLIER = 256 # products with constants below this become shift and add sequences instead of Math.multiply
 
-    vm_writer = None
 
+def word(value: int) -> int:
+    """ value as a Jack int, 16 bit two's complement """
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
 
-    def __init__(self, input_stream, output_stream):
-        self.input_file = open(input_stream, "r")
-        self.token_lines = self.input_file.readlines()
-        self.output_file = output_stream
-        # self.class_table = None 
-        # self.subroutine_table = None 
-        self.vm_writer = None
-             
-        self.compileClass()
-    def compileClass(self):
-        self.class_table = symbolTable() # HACK: Only allowed to add static or field here
-        self.subroutine_table = symbolTable() # HACK: Only allowed to add arg or var here
-        self.vm_writer = VMWriter(self.output_file + ".vm")
-
-        self.line_num += 1
-        self.filtered_line = self.helperFilter()
-        self.commands += "<class>\n<keyword>" + self.filtered_line + "</keyword>\n" 
-
-        self.line_num += 1 # for className
-        self.filtered_line = self.helperFilter()
-        self.commands += "<identifier>" + self.filtered_line + "</identifier>\n"
-        self.class_name = self.filtered_line
-
-        self.line_num += 1 # for symbol
-        self.filtered_line = self.helperFilter()
-        for sym in self.symbol_list:
-            if sym in self.filtered_line:
-                self.commands += "<symbol>" + sym + "</symbol>\n"
-                                                                    
-        self.line_num += 1 # keyword for initial classVarDec/subroutineDec
-        self.filtered_line = self.helperFilter()
-        while self.filtered_line in ("static", "field"):
-            self.compileClassVarDec() # goes to just after ;
-        while self.filtered_line in ("constructor", "function", "method"):
-            self.compileSubroutine() # goes to just after ;
-
-        self.commands += "<symbol>}</symbol>\n"
-        self.commands += "</class>"
-        self.input_file.close()
-        with open(self.output_file + ".xml", "w") as file:
-            file.write(self.commands)
-        self.vm_writer.close()
-
-    def compileClassVarDec(self):
-        """ Handles 1 or more class variable declarations """
-        self.commands += "<classVarDec>\n"
-        self.filtered_line = self.helperFilter()
-        self.commands += f"<keyword>{self.filtered_line}</keyword>\n"
-        self.kind = self.filtered_line # either STATIC or FIELD
-
-        self.line_num += 1 # for type
-        self.filtered_token = self.helperToken()
-        self.filtered_line = self.helperFilter()
-        if self.filtered_token == "keyword":
-            self.commands += f"<{self.filtered_token}>{self.filtered_line}</{self.filtered_token}>\n"
-            self.id_type = self.filtered_line
-        else:
-            self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-            self.id_type = self.filtered_line
-
-        self.line_num += 1 # for varName
-        self.filtered_line = self.helperFilter()
-        self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-        self.var_name = self.filtered_line
-
-        self.class_table.Define(self.var_name,self.id_type, self.kind)
-
-        self.line_num += 1 # for ; or ,
-        self.filtered_line = self.helperFilter()
-        if self.filtered_line == ";":
-            self.commands += f"<symbol>{self.filtered_line}</symbol>\n"
-        elif self.filtered_line == ",":
-            while (self.filtered_line == ","): 
-                self.commands += f"<symbol>{self.filtered_line}</symbol>\n"
-                self.line_num += 1 # for extra varName
-                self.filtered_line = self.helperFilter()
-                self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-
-                self.var_name = self.filtered_line
-                self.class_table.Define(self.var_name, self.id_type, self.kind)
-                self.line_num += 1 # for next comma
-                self.filtered_line = self.helperFilter()
-            self.commands += f"<symbol>{self.filtered_line}</symbol>\n" # if semicolon
-        self.commands += "</classVarDec>\n"
-
-        self.line_num += 1
-        self.filtered_line = self.helperFilter() # after ; -> classVarDec, subroutineDec, }
-        
 
-    def compileSubroutine(self):
-        """ Handles 1 or more subroutine declarations """
-        self.commands += "<subroutineDec>\n"
-        self.filtered_line = self.helperFilter()
-        self.commands += f"<keyword>{self.filtered_line}</keyword>\n"
-        self.subroutine_keyword = self.filtered_line
-
-        self.line_num += 1 # for return type
-        self.filtered_line = self.helperFilter()
-        if self.filtered_line in ("void", "int", "char", "boolean"):
-            self.commands += f"<keyword>{self.filtered_line}</keyword>\n"
-        else:
-            self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-
-        self.line_num += 1 # for subroutineName
-        self.filtered_line = self.helperFilter()
-        self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-        identifier_name = self.filtered_line
-        self.subroutine_table.startSubroutine()
-
-        self.line_num += 1
-        self.filtered_line = self.helperFilter()
-        self.commands += "<symbol>(</symbol>\n"
-
-        self.line_num += 1 # for param list - either type or )
-        self.filtered_line = self.helperFilter()
-        self.filtered_token = self.helperToken()
-
-        self.commands += "<parameterList>\n"
-        if self.filtered_line in ("int", "char", "boolean") or self.filtered_token == "identifier":
-            self.compileParameterList()
-            self.added_this = False
-        self.commands += "</parameterList>\n"
-        self.commands += "<symbol>)</symbol>\n"
-
-
-        self.commands += "<subroutineBody>\n"
-        self.line_num += 1 # for {
-        self.filtered_line = self.helperFilter()
-        self.commands += "<symbol>{</symbol>\n"
-        self.line_num += 1 # for "var" in varDec or "let", "if", "wile", "do", "return"
-        self.filtered_line = self.helperFilter()
-        num_local = 0
-        if self.filtered_line == "var":
-            while self.filtered_line == "var":
-                num_local = self.compileVarDec()
-
-        self.vm_writer.writeFunction(self.class_name + "." + identifier_name, num_local)
-        if self.subroutine_keyword == "constructor":
-            self.vm_writer.writePush("constant", self.class_table.varCount("field")) # setting constructor fields and allocating memory for 'this'
-            self.vm_writer.writeCall("Memory.alloc", 1)
-            self.vm_writer.writePop("pointer", 0)
-        elif self.subroutine_keyword == "method":
-            self.vm_writer.writePush("argument", 0)
-            self.vm_writer.writePop("pointer", 0)
+def evaluate(op: str, x: int, y: int) -> int | None:
+    """ x op y as the compiled program computes it, None when it is not safe to fold """
+    if op == "+":
+        return word(x + y)
+    if op == "-":
+        return word(x - y)
+    if op == "*":
+        return word(x * y) # Math.multiply keeps the low 16 bits
+    if op == "/":
+        if not -16384 <= x < 16384 or y == 0 or y == -32768:
+            return None # left to Math.divide, which is only exact in this range, like MATH$DIVIDE in 8/vm.py
+        quotient = abs(x) // abs(y)
+        return -quotient if (x < 0) != (y < 0) else quotient
+    if op == "&":
+        return word(x & y)
+    if op == "|":
+        return word(x | y)
+    if op == "=":
+        return -1 if x == y else 0
+    if not -32768 <= x - y <= 32767:
+        return None # lt and gt compare through x - y, which overflows here
+    return -1 if (x < y if op == "<" else x > y) else 0
 
 
-        if self.filtered_line in ("let", "if", "while", "do", "return"):
-            self.commands += "<statements>\n"
-            self.compileStatements()
-            self.commands += "</statements>\n"
-            self.commands += "<symbol>}</symbol>\n"
-        self.commands += "</subroutineBody>\n"
-        self.commands += "</subroutineDec>\n"
+class ClassDec:  # class className { classVarDec* subroutineDec* }
+    __slots__ = ("name", "variables", "subroutines")
 
-        if self.line_num < len(self.token_lines)-1: # not at EOF
-            self.line_num += 1 # for subroutineDec
-            self.filtered_line = self.helperFilter()
-            if self.helperFilter() in ("constructor", "function", "method"):
-                self.compileSubroutine()
+    def __init__(self, name: str, variables: list, subroutines: list):
+        self.name = name
+        self.variables = variables # ClassVarDec nodes
+        self.subroutines = subroutines # SubroutineDec nodes
 
 
-    def compileStatements(self):
-        
-        self.filtered_line = self.helperFilter()
-        if self.filtered_line == "let":
-            self.compileLet()
-        elif self.filtered_line == "if":
-            self.compileIf()
-        elif self.filtered_line == "while":
-            self.compileWhile()
-        elif self.filtered_line == "do":
-            self.compileDo()
-        elif self.filtered_line == "return":
-            self.compileReturn()
-
-
-        self.filtered_line = self.helperFilter()
-        if self.filtered_line in ("let", "if", "while", "do", "return"):
-            self.compileStatements()
-
-    def compileReturn(self):
-        self.commands += "<returnStatement>\n"
-        self.commands += "<keyword>return</keyword>\n"
-        self.line_num += 1 # for expression or ;
-        self.filtered_line = self.helperFilter()
-        if self.filtered_line != ";":
-            # expression
-            self.compileExpression()
-            if self.filtered_line == ";":
-                self.vm_writer.writeReturn()
-        else:
-            self.vm_writer.writeReturn()
-        self.commands += "<symbol>;</symbol>\n"
-        
-        self.commands += "</returnStatement>\n"
-        self.line_num += 1
-        self.filtered_line = self.helperFilter()
-
-    def compileDo(self):
-        # TODO: Finish this do statement first
-        # Have to add class into class_table with type as self.class_name
-        # Have to make sure to check class_table if checking subroutine_table fails
-        # Anytime subroutine (constructor, method, or function) is declared or called, make sure class_name. in front
-        self.commands += "<doStatement>\n"
-        self.commands += "<keyword>do</keyword>\n"
-        self.line_num += 1 # for subroutineName
-        self.filtered_line = self.helperFilter()
-        self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-        identifier_name = self.filtered_line
-        self.line_num += 1 # for ( or .
-        self.filtered_line = self.helperFilter()
-        if self.filtered_line == "(": # METHOD
-            self.commands += "<symbol>(</symbol>\n"
-            self.line_num += 1 # for expressionList which could also be empty
-            self.filtered_line = self.helperFilter()
-            self.commands += "<expressionList>\n" # need this even if empty
+class ClassVarDec:  # (static | field) type varName (, varName)* ;
+    __slots__ = ("kind", "type", "names")
 
-            self.vm_writer.writePush("pointer", 0)
-            num_args = self.compileExpressionList()
-            num_args += 1
-            self.vm_writer.writeCall(identifier_name, num_args)
-
-            self.commands += "</expressionList>\n"
-            self.commands += "<symbol>)</symbol>\n"
-        elif self.filtered_line == ".": # FUNCTION
-            identifier_type = self.subroutine_table.typeOf(identifier_name)
-            if identifier_type == None:
-                identifier_type = self.class_table.typeOf(identifier_name)
-            if (identifier_type == self.class_name) or (identifier_type == None):
-                self.commands += "<symbol>.</symbol>\n"
-                self.line_num += 1 # for subroutine name
-                self.filtered_line = self.helperFilter()
-
-                func_name = identifier_name + "." + self.filtered_line
-                self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-                self.line_num += 1 # for (
-                self.filtered_line = self.helperFilter()
-                self.commands += "<symbol>(</symbol>\n"
-                self.line_num += 1 # for expressionList which could also be empty
-                self.filtered_line = self.helperFilter()
-                self.commands += "<expressionList>\n" # need this even if empty
-                num_args = self.compileExpressionList()
-                print("reached")
-                self.vm_writer.writeCall(func_name, num_args)
-
-
-                self.commands += "</expressionList>\n"
-                self.commands += "<symbol>)</symbol>\n"
-            else:
-                self.commands += "<symbol>.</symbol>\n"
-                self.line_num += 1 # for subroutine name
-                self.filtered_line = self.helperFilter()
-
-                method_name = identifier_name + "." + self.filtered_line # TODO: May need to make this as self.class_name + . + subroutineName not varName
-                self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-                self.line_num += 1 # for (
-                self.filtered_line = self.helperFilter()
-                self.commands += "<symbol>(</symbol>\n"
-                self.line_num += 1 # for expressionList which could also be empty
-                self.filtered_line = self.helperFilter()
-                self.commands += "<expressionList>\n" # need this even if empty
-                self.vm_writer.writePush("pointer", 0)
-                num_args = self.compileExpressionList()
-                num_args += 1
-                self.vm_writer.writeCall(method_name, num_args)
+    def __init__(self, kind: str, id_type: str, names: list):
+        self.kind = kind # 'static' or 'field'
+        self.type = id_type # 'int', 'char', 'boolean', className
+        self.names = names
 
-                self.commands += "</expressionList>\n"
-                self.commands += "<symbol>)</symbol>\n"
 
-        self.line_num += 1 # for ;
-        self.filtered_line = self.helperFilter()
-        self.commands += "<symbol>;</symbol>\n"
+class SubroutineDec:  # (constructor | function | method) (void | type) name ( parameterList ) { varDec* statements }
+    __slots__ = ("kind", "return_type", "name", "parameters", "locals", "statements")
 
-        self.commands += "</doStatement>\n"
-        self.line_num += 1
-        self.filtered_line = self.helperFilter()
+    def __init__(self, kind: str, return_type: str, name: str, parameters: list, local_vars: list, statements: list):
+        self.kind = kind
+        self.return_type = return_type
+        self.name = name
+        self.parameters = parameters # (type, name) pairs
+        self.locals = local_vars # VarDec nodes
+        self.statements = statements
 
-    def compileExpressionList(self):
-        num_args = 0
-        self.filtered_line = self.helperFilter()
-        while self.filtered_line != ")":
-            # expression
-            self.compileExpression() # either reaches , or )
-            num_args += 1
-            self.filtered_line = self.helperFilter()
-            if self.filtered_line == ",":
-                self.commands += "<symbol>,</symbol>\n"
-                self.line_num += 1
-                self.filtered_line = self.helperFilter()
-        return num_args
-
-    def compileExpression(self):
-
-        print("reached: ", self.filtered_line)
-        op_list = ["+", "-", "*", "/", "&amp;", "|", "&lt;", "&gt;", "="]
-        op_commands = {"+":"add", "-":"sub", "*": "call Math.multiply 2", "/": "call Math.divide 2", "&amp;":"and", "|":"or", "&lt;":"lt", "&gt;":"gt", "=":"eq"}
-        self.commands += "<expression>\n"
-        self.compileTerm()
-        self.filtered_line = self.helperFilter() # just after, either op or ignore
-        while self.filtered_line in op_list:
-            self.commands += f"<symbol>{self.filtered_line}</symbol>\n"
-            op = op_commands[self.filtered_line]
-            self.line_num += 1 # set up compileTerm
-            self.filtered_line = self.helperFilter()
-            self.compileTerm()
-            self.filtered_line = self.helperFilter()
-            self.vm_writer.writeArithmetic(op)
-
-
-
-        self.commands += "</expression>\n"
-        # already incremented
-
-    def compileTerm(self):
-        self.commands += "<term>\n"
-        self.filtered_line = self.helperFilter()
-        self.filtered_token = self.helperToken()
-        if self.filtered_token == "integerConstant":
-            self.commands += f"<integerConstant>{self.filtered_line}</integerConstant>\n"
-            self.vm_writer.writePush("constant", int(self.filtered_line))
-        elif self.filtered_token == "stringConstant":
-            self.commands += f"<stringConstant>{self.filtered_line}</stringConstant>\n"
-            self.vm_writer.writePush("constant", len(self.filtered_line))
-            self.vm_writer.writeCall("String.new", 1) # creates a new EMPTY string
-            for char in self.filtered_line:
-                self.vm_writer.writePush("constant", ord(char))
-                self.vm_writer.writeCall("String.appendChar", 2) # adds to string before
-        elif self.filtered_line in ("true", "false", "null", "this"):
-            self.commands += f"<keyword>{self.filtered_line}</keyword>\n"
-            if self.filtered_line == "true":
-                self.vm_writer.writePush("constant", 1)
-                self.vm_writer.writeArithmetic("neg")
-            elif self.filtered_line in ("false" or "null"):
-                self.vm_writer.writePush("constant", 0)
-            else:
-                self.vm_writer.writePush("pointer", 0)
-        elif self.filtered_token == "identifier":
-            # either varname, varname[expr], subroutine(), varName.subroutine()
-            self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-            identifier_name = self.filtered_line
-
-            self.line_num += 1 # for ., [, ( -> ignore if none of these
-            self.filtered_line = self.helperFilter()
-
-            if self.filtered_line == ".":
-                identifier_type = self.subroutine_table.typeOf(identifier_name)
-                if identifier_type == None:
-                    identifier_type = self.class_table.typeOf(identifier_name)
-                if identifier_type == self.class_name:
-                    self.commands += "<symbol>.</symbol>\n"
-                    self.line_num += 1 # for subroutine name
-                    self.filtered_line = self.helperFilter()
-
-                    func_name = identifier_name + "." + self.filtered_line
-                    self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-                    self.line_num += 1 # for (
-                    self.filtered_line = self.helperFilter()
-                    self.commands += "<symbol>(</symbol>\n"
-                    self.line_num += 1 # for expressionList
-                    self.filtered_line = self.helperFilter()
-                    self.commands += "<expressionList>\n"
-                    num_args = self.compileExpressionList()
-                    self.vm_writer.writeCall(func_name, num_args)
-
-
-                    self.commands += "</expressionList>\n"
-                    self.commands += "<symbol>)</symbol>\n"
-                else:
-                    self.commands += "<symbol>.</symbol>\n"
-                    self.line_num += 1 # for subroutine name
-                    self.filtered_line = self.helperFilter()
-
-                    method_name = identifier_name + "." + self.filtered_line
-                    self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-                    self.line_num += 1 # for (
-                    self.filtered_line = self.helperFilter()
-                    self.commands += "<symbol>(</symbol>\n"
-                    self.line_num += 1 # for expressionList
-                    self.filtered_line = self.helperFilter()
-                    self.commands += "<expressionList>\n"
-                    self.vm_writer.writePush("pointer", 0)
-                    num_args = self.compileExpressionList()
-                    num_args += 1 # since we added in object
-                    self.vm_writer.writeCall(method_name, num_args)
-
-                    self.commands += "</expressionList>\n"
-                    self.commands += "<symbol>)</symbol>\n"
-
-
-
-            elif self.filtered_line == "(":
-                self.commands += "<symbol>(</symbol>\n"
-                self.line_num += 1 # for expressionList
-                self.filtered_line = self.helperFilter()
-                self.commands += "<expressionList>\n"
-
-                self.vm_writer.writePush("pointer", 0)
-                num_args = self.compileExpressionList()
-                num_args += 1 # since we added in object
-                self.vm_writer.writeCall(identifier_name, num_args)
-
-                self.commands += "</expressionList>\n"
-                self.commands += "<symbol>)</symbol>\n"
-
-            elif self.filtered_line == "[":
-                self.commands += "<symbol>[</symbol>\n"
-                self.line_num += 1
-                self.filtered_line = self.helperFilter()
-                self.compileExpression()
-
-                var_kind = self.subroutine_table.kindOf(identifier_name)
-                if var_kind == None:
-                    var_kind = self.class_table.kindOf(identifier_name)
-                    var_kind = "this" if var_kind == "field" else print("ERROR")
-                var_index = self.subroutine_table.indexOf(identifier_name)
-                self.vm_writer.writePush(var_kind, var_index)
-                self.vm_writer.writeArithmetic("add")
-                self.vm_writer.writePop("pointer", 1)
-                self.commands += "<symbol>]</symbol>\n"
-            else:
-                var_kind = self.subroutine_table.kindOf(identifier_name)
-                if var_kind == None:
-                    var_kind = self.class_table.kindOf(identifier_name)
-                    var_kind = "this" if var_kind == "field" else None
-                var_index = self.subroutine_table.indexOf(identifier_name)
-                self.vm_writer.writePush(var_kind, var_index)
-
-                self.line_num -= 1
-                self.filtered_line = self.helperFilter()
-        elif self.filtered_line == "(":
-            self.commands += "<symbol>(</symbol>\n"
-            self.line_num += 1
-            self.filtered_line = self.helperFilter()
-            self.compileExpression()
-            self.commands += "<symbol>)</symbol>\n"
-            # self.line_num -= 1
-        elif self.filtered_line in ("-", "~"):
-            op = self.filtered_line
-            self.commands += f"<symbol>{self.filtered_line}</symbol>\n"
-            self.line_num += 1 # set up recursion
-            self.filtered_line = self.helperFilter()
-            self.compileTerm()
-            if op == "-":
-                self.vm_writer.writeArithmetic("not")
-            elif op == "~":
-                self.vm_writer.writeArithmetic("neg")
-            else:
-                print("ERROR: expected \'-\' or \"=\"")
 
+class VarDec:  # var type varName (, varName)* ;
+    __slots__ = ("type", "names")
 
-        self.commands += "</term>\n"
-        self.line_num += 1
-        self.filtered_line = self.helperFilter()
+    def __init__(self, id_type: str, names: list):
+        self.type = id_type
+        self.names = names
 
-    def compileWhile(self):
-        self.commands += "<whileStatement>\n"
-        self.commands += "<keyword>while</keyword>\n"
-        self.line_num += 1 # for (
-        self.filtered_line = self.helperFilter()
 
-        self.vm_writer.writeLabel("WHILE_LOOP$" + str(self.while_index))
+class LetStatement:  # let varName ([ expression ])? = expression ;
+    __slots__ = ("name", "index", "value")
 
-        self.commands += "<symbol>(</symbol>\n"
-        self.line_num += 1
-        self.filtered_line = self.helperFilter()
-        self.compileExpression()
+    def __init__(self, name: str, index, value):
+        self.name = name
+        self.index = index # Expression or None
+        self.value = value
 
-        self.vm_writer.writeArithmetic("not")
-        self.vm_writer.writeIf("WHILE_END$" + str(self.while_index))
-
-        self.commands += "<symbol>)</symbol>\n"
-        if self.filtered_line == ")":
-            self.line_num += 1
-            self.filtered = self.helperFilter()
-        self.commands += "<symbol>{</symbol>\n"
-        self.line_num += 1
-        self.filtered_line = self.helperFilter()
-        self.commands += "<statements>\n"
-        self.compileStatements() # reaches just after last symbol to '}' 
-        self.commands += "</statements>\n"
-        self.commands += "<symbol>}</symbol>\n"
-
-        self.vm_writer.writeGoto("WHILE_LOOP$" + str(self.while_index))
-        self.vm_writer.writeLabel("WHILE_END$" + str(self.while_index))
-
-
-        self.commands += "</whileStatement>\n"
-        self.line_num += 1
-        self.filtered_line = self.helperFilter()
-        self.while_index += 1
 
-    def compileIf(self):
-        self.commands += "<ifStatement>\n"
-        self.commands += "<keyword>if</keyword>\n"
-        self.line_num += 1 # for (
-        self.filtered_line = self.helperFilter()
-        self.commands += "<symbol>(</symbol>\n"
-        self.line_num += 1
-        self.filtered_line = self.helperFilter()
-        self.compileExpression() # should reach just after to ')'
-        self.commands += "<symbol>)</symbol>\n"
-
-        self.vm_writer.writeIf("IF_TRUE$" + str(self.if_index))
-        self.vm_writer.writeGoto("IF_FALSE$" + str(self.if_index))
-
-        self.line_num += 1 # for {
-        self.filtered_line = self.helperFilter()
-        self.commands += "<symbol>{</symbol>\n"
-        self.line_num += 1 # for statements keyword
-        self.filtered_line = self.helperFilter()
-        self.commands += "<statements>\n"
-        self.vm_writer.writeLabel("IF_TRUE$" + str(self.if_index))
-        self.compileStatements() # reaches just after last symbol to '}' 
-        self.commands += "</statements>\n"
-        self.commands += "<symbol>}</symbol>\n"
-
-
-        self.line_num += 1
-        self.filtered_line == self.helperFilter()
-        if self.filtered_line == "else</keyword>\n":
-            self.filtered_line = "else"
-        if self.filtered_line == "else":
-            # else statement included
-            self.commands += "<keyword>else</keyword>\n"
-
-            self.vm_writer.writeGoto("IF_END$" + str(self.if_index))
-            self.vm_writer.writeLabel("IF_FALSE$" + str(self.if_index))
-
-            self.line_num += 1
-            self.filtered_line = self.helperFilter()
-            self.commands += "<symbol>{</symbol>\n"
-            self.line_num += 1
-            self.filtered_line = self.helperFilter()
-            self.commands += "<statements>\n"
-            self.compileStatements()
-            self.commands += "</statements>\n"
-            self.commands += "<symbol>}</symbol>\n"
-            self.commands += "</ifStatement>\n"
-            self.line_num += 1 # for recursion
-            self.filtered_line = self.helperFilter()
-            self.vm_writer.writeLabel("IF_END$" + str(self.if_index))
-        else:
-            self.vm_writer.writeLabel("IF_FALSE$" + str(self.if_index))
-            self.if_index += 1
-            self.commands += "</ifStatement>\n"
-
-    def compileLet(self):
-        self.commands += "<letStatement>\n"
-        self.commands += "<keyword>let</keyword>\n"
-        self.line_num += 1 # for varName
-        self.filtered_line = self.helperFilter()
-        self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-        identifier_name = self.filtered_line
-        self.line_num += 1 # for [ or = 
-        self.filtered_line = self.helperFilter()
-        if self.filtered_line == "[":
-            self.commands += "<symbol>[</symbol>\n"
-            self.line_num += 1
-            self.filtered_line = self.helperFilter()
-            self.compileExpression()
-            self.commands += "<symbol>]</symbol>\n"
-
-
-            var_kind = self.subroutine_table.kindOf(identifier_name)
-            if var_kind == None:
-                var_kind = self.class_table.kindOf(identifier_name)
-                var_kind = "this" if var_kind == "field" else None
-            var_index = self.subroutine_table.indexOf(identifier_name)
-            self.vm_writer.writePush(var_kind, var_index)
-            self.vm_writer.writeArithmetic("add") # gets address of array[index]
+class IfStatement:  # if ( expression ) { statements } (else { statements })?
+    __slots__ = ("condition", "statements", "else_statements")
+
+    def __init__(self, condition, statements: list, else_statements):
+        self.condition = condition
+        self.statements = statements
+        self.else_statements = else_statements # list or None without else
+
+
+class WhileStatement:  # while ( expression ) { statements }
+    __slots__ = ("condition", "statements")
+
+    def __init__(self, condition, statements: list):
+        self.condition = condition
+        self.statements = statements
+
+
+class DoStatement:  # do subroutineCall ;
+    __slots__ = ("call",)
+
+    def __init__(self, call):
+        self.call = call # SubroutineCall
+
+
+class ReturnStatement:  # return expression? ;
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value # Expression or None
+
+
+class Expression:  # term (op term)*, evaluated left to right as Jack has no precedence
+    __slots__ = ("terms", "ops")
+
+    def __init__(self, terms: list, ops: list):
+        self.terms = terms # a term in brackets is itself an Expression
+        self.ops = ops # len(terms) - 1 symbols
+
+
+class IntegerConstant:
+    __slots__ = ("value",)
+
+    def __init__(self, value: int):
+        self.value = value
 
 
-            self.line_num += 1 # for = 
-            self.filtered_line = self.helperFilter()
-            self.commands  += "<symbol>=</symbol>\n"
-            # self.line_num += 1 # for expression
-            self.line_num += 1
-            self.filtered_line = self.helperFilter()
-            self.compileExpression()
+class StringConstant:
+    __slots__ = ("value",)
 
+    def __init__(self, value: str):
+        self.value = value
+
+
+class KeywordConstant:  # true, false, null, this
+    __slots__ = ("value",)
+
+    def __init__(self, value: str):
+        self.value = value
+
+
+class VarName:
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class ArrayEntry:  # varName [ expression ]
+    __slots__ = ("name", "index")
+
+    def __init__(self, name: str, index):
+        self.name = name
+        self.index = index
+
+
+class SubroutineCall:  # name ( expressionList ) or (className | varName) . name ( expressionList )
+    __slots__ = ("target", "name", "arguments")
+
+    def __init__(self, target, name: str, arguments: list):
+        self.target = target # None for a method of this class
+        self.name = name
+        self.arguments = arguments # Expression nodes
+
+
+class UnaryOp:  # (- | ~) term
+    __slots__ = ("op", "term")
+
+    def __init__(self, op: str, term):
+        self.op = op
+        self.term = term
+
+
+class Parser:
+    """ Recursive descent over the Token records of one class, builds its ClassDec """
+    tokens = None
+    position = 0 # index of the next token
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> str:
+        """ The value of the next token, "" at the end of the file """
+        if self.position < len(self.tokens):
+            return self.tokens[self.position].value
+        return ""
+
+    def advance(self) -> Token:
+        if self.position >= len(self.tokens):
+            raise ValueError("unexpected end of file")
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def expect(self, value: str) -> Token:
+        token = self.advance()
+        if token.value != value or token.kind == TOKEN_TYPE.STRING_CONST:
+            self.error(token, f"expected '{value}'")
+        return token
+
+    def expectIdentifier(self) -> str:
+        token = self.advance()
+        if token.kind != TOKEN_TYPE.IDENTIFIER:
+            self.error(token, "expected an identifier")
+        return token.value
+
+    def error(self, token: Token, message: str):
+        raise ValueError(f"{token.line}:{token.column}: {message}, got '{token.value}'")
+
+    def parseType(self, allow_void=False) -> str:
+        token = self.advance()
+        if token.kind == TOKEN_TYPE.IDENTIFIER or token.value in ("int", "char", "boolean") or \
+                (allow_void and token.value == "void"):
+            return token.value
+        self.error(token, "expected a type")
+
+    def parseNames(self) -> list:
+        """ varName (, varName)* ; """
+        names = [self.expectIdentifier()]
+        while self.peek() == ",":
+            self.position += 1
+            names.append(self.expectIdentifier())
+        self.expect(";")
+        return names
+
+    def parseClass(self) -> ClassDec:
+        self.expect("class")
+        name = self.expectIdentifier()
+        self.expect("{")
+        variables = []
+        while self.peek() in ("static", "field"):
+            kind = self.advance().value
+            variables.append(ClassVarDec(kind, self.parseType(), self.parseNames()))
+        subroutines = []
+        while self.peek() in ("constructor", "function", "method"):
+            subroutines.append(self.parseSubroutine())
+        self.expect("}")
+        if self.position < len(self.tokens):
+            self.error(self.tokens[self.position], "expected the end of the file")
+        return ClassDec(name, variables, subroutines)
+
+    def parseSubroutine(self) -> SubroutineDec:
+        kind = self.advance().value
+        return_type = self.parseType(True)
+        name = self.expectIdentifier()
+        self.expect("(")
+        parameters = []
+        if self.peek() != ")":
+            parameters.append((self.parseType(), self.expectIdentifier()))
+            while self.peek() == ",":
+                self.position += 1
+                parameters.append((self.parseType(), self.expectIdentifier()))
+        self.expect(")")
+        self.expect("{")
+        local_vars = []
+        while self.peek() == "var":
+            self.position += 1
+            local_vars.append(VarDec(self.parseType(), self.parseNames()))
+        statements = self.parseStatements()
+        self.expect("}")
+        return SubroutineDec(kind, return_type, name, parameters, local_vars, statements)
+
+    def parseStatements(self) -> list:
+        """ Statements up to the closing } which is left for the caller """
+        statements = []
+        while True:
+            keyword = self.peek()
+            if keyword == "let":
+                statements.append(self.parseLet())
+            elif keyword == "if":
+                statements.append(self.parseIf())
+            elif keyword == "while":
+                statements.append(self.parseWhile())
+            elif keyword == "do":
+                statements.append(self.parseDo())
+            elif keyword == "return":
+                statements.append(self.parseReturn())
+            else:
+                return statements
+
+    def parseLet(self) -> LetStatement:
+        self.position += 1
+        name = self.expectIdentifier()
+        index = None
+        if self.peek() == "[":
+            self.position += 1
+            index = self.parseExpression()
+            self.expect("]")
+        self.expect("=")
+        value = self.parseExpression()
+        self.expect(";")
+        return LetStatement(name, index, value)
+
+    def parseBlock(self) -> list:
+        """ { statements } """
+        self.expect("{")
+        statements = self.parseStatements()
+        self.expect("}")
+        return statements
+
+    def parseIf(self) -> IfStatement:
+        self.position += 1
+        self.expect("(")
+        condition = self.parseExpression()
+        self.expect(")")
+        statements = self.parseBlock()
+        else_statements = None
+        if self.peek() == "else":
+            self.position += 1
+            else_statements = self.parseBlock()
+        return IfStatement(condition, statements, else_statements)
+
+    def parseWhile(self) -> WhileStatement:
+        self.position += 1
+        self.expect("(")
+        condition = self.parseExpression()
+        self.expect(")")
+        return WhileStatement(condition, self.parseBlock())
+
+    def parseDo(self) -> DoStatement:
+        self.position += 1
+        name = self.expectIdentifier()
+        call = self.parseCall(name)
+        if call is None:
+            self.error(self.advance(), "expected a subroutine call")
+        self.expect(";")
+        return DoStatement(call)
+
+    def parseReturn(self) -> ReturnStatement:
+        self.position += 1
+        value = None
+        if self.peek() != ";":
+            value = self.parseExpression()
+        self.expect(";")
+        return ReturnStatement(value)
+
+    def parseCall(self, name: str) -> SubroutineCall | None:
+        """ The rest of a subroutine call after its first identifier, None when no call follows """
+        target = None
+        if self.peek() == ".":
+            self.position += 1
+            target, name = name, self.expectIdentifier()
+        elif self.peek() != "(":
+            return None
+        self.expect("(")
+        arguments = []
+        if self.peek() != ")":
+            arguments.append(self.parseExpression())
+            while self.peek() == ",":
+                self.position += 1
+                arguments.append(self.parseExpression())
+        self.expect(")")
+        return SubroutineCall(target, name, arguments)
+
+    def parseExpression(self) -> Expression:
+        terms = [self.parseTerm()]
+        ops = []
+        while self.peek() in OPS and self.tokens[self.position].kind == TOKEN_TYPE.SYMBOL:
+            ops.append(self.advance().value)
+            terms.append(self.parseTerm())
+        return Expression(terms, ops)
+
+    def parseTerm(self):
+        token = self.advance()
+        kind = token.kind
+        if kind == TOKEN_TYPE.INT_CONST:
+            return IntegerConstant(int(token.value))
+        if kind == TOKEN_TYPE.STRING_CONST:
+            return StringConstant(token.value)
+        if kind == TOKEN_TYPE.IDENTIFIER:
+            if self.peek() == "[":
+                self.position += 1
+                index = self.parseExpression()
+                self.expect("]")
+                return ArrayEntry(token.value, index)
+            call = self.parseCall(token.value)
+            return VarName(token.value) if call is None else call
+        if kind == TOKEN_TYPE.KEYWORD and token.value in ("true", "false", "null", "this"):
+            return KeywordConstant(token.value)
+        if token.value == "(":
+            expression = self.parseExpression()
+            self.expect(")")
+            return expression
+        if token.value in ("-", "~"):
+            return UnaryOp(token.value, self.parseTerm())
+        self.error(token, "expected a term")
+
+
+class ParseTreeWriter:
+    """ The Xxx.xml parse tree of a ClassDec, in the element layout of the nand2tetris test files """
+    lines = None
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, class_dec: ClassDec) -> str:
+        lines = self.lines
+        lines.append("<class>\n<keyword>class</keyword>\n")
+        self.terminal("identifier", class_dec.name)
+        lines.append("<symbol>{</symbol>\n")
+        for variable in class_dec.variables:
+            lines.append("<classVarDec>\n")
+            self.terminal("keyword", variable.kind)
+            self.writeNames(variable.type, variable.names)
+            lines.append("</classVarDec>\n")
+        for subroutine in class_dec.subroutines:
+            self.writeSubroutine(subroutine)
+        lines.append("<symbol>}</symbol>\n</class>")
+        return "".join(lines)
+
+    def terminal(self, tag: str, value: str):
+        self.lines.append("<" + tag + ">" + value + "</" + tag + ">\n")
+
+    def writeType(self, id_type: str):
+        self.terminal("keyword" if id_type in KEYWORDS else "identifier", id_type)
+
+    def writeNames(self, id_type: str, names: list):
+        """ type varName (, varName)* ; """
+        self.writeType(id_type)
+        self.terminal("identifier", names[0])
+        for name in names[1:]:
+            self.lines.append("<symbol>,</symbol>\n")
+            self.terminal("identifier", name)
+        self.lines.append("<symbol>;</symbol>\n")
+
+    def writeSubroutine(self, subroutine: SubroutineDec):
+        lines = self.lines
+        lines.append("<subroutineDec>\n")
+        self.terminal("keyword", subroutine.kind)
+        self.writeType(subroutine.return_type)
+        self.terminal("identifier", subroutine.name)
+        lines.append("<symbol>(</symbol>\n<parameterList>\n")
+        for i, (id_type, name) in enumerate(subroutine.parameters):
+            if i:
+                lines.append("<symbol>,</symbol>\n")
+            self.writeType(id_type)
+            self.terminal("identifier", name)
+        lines.append("</parameterList>\n<symbol>)</symbol>\n<subroutineBody>\n<symbol>{</symbol>\n")
+        for variable in subroutine.locals:
+            lines.append("<varDec>\n<keyword>var</keyword>\n")
+            self.writeNames(variable.type, variable.names)
+            lines.append("</varDec>\n")
+        self.writeStatements(subroutine.statements)
+        lines.append("<symbol>}</symbol>\n</subroutineBody>\n</subroutineDec>\n")
+
+    def writeStatements(self, statements: list):
+        lines = self.lines
+        lines.append("<statements>\n")
+        for statement in statements:
+            kind = type(statement)
+            if kind is LetStatement:
+                lines.append("<letStatement>\n<keyword>let</keyword>\n")
+                self.terminal("identifier", statement.name)
+                if statement.index is not None:
+                    lines.append("<symbol>[</symbol>\n")
+                    self.writeExpression(statement.index)
+                    lines.append("<symbol>]</symbol>\n")
+                lines.append("<symbol>=</symbol>\n")
+                self.writeExpression(statement.value)
+                lines.append("<symbol>;</symbol>\n</letStatement>\n")
+            elif kind is IfStatement:
+                lines.append("<ifStatement>\n<keyword>if</keyword>\n<symbol>(</symbol>\n")
+                self.writeExpression(statement.condition)
+                lines.append("<symbol>)</symbol>\n<symbol>{</symbol>\n")
+                self.writeStatements(statement.statements)
+                lines.append("<symbol>}</symbol>\n")
+                if statement.else_statements is not None:
+                    lines.append("<keyword>else</keyword>\n<symbol>{</symbol>\n")
+                    self.writeStatements(statement.else_statements)
+                    lines.append("<symbol>}</symbol>\n")
+                lines.append("</ifStatement>\n")
+            elif kind is WhileStatement:
+                lines.append("<whileStatement>\n<keyword>while</keyword>\n<symbol>(</symbol>\n")
+                self.writeExpression(statement.condition)
+                lines.append("<symbol>)</symbol>\n<symbol>{</symbol>\n")
+                self.writeStatements(statement.statements)
+                lines.append("<symbol>}</symbol>\n</whileStatement>\n")
+            elif kind is DoStatement:
+                lines.append("<doStatement>\n<keyword>do</keyword>\n")
+                self.writeCall(statement.call)
+                lines.append("<symbol>;</symbol>\n</doStatement>\n")
+            else:
+                lines.append("<returnStatement>\n<keyword>return</keyword>\n")
+                if statement.value is not None:
+                    self.writeExpression(statement.value)
+                lines.append("<symbol>;</symbol>\n</returnStatement>\n")
+        lines.append("</statements>\n")
+
+    def writeExpression(self, expression: Expression):
+        lines = self.lines
+        lines.append("<expression>\n")
+        self.writeTerm(expression.terms[0])
+        for op, term in zip(expression.ops, expression.terms[1:]):
+            lines.append("<symbol>" + XML_ESCAPES.get(op, op) + "</symbol>\n")
+            self.writeTerm(term)
+        lines.append("</expression>\n")
+
+    def writeCall(self, call: SubroutineCall):
+        lines = self.lines
+        if call.target is not None:
+            self.terminal("identifier", call.target)
+            lines.append("<symbol>.</symbol>\n")
+        self.terminal("identifier", call.name)
+        lines.append("<symbol>(</symbol>\n<expressionList>\n")
+        for i, argument in enumerate(call.arguments):
+            if i:
+                lines.append("<symbol>,</symbol>\n")
+            self.writeExpression(argument)
+        lines.append("</expressionList>\n<symbol>)</symbol>\n")
+
+    def writeTerm(self, term):
+        lines = self.lines
+        lines.append("<term>\n")
+        kind = type(term)
+        if kind is IntegerConstant:
+            self.terminal("integerConstant", str(term.value))
+        elif kind is StringConstant:
+            self.terminal("stringConstant", term.value)
+        elif kind is KeywordConstant:
+            self.terminal("keyword", term.value)
+        elif kind is VarName:
+            self.terminal("identifier", term.name)
+        elif kind is ArrayEntry:
+            self.terminal("identifier", term.name)
+            lines.append("<symbol>[</symbol>\n")
+            self.writeExpression(term.index)
+            lines.append("<symbol>]</symbol>\n")
+        elif kind is SubroutineCall:
+            self.writeCall(term)
+        elif kind is Expression:
+            lines.append("<symbol>(</symbol>\n")
+            self.writeExpression(term)
+            lines.append("<symbol>)</symbol>\n")
+        else:
+            lines.append("<symbol>" + term.op + "</symbol>\n")
+            self.writeTerm(term.term)
+        lines.append("</term>\n")
+
+
+class ExpressionFolder:
+    """ Optimization pass between the Parser and the CodeGenerator, folds constant subexpressions in place """
+
+    def foldClass(self, class_dec: ClassDec):
+        for subroutine in class_dec.subroutines:
+            self.foldStatements(subroutine.statements)
+
+    def foldStatements(self, statements: list):
+        for statement in statements:
+            kind = type(statement)
+            if kind is LetStatement:
+                if statement.index is not None:
+                    statement.index = self.foldExpression(statement.index)
+                statement.value = self.foldExpression(statement.value)
+            elif kind is IfStatement:
+                statement.condition = self.foldExpression(statement.condition)
+                self.foldStatements(statement.statements)
+                if statement.else_statements is not None:
+                    self.foldStatements(statement.else_statements)
+            elif kind is WhileStatement:
+                statement.condition = self.foldExpression(statement.condition)
+                self.foldStatements(statement.statements)
+            elif kind is DoStatement:
+                self.foldTerm(statement.call)
+            elif statement.value is not None:
+                statement.value = self.foldExpression(statement.value)
+
+    def constant(self, term) -> int | None:
+        """ The value of a constant term, None otherwise """
+        kind = type(term)
+        if kind is IntegerConstant:
+            return word(term.value)
+        if kind is KeywordConstant:
+            return KEYWORD_VALUES.get(term.value)
+        return None
+
+    def foldExpression(self, expression: Expression) -> Expression:
+        terms = [self.foldTerm(term) for term in expression.terms]
+        ops = list(expression.ops)
+        if type(terms[0]) is Expression: # (a op b) op c is a op b op c, as Jack goes left to right
+            ops[:0] = terms[0].ops
+            terms[:1] = terms[0].terms
+        folded_terms, folded_ops = [terms[0]], []
+        for op, term in zip(ops, terms[1:]):
+            y = self.constant(term)
+            if y is not None:
+                if len(folded_terms) == 1:
+                    x = self.constant(folded_terms[0])
+                    if x is not None:
+                        value = evaluate(op, x, y)
+                        if value is not None:
+                            folded_terms[0] = IntegerConstant(value)
+                            continue
+                if op in ("+", "-") and folded_ops and folded_ops[-1] in ("+", "-") and \
+                        self.constant(folded_terms[-1]) is not None:
+                    # (e + c1) - c2 is e + (c1 - c2) in 16 bit arithmetic
+                    previous = self.constant(folded_terms.pop())
+                    y = word((previous if folded_ops.pop() == "+" else -previous) + (y if op == "+" else -y))
+                    op = "+"
+                if y < 0 and op in ("+", "-") and y != -32768:
+                    op, y = "-" if op == "+" else "+", -y
+                if (y == 0 and op in ("+", "-", "|")) or (y == -1 and op == "&") or (y == 1 and op == "*"):
+                    continue # e op y is e, not e / 1 as Math.divide(e, 1) is not e outside -16384..16383
+                term = IntegerConstant(y)
+            elif op == "*" and len(folded_terms) == 1 and self.constant(folded_terms[0]) is not None:
+                # c * e is e * c, which the CodeGenerator strength reduces
+                folded_terms[0], term = term, IntegerConstant(self.constant(folded_terms[0]))
+            folded_ops.append(op)
+            folded_terms.append(term)
+        expression.terms, expression.ops = folded_terms, folded_ops
+        return expression
+
+    def foldTerm(self, term):
+        """ The term with its subexpressions folded, an IntegerConstant when it is constant """
+        kind = type(term)
+        if kind is Expression:
+            expression = self.foldExpression(term)
+            return expression.terms[0] if len(expression.terms) == 1 else expression # drops the brackets
+        if kind is UnaryOp:
+            term.term = self.foldTerm(term.term)
+            value = self.constant(term.term)
+            if value is not None:
+                return IntegerConstant(word(-value if term.op == "-" else ~value))
+        elif kind is ArrayEntry:
+            term.index = self.foldExpression(term.index)
+        elif kind is SubroutineCall:
+            term.arguments = [self.foldExpression(argument) for argument in term.arguments]
+        return term
+
+
+class CodeGenerator:
+    """ VM code of a ClassDec, a separate pass over the tree the Parser built """
+    class_name = ""
+    class_table = None
+    subroutine_table = None
+    subroutine_name = "" # Xxx.name of the subroutine being compiled, for errors
+    if_index = 0 # for unique branching labels
+    while_index = 0 # for unique branching labels
+    optimize = True # multiplications by constants as adds, ExpressionFolder runs before when on
+    intrinsics = False # 8/vm.py -i shifts and adds push constant c / call Math.multiply 2 itself, so that stays
+    vm_writer = None
+
+    def __init__(self, output_stream, optimize=True, intrinsics=False):
+        self.vm_writer = VMWriter(output_stream)
+        self.optimize = optimize
+        self.intrinsics = intrinsics
+        self.statement_compilers = {LetStatement: self.compileLet, IfStatement: self.compileIf,
+                                    WhileStatement: self.compileWhile, DoStatement: self.compileDo,
+                                    ReturnStatement: self.compileReturn}
+        self.term_compilers = {IntegerConstant: self.compileInteger, StringConstant: self.compileString,
+                               KeywordConstant: self.compileKeyword, VarName: self.compileVarName,
+                               ArrayEntry: self.compileArrayEntry, SubroutineCall: self.compileCall,
+                               Expression: self.compileExpression, UnaryOp: self.compileUnaryOp}
+
+    def compileClass(self, class_dec: ClassDec) -> str:
+        """ Returns the VM code, VMWriter.close writes it """
+        self.class_name = class_dec.name
+        self.class_table = symbolTable()
+        self.subroutine_table = symbolTable()
+        for variable in class_dec.variables:
+            for name in variable.names:
+                self.class_table.Define(name, variable.type, variable.kind)
+        for subroutine in class_dec.subroutines:
+            self.compileSubroutine(subroutine)
+        return self.vm_writer.text()
+
+    def compileSubroutine(self, subroutine: SubroutineDec):
+        table = self.subroutine_table
+        table.startSubroutine()
+        self.subroutine_name = self.class_name + "." + subroutine.name
+        if subroutine.kind == "method":
+            table.Define("this", self.class_name, "argument")
+        for id_type, name in subroutine.parameters:
+            table.Define(name, id_type, "argument")
+        for variable in subroutine.locals:
+            for name in variable.names:
+                table.Define(name, variable.type, "var")
+
+        self.vm_writer.writeFunction(self.subroutine_name, table.varCount("var"))
+        if subroutine.kind == "constructor":
+            self.vm_writer.writePush("constant", self.class_table.varCount("field")) # allocating memory for 'this'
+            self.vm_writer.writeCall("Memory.alloc", 1)
+            self.vm_writer.writePop("pointer", 0)
+        elif subroutine.kind == "method":
+            self.vm_writer.writePush("argument", 0)
+            self.vm_writer.writePop("pointer", 0)
+        self.compileStatements(subroutine.statements)
+
+    def lookUp(self, name: str) -> tuple:
+        """ (segment, index) of a variable, subroutine scope first """
+        table = self.subroutine_table
+        kind = table.kindOf(name)
+        if kind is None:
+            table = self.class_table
+            kind = table.kindOf(name)
+            if kind is None:
+                raise ValueError(f"{self.subroutine_name}: undefined variable '{name}'")
+        return SEGMENTS[kind], table.indexOf(name)
+
+    def compileStatements(self, statements: list):
+        compilers = self.statement_compilers
+        for statement in statements:
+            compilers[type(statement)](statement)
+
+    def compileLet(self, statement: LetStatement):
+        segment, index = self.lookUp(statement.name)
+        if statement.index is None:
+            self.compileExpression(statement.value)
+            self.vm_writer.writePop(segment, index)
+        else:
+            self.compileExpression(statement.index)
+            self.vm_writer.writePush(segment, index)
+            self.vm_writer.writeArithmetic("add") # gets address of array[index]
+            self.compileExpression(statement.value)
             self.vm_writer.writePop("temp", 0)
             self.vm_writer.writePop("pointer", 1)
             self.vm_writer.writePush("temp", 0)
             self.vm_writer.writePop("that", 0)
+
+    def compileIf(self, statement: IfStatement):
+        index = str(self.if_index)
+        self.if_index += 1
+        self.compileExpression(statement.condition)
+        self.vm_writer.writeIf("IF_TRUE$" + index)
+        self.vm_writer.writeGoto("IF_FALSE$" + index)
+        self.vm_writer.writeLabel("IF_TRUE$" + index)
+        self.compileStatements(statement.statements)
+        if statement.else_statements is None:
+            self.vm_writer.writeLabel("IF_FALSE$" + index)
         else:
-            self.filtered_line = self.helperFilter()
-            self.commands  += "<symbol>=</symbol>\n"
-            # self.line_num += 1 # for expression
-            self.line_num += 1
-            self.filtered_line = self.helperFilter()
-            self.compileExpression()
-
-            var_kind = self.subroutine_table.kindOf(identifier_name)
-            if var_kind == None:
-                var_kind = self.class_table.kindOf(identifier_name)
-                var_kind = "this" if var_kind == "field" else None
-            var_index = self.subroutine_table.indexOf(identifier_name)
-            self.vm_writer.writePop(var_kind, var_index)
-
-            self.commands += "<symbol>;</symbol>\n"
-            self.commands += "</letStatement>\n"
-            self.line_num += 1 # for recursion
-            self.filtered_line = self.helperFilter()
-
-
-    def compileVarDec(self):
-        self.commands += "<varDec>\n"
-        self.filtered_line = self.helperFilter()
-        self.commands += f"<keyword>{self.filtered_line}</keyword>\n"
-
-        self.line_num += 1 # for type
-        self.filtered_line = self.helperFilter()
-        self.filtered_token = self.helperToken()
-        if self.filtered_token == "keyword":
-            self.commands += f"<keyword>{self.filtered_line}</keyword>\n"
+            self.vm_writer.writeGoto("IF_END$" + index)
+            self.vm_writer.writeLabel("IF_FALSE$" + index)
+            self.compileStatements(statement.else_statements)
+            self.vm_writer.writeLabel("IF_END$" + index)
+
+    def compileWhile(self, statement: WhileStatement):
+        index = str(self.while_index)
+        self.while_index += 1
+        self.vm_writer.writeLabel("WHILE_LOOP$" + index)
+        self.compileExpression(statement.condition)
+        self.vm_writer.writeArithmetic("not")
+        self.vm_writer.writeIf("WHILE_END$" + index)
+        self.compileStatements(statement.statements)
+        self.vm_writer.writeGoto("WHILE_LOOP$" + index)
+        self.vm_writer.writeLabel("WHILE_END$" + index)
+
+    def compileDo(self, statement: DoStatement):
+        self.compileCall(statement.call)
+        self.vm_writer.writePop("temp", 0) # discards the returned value
+
+    def compileReturn(self, statement: ReturnStatement):
+        if statement.value is None:
+            self.vm_writer.writePush("constant", 0) # void subroutines still return a value
         else:
-            self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-        self.id_type = self.filtered_line
-
-        self.line_num += 1 # for varName
-        self.filtered_line = self.helperFilter()
-        self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-        self.var_name = self.filtered_line
-
-        self.subroutine_table.Define(self.var_name, self.id_type, "var")
-        num_local = 1
-
-        self.line_num += 1 # either , for loop or ; for recursion or exit
-        self.filtered_line = self.helperFilter()
-        while self.filtered_line == ",":
-            self.commands += f"<symbol>{self.filtered_line}</symbol>\n"
-            self.line_num += 1 # for next varName
-            self.filtered_line = self.helperFilter()
-            self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-            self.line_num += 1 # sets up next iter of loop
-            self.filtered_line = self.helperFilter()
-            num_local += 1
-        self.commands += "<symbol>;</symbol>"
-        self.commands += "\n</varDec>\n"
-
-        self.line_num += 1
-        self.filtered_line = self.helperFilter()
-        if self.filtered_line == "var":
-            self.compileVarDec()
-        return num_local
-
-
-
-
-
-    # TODO: Everytime I use 'this' maybe I should just use the typeOf as 'this' rather than pop pointer 0
-    def compileParameterList(self):
-        self.filtered_line = self.helperFilter()
-        self.filtered_token = self.helperToken()
-        if self.filtered_token == "keyword":
-            # int, char, boolean
-            self.commands += f"<keyword>{self.filtered_line}</keyword>\n"
+            self.compileExpression(statement.value)
+        self.vm_writer.writeReturn()
+
+    def compileExpression(self, expression: Expression):
+        compilers = self.term_compilers
+        terms = expression.terms
+        term = terms[0]
+        compilers[type(term)](term)
+        for i, op in enumerate(expression.ops, 1):
+            term = terms[i]
+            if op == "*" and self.optimize and type(term) is IntegerConstant and self.compileMultiplyBy(term.value):
+                continue
+            compilers[type(term)](term)
+            if op == "*":
+                self.vm_writer.writeCall("Math.multiply", 2)
+            elif op == "/":
+                self.vm_writer.writeCall("Math.divide", 2)
+            else:
+                self.vm_writer.writeArithmetic(OP_COMMANDS[op])
+
+    def compileMultiplyBy(self, factor: int) -> bool:
+        """ Multiplies the top of the stack by a constant with add, False when Math.multiply is cheaper """
+        factor = word(factor)
+        if factor == -1:
+            self.vm_writer.writeArithmetic("neg")
+            return True
+        if self.intrinsics:
+            if factor >= 0 or factor == -32768:
+                return False
+            self.vm_writer.writePush("constant", -factor) # in the form the translator reduces
+            self.vm_writer.writeCall("Math.multiply", 2)
+            self.vm_writer.writeArithmetic("neg")
+            return True
+        if factor == 0:
+            self.vm_writer.writePush("constant", 0)
+            self.vm_writer.writeArithmetic("and") # keeps the side effects of the left operand
+            return True
+        bits = factor & 0xFFFF
+        if bits & (bits - 1) == 0 and bits < SMALL_MULTIPLIER: # x * 2^k is k doublings
+            for _ in range(bits.bit_length() - 1):
+                self.writeDouble()
+            return True
+        if abs(factor) >= SMALL_MULTIPLIER:
+            return False
+        # Horner over the bits of abs(factor), x is kept in temp 1
+        self.vm_writer.writePop("temp", 1)
+        self.vm_writer.writePush("temp", 1)
+        for bit in bin(abs(factor))[3:]:
+            self.writeDouble()
+            if bit == "1":
+                self.vm_writer.writePush("temp", 1)
+                self.vm_writer.writeArithmetic("add")
+        if factor < 0:
+            self.vm_writer.writeArithmetic("neg")
+        return True
+
+    def writeDouble(self):
+        """ Doubles the top of the stack, the VM has no dup so it goes through temp 2 """
+        self.vm_writer.writePop("temp", 2)
+        self.vm_writer.writePush("temp", 2)
+        self.vm_writer.writePush("temp", 2)
+        self.vm_writer.writeArithmetic("add")
+
+    def compileInteger(self, term: IntegerConstant):
+        if term.value < 0: # folded constants, push constant only takes 0..32767
+            self.vm_writer.writePush("constant", ~term.value)
+            self.vm_writer.writeArithmetic("not")
+        else:
+            self.vm_writer.writePush("constant", term.value)
+
+    def compileString(self, term: StringConstant):
+        self.vm_writer.writePush("constant", len(term.value))
+        self.vm_writer.writeCall("String.new", 1) # creates a new EMPTY string
+        for char in term.value:
+            self.vm_writer.writePush("constant", ord(char))
+            self.vm_writer.writeCall("String.appendChar", 2) # adds to string before
+
+    def compileKeyword(self, term: KeywordConstant):
+        if term.value == "true":
+            self.vm_writer.writePush("constant", 1)
+            self.vm_writer.writeArithmetic("neg")
+        elif term.value == "this":
+            self.vm_writer.writePush("pointer", 0)
         else:
-            # className
-            self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-        self.id_type = self.filtered_line
-
-        self.line_num += 1 # for varName
-        self.filtered_line = self.helperFilter()
-        self.commands += f"<identifier>{self.filtered_line}</identifier>\n"
-        self.var_name = self.filtered_line
-
-        if self.subroutine_keyword == "method" and self.added_this == False:
-            # add 'this'
-            self.subroutine_table.Define("this", self.class_name, "argument") 
-            self.added_this = True
-        self.subroutine_table.Define(self.var_name, self.id_type, "argument")
-            
-
-        self.line_num += 1 # for , or )
-        self.filtered_line = self.helperFilter()
-        if self.filtered_line == ",":
-            self.commands += f"<symbol>{self.filtered_line}</symbol>\n"
-            self.line_num += 1 # for type to set up recursion
-            self.filtered_line = self.helperFilter()
-            self.compileParameterList()
-        # elif self.filtered_line == ")":
-        #     self.line_num += 1
-        #     self.filtered_line = self.helperFilter()
-
-
-
-    def helperFilter(self):
-        """ Returns the contents """
-        print(self.line_num)
-        print(len(self.token_lines))
-        quote_index = self.token_lines[self.line_num].find(">")
-        self.filtered_line = self.token_lines[self.line_num][quote_index+1:]
-        quote_index = self.filtered_line.find("<")
-        return self.filtered_line[:quote_index]
-
-    def helperToken(self):
-        """ Returns the terminal type """
-        quote_index = self.token_lines[self.line_num].find(">")
-        return self.token_lines[self.line_num][1:quote_index]
-
-def JackAnalyzer(file):
+            self.vm_writer.writePush("constant", 0)
+
+    def compileVarName(self, term: VarName):
+        self.vm_writer.writePush(*self.lookUp(term.name))
+
+    def compileArrayEntry(self, term: ArrayEntry):
+        self.compileExpression(term.index)
+        self.vm_writer.writePush(*self.lookUp(term.name))
+        self.vm_writer.writeArithmetic("add")
+        self.vm_writer.writePop("pointer", 1)
+        self.vm_writer.writePush("that", 0)
+
+    def compileCall(self, call: SubroutineCall):
+        num_args = len(call.arguments)
+        if call.target is None: # method of this object
+            self.vm_writer.writePush("pointer", 0)
+            func_name = self.class_name + "." + call.name
+            num_args += 1
+        else:
+            kind = self.subroutine_table.kindOf(call.target)
+            table = self.subroutine_table if kind is not None else self.class_table
+            id_type = table.typeOf(call.target)
+            if id_type is None: # className.subroutineName
+                func_name = call.target + "." + call.name
+            else: # varName.methodName, the object is the first argument
+                self.vm_writer.writePush(*self.lookUp(call.target))
+                func_name = id_type + "." + call.name
+                num_args += 1
+        for argument in call.arguments:
+            self.compileExpression(argument)
+        self.vm_writer.writeCall(func_name, num_args)
+
+    def compileUnaryOp(self, term: UnaryOp):
+        self.term_compilers[type(term.term)](term.term)
+        self.vm_writer.writeArithmetic("neg" if term.op == "-" else "not")
+
+
+def JackAnalyzer(file, write_xml=False, vm_only=False, optimize=True, intrinsics=False):
     input_file = file
     # Square/Main.jack
     print("Processing: ", input_file)
-    # Create tokenizer file
-    JackTokenizer(input_file)
-            # Once value has been extracted from one line, return and add to "XxxT.xml"
+    # Tokens stay in memory, "XxxT.xml" is only written when asked for
+    tokens = JackTokenizer(input_file, write_xml).tokens
     dir_index = input_file.find("/")
     ext_index = input_file.find(".")
     output_file_name = input_file[dir_index+1:ext_index]
 
-    comp_engine = CompilationEngine(output_file_name +"T.xml", output_file_name)
+    try:
+        class_dec = Parser(tokens).parseClass()
+        if not vm_only:
+            with open(output_file_name + ".xml", "w") as file:
+                file.write(ParseTreeWriter().write(class_dec))
+        if optimize:
+            ExpressionFolder().foldClass(class_dec)
+        code_generator = CodeGenerator(output_file_name + ".vm", optimize, intrinsics)
+        code_generator.compileClass(class_dec)
+    except ValueError as error:
+        print(f"ERROR: {input_file}:{error}")
+        return
+    code_generator.vm_writer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,651 @@
+"""
+Benchmarks for the VM translator
+
+author: Arpon Sarker
+date: 15-12-2024
+"""
+
+import cmd
+import contextlib
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import emulator
+import interpreter
+import vm
+
+
+SIZES = [1000, 4000, 16000, 64000] # number of .vm lines
+ROM_SIZES = [250, 500, 1000, 2000] # number of .vm lines, the largest still fits in the 32K ROM
+
+
+def syntheticProgram(num_lines: int) -> str:
+    """ Builds a .vm program of roughly num_lines lines out of small functions """
+    body = [
+        "push argument 0",
+        "push constant 2",
+        "lt",
+        "if-goto BASE",
+        "push argument 0",
+        "push constant 1",
+        "sub",
+        "pop local 0",
+        "push local 0",
+        "push static 0",
+        "add",
+        "pop static 0",
+        "push local 0",
+        "call Main.f0 1",
+        "push constant 7",
+        "eq",
+        "not",
+        "return",
+        "label BASE",
+        "push argument 0",
+        "return",
+    ]
+    lines = ["function Sys.init 0", "push constant 10", "call Main.f0 1", "label HALT", "goto HALT"]
+    i = 0
+    while len(lines) < num_lines:
+        lines.append(f"function Main.f{i} 1")
+        lines += body
+        i += 1
+    return "\n".join(lines) + "\n"
+
+
+def syntheticDirectory(directory, num_files: int, num_lines: int):
+    """ Writes num_files independent classes of num_lines lines each, plus Sys.vm """
+    with open(os.path.join(directory, "Sys.vm"), "w") as file:
+        file.write("function Sys.init 0\npush constant 10\ncall Class0.f0 1\nlabel HALT\ngoto HALT\n")
+    for i in range(num_files):
+        source = syntheticProgram(num_lines).split("\n", 5)[5] # drop the Sys.init header
+        with open(os.path.join(directory, f"Class{i}.vm"), "w") as file:
+            file.write(source.replace("Main.", f"Class{i}."))
+
+
+# recursive programs for the call protocol comparison, each leaves its answer in RAM[5]
+CALL_BENCHMARKS = {
+    "sum (tail recursion)": """
+function Sys.init 0
+push constant 150
+push constant 0
+call Main.sum 2
+pop temp 0
+label HALT
+goto HALT
+function Main.sum 0
+push argument 0
+push constant 0
+eq
+if-goto DONE
+push argument 0
+push constant 1
+sub
+push argument 1
+push argument 0
+add
+call Main.sum 2
+return
+label DONE
+push argument 1
+return
+""",
+    "gcd (tail recursion, leaf mod)": """
+function Sys.init 0
+push constant 28657
+push constant 17711
+call Main.gcd 2
+pop temp 0
+label HALT
+goto HALT
+function Main.gcd 0
+push argument 1
+push constant 0
+eq
+if-goto DONE
+push argument 1
+push argument 0
+push argument 1
+call Main.mod 2
+call Main.gcd 2
+return
+label DONE
+push argument 0
+return
+function Main.mod 0
+label LOOP
+push argument 0
+push argument 1
+lt
+if-goto DONE
+push argument 0
+push argument 1
+sub
+pop argument 0
+goto LOOP
+label DONE
+push argument 0
+return
+""",
+    "fib (recursion, leaf add)": """
+function Sys.init 0
+push constant 15
+call Main.fib 1
+pop temp 0
+label HALT
+goto HALT
+function Main.fib 0
+push argument 0
+push constant 2
+lt
+if-goto BASE
+push argument 0
+push constant 2
+sub
+call Main.fib 1
+push argument 0
+push constant 1
+sub
+call Main.fib 1
+call Main.add 2
+return
+label BASE
+push argument 0
+return
+function Main.add 0
+push argument 0
+push argument 1
+add
+return
+""",
+}
+
+
+# a counting loop shaped like the output of 11/compiler.py's compileWhile and compileIf
+FUSION_BENCHMARK = """
+function Sys.init 0
+call Main.main 0
+pop temp 0
+label HALT
+goto HALT
+function Main.main 2
+push constant 0
+pop local 0
+push constant 0
+pop local 1
+label WHILE_LOOP$0
+push local 0
+push constant 500
+lt
+not
+if-goto WHILE_END$0
+push local 1
+push local 0
+add
+pop local 1
+push local 0
+push constant 3
+eq
+if-goto IF_TRUE$0
+goto IF_FALSE$0
+label IF_TRUE$0
+push local 1
+push constant 1
+sub
+pop local 1
+label IF_FALSE$0
+push local 0
+push constant 1
+add
+pop local 0
+goto WHILE_LOOP$0
+label WHILE_END$0
+push local 1
+return
+"""
+
+
+def runHack(assembly: str, max_cycles: int = 10000000) -> tuple:
+    """ Runs Hack assembly until it jumps to itself, -> (RAM, cycles) """
+    symbols = dict(vm.PREDEFINED)
+    code = []
+    for line in assembly.split("\n"):
+        line = line.split("//")[0].strip()
+        if line.startswith("("):
+            symbols[line[1:-1]] = len(code)
+        elif line:
+            code.append(line)
+    variables = 16
+    program = []
+    for line in code:
+        if line[0] == "@":
+            value = line[1:]
+            if not value.isdigit() and value not in symbols:
+                symbols[value] = variables
+                variables += 1
+            program.append((int(value) if value.isdigit() else symbols[value], None, None, None))
+        else:
+            dest, comp, jump = vm.splitInstruction(line)
+            program.append((None, vm.COMP[comp], dest, jump))
+    jumps = {"": lambda v: False, "JGT": lambda v: 0 < v < 0x8000, "JEQ": lambda v: v == 0,
+             "JGE": lambda v: v < 0x8000, "JLT": lambda v: v >= 0x8000, "JNE": lambda v: v != 0,
+             "JLE": lambda v: v == 0 or v >= 0x8000, "JMP": lambda v: True}
+    ram = [0] * 32768
+    a = d = pc = cycles = 0
+    while cycles < max_cycles and pc < len(program):
+        value, comp, dest, jump = program[pc]
+        cycles += 1
+        if comp is None:
+            a = value
+            pc += 1
+            continue
+        address = a & 0x7FFF # addressM and the jump target are A before this instruction
+        result = comp(a, d, ram[address]) & 0xFFFF
+        if "M" in dest:
+            ram[address] = result
+        if "A" in dest:
+            a = result
+        if "D" in dest:
+            d = result
+        if jumps[jump](result):
+            if address == pc - 1:
+                break # @HALT / 0;JMP
+            pc = address
+        else:
+            pc += 1
+    return ram, cycles
+
+
+def bootProgram() -> str:
+    """
+    Math.init and Output.initMap with the tables of 12/Math.jack and 12/Output.jack, translated the way the
+    reference Jack compiler does, over a bump allocator so the boot can run on its own
+    """
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "12")
+    with open(os.path.join(root, "Math.jack")) as file:
+        powers = re.findall(r"let powersOfTwo\[(\d+)\]\s*=\s*([^;]*);", file.read())
+    with open(os.path.join(root, "Output.jack")) as file:
+        rows = re.findall(r"do Output\.create\(([\d,\s]+)\);", file.read())
+    lines = ["function Sys.init 0", "call Math.init 0", "pop temp 0", "call Output.initMap 0", "pop temp 0",
+             "label HALT", "goto HALT",
+             "function Array.new 0", "push constant 2048", "push static 0", "add",
+             "push static 0", "push argument 0", "add", "pop static 0", "return",
+             "function Math.init 0", "push constant 16", "pop static 0",
+             "push constant 16", "call Array.new 1", "pop static 1"]
+    for index, expression in powers:
+        terms = re.findall(r"[+-]?\s*\d+", expression)
+        lines += ["push static 1", "push constant " + index, "add", "push constant " + terms[0].strip()]
+        for term in terms[1:]:
+            term = term.replace(" ", "")
+            lines += ["push constant " + term[1:], "add" if term[0] == "+" else "sub"]
+        lines += ["pop temp 0", "pop pointer 1", "push temp 0", "pop that 0"]
+    lines += ["push constant 0", "return",
+              "function Output.initMap 0", "push constant 127", "call Array.new 1", "pop static 0"]
+    for row in rows:
+        values = row.replace(" ", "").split(",")
+        lines += ["push constant " + value for value in values] + ["call Output.create " + str(len(values)), "pop temp 0"]
+    lines += ["push constant 0", "return",
+              "function Output.create 1", "push constant 11", "call Array.new 1", "pop local 0",
+              "push static 0", "push argument 0", "add", "push local 0",
+              "pop temp 0", "pop pointer 1", "push temp 0", "pop that 0"]
+    for k in range(11):
+        lines += ["push local 0", "push constant " + str(k), "add", "push argument " + str(k + 1),
+                  "pop temp 0", "pop pointer 1", "push temp 0", "pop that 0"]
+    lines += ["push constant 0", "return"]
+    return "\n".join(lines) + "\n"
+
+
+def pushPopCycles(input_files, mode: str, specialize: bool) -> int:
+    """ Cycles to run every push and pop of the files once, each template is straight-line code """
+    cycles = 0
+    for input_file in input_files:
+        table = vm.parseFile(input_file)
+        counter = vm.RomCounter()
+        coder = vm.makeCodeWriter("test.asm", counter, mode=mode, specialize=specialize)
+        coder.setCurrentFile(vm.unitName(input_file))
+        for i in range(len(table)):
+            if table.opcodes[i] in (vm.OP_PUSH, vm.OP_POP):
+                command = "push" if table.opcodes[i] == vm.OP_PUSH else "pop"
+                coder.WritePushPop(command, vm.SEGMENTS[table.arg1[i]], table.arg2[i])
+        cycles += counter.words
+    return cycles
+
+
+def buildCppAssembler(work):
+    """ Compiles 6/assembler.cpp into work, None without g++. The tool reads pong/Pong.asm with CRLF line endings """
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "6", "assembler.cpp")
+    with open(source) as file:
+        code = "#include <bitset>\n" + file.read() # it uses std::bitset without including it
+    with open(os.path.join(work, "assembler.cpp"), "w") as file:
+        file.write(code)
+    executable = os.path.join(work, "assembler")
+    try:
+        subprocess.run(["g++", "-O2", "-fpermissive", "-w", "-o", executable, "assembler.cpp"], cwd=work,
+                       capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    os.makedirs(os.path.join(work, "pong"), exist_ok=True)
+    return executable
+
+
+def runChild(args):
+    """ Runs one measurement in a fresh interpreter so peak RSS belongs to it alone """
+    result = subprocess.run([sys.executable, os.path.abspath(__file__)] + args,
+                            capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+class BENCH_CLI(cmd.Cmd):
+    prompt = "bench> "
+    intro = "Benchmarks for the VM translator"
+
+    def do_streaming(self, line):
+        """Translation time and peak RSS against input size, in memory vs streaming"""
+        print(f"{'lines':>8} {'mode':>8} {'seconds':>9} {'peak RSS (KiB)':>15}")
+        with tempfile.TemporaryDirectory() as work:
+            for size in SIZES:
+                source = os.path.join(work, f"prog{size}.vm")
+                with open(source, "w") as file:
+                    file.write(syntheticProgram(size))
+                for mode in ("memory", "stream"):
+                    seconds, rss = runChild(["_translate", mode, source, work])
+                    print(f"{size:>8} {mode:>8} {float(seconds):>9.3f} {int(rss):>15}")
+
+    def do_parallel(self, line):
+        """Directory translation time against the number of worker processes"""
+        num_files = 16
+        with tempfile.TemporaryDirectory() as work:
+            syntheticDirectory(work, num_files, 4000)
+            input_files = vm.vmFiles(work)
+            print(f"{num_files} files, {os.cpu_count()} cores")
+            print(f"{'jobs':>5} {'seconds':>9}")
+            for jobs in sorted({1, 2, 4, os.cpu_count()}):
+                start = time.perf_counter()
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    vm.translateFiles(input_files, jobs=jobs)
+                print(f"{jobs:>5} {time.perf_counter() - start:>9.3f}")
+            os.remove("test.asm")
+
+    def do_frontend(self, line):
+        """Lines per second of parsing into an InstructionTable and of the whole translation"""
+        print(f"{'lines':>8} {'parse lines/s':>14} {'translate lines/s':>18}")
+        for size in SIZES:
+            source = syntheticProgram(size)
+            start = time.perf_counter()
+            table = vm.InstructionTable(source)
+            parse = time.perf_counter() - start
+            with open(os.devnull, "w") as devnull:
+                coder = vm.makeCodeWriter("test.asm", devnull)
+                start = time.perf_counter()
+                vm.writeInstructions(coder, vm.InstructionTable(source))
+                coder.finish()
+                translate = time.perf_counter() - start
+            print(f"{len(table):>8} {len(table) / parse:>14.0f} {len(table) / translate:>18.0f}")
+
+    def do_calls(self, line):
+        """Cycles of recursive programs with the standard call protocol and with -t"""
+        print(f"{'program':<32} {'cycles':>9} {'with -t':>9} {'saved':>7}")
+        with tempfile.TemporaryDirectory() as work:
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                for name, source in CALL_BENCHMARKS.items():
+                    with open("Main.vm", "w") as file:
+                        file.write(source)
+                    cycles = []
+                    for fast_calls in (False, True):
+                        vm.translateFiles(["Main.vm"], fast_calls=fast_calls)
+                        with open("test.asm") as file:
+                            ram, count = runHack(file.read())
+                        cycles.append(count)
+                    print(f"{name:<32} {cycles[0]:>9} {cycles[1]:>9} {100 * (cycles[0] - cycles[1]) / cycles[0]:>6.1f}%")
+            finally:
+                os.chdir(cwd)
+
+    def do_fusion(self, line):
+        """ROM words, cycles and hits with each superinstruction on its own and with all of them"""
+        configurations = [("none", ())] + [(pattern, (pattern,)) for pattern in vm.SUPERINSTRUCTIONS] + \
+            [("all", vm.SUPERINSTRUCTIONS)]
+        print(f"{'superinstructions':<18} {'ROM words':>9} {'cycles':>9} {'hits':>5}")
+        with tempfile.TemporaryDirectory() as work:
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                with open("Main.vm", "w") as file:
+                    file.write(FUSION_BENCHMARK)
+                for name, fuse in configurations:
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                        stats = vm.translateFiles(["Main.vm"], fuse=fuse)
+                    with open("test.asm") as file:
+                        assembly = file.read()
+                    ram, cycles = runHack(assembly)
+                    hits = sum(stats["fused " + pattern] for pattern in fuse)
+                    words = vm.romUsage(["Main.vm"], fuse=fuse)
+                    print(f"{name:<18} {words:>9} {cycles:>9} {hits:>5}")
+            finally:
+                os.chdir(cwd)
+
+    def do_addressing(self, line):
+        """ROM words and push/pop cycles without and with addressing-mode specialization, e.g. addressing ../12"""
+        directory = line.strip() or "."
+        input_files = vm.vmFiles(directory)
+        if not input_files:
+            print("no .vm files in", directory, "- compile the .jack files with 11/compiler.py first")
+            return
+        print(f"{len(input_files)} files in {directory}, push/pop cycles count every push and pop once")
+        print(f"{'mode':<9} {'ROM before':>10} {'ROM after':>10} {'cycles before':>14} {'cycles after':>13}")
+        for mode in ("standard", "size"):
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                words = [vm.romUsage(input_files, mode=mode, specialize=specialize) for specialize in (False, True)]
+                cycles = [pushPopCycles(input_files, mode, specialize) for specialize in (False, True)]
+            print(f"{mode:<9} {words[0]:>10} {words[1]:>10} {cycles[0]:>14} {cycles[1]:>13}")
+
+    def do_prologue(self, line):
+        """Cycles and ROM words per call of the function prologue against the number of locals"""
+        print(f"{'locals':>6} {'loop cycles':>12} {'loop words':>11} {'cycles':>7} {'words':>6}")
+        for num_locals in range(13):
+            row = []
+            for unroll_locals in (0, vm.CodeWriter.unroll_locals):
+                coder = vm.CodeWriter("test.asm", vm.RomCounter())
+                coder.unroll_locals = unroll_locals
+                assembly = coder.prologue("Main.f", num_locals)
+                ram, cycles = runHack(assembly + "(HALT)\n@HALT\n0;JMP\n")
+                row += [cycles - 2, assembly.count("\n") - assembly.count("(")] # minus the halt loop
+            print(f"{num_locals:>6} {row[0]:>12} {row[1]:>11} {row[2]:>7} {row[3]:>6}")
+
+    def do_assemble(self, line):
+        """Seconds from .vm to .hack in process against test.asm plus a separate assembler"""
+        print(f"{'lines':>8} {'ROM words':>9} {'in process':>11} {'asm+Python':>11} {'asm+C++':>9} {'same':>5}")
+        with tempfile.TemporaryDirectory() as work:
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                assembler = buildCppAssembler(work)
+                for size in ROM_SIZES:
+                    with open("Main.vm", "w") as file:
+                        file.write(syntheticProgram(size))
+                    start = time.perf_counter()
+                    vm.translateFiles(["Main.vm"], assemble="hack")
+                    direct = time.perf_counter() - start
+                    with open("test.hack") as file:
+                        expected = file.read()
+                    start = time.perf_counter()
+                    vm.translateFiles(["Main.vm"])
+                    with open("test.asm") as file:
+                        words = vm.assembleText(file.read())
+                    with open("test.hack", "w") as file:
+                        file.write(vm.hackText(words))
+                    two_step = time.perf_counter() - start
+                    same = expected == vm.hackText(words)
+                    cpp = "-"
+                    if assembler is not None:
+                        # the conversion to CRLF is not timed
+                        with open("test.asm") as source, open(os.path.join("pong", "Pong.asm"), "w", newline="\r\n") as target:
+                            target.write(source.read())
+                        start = time.perf_counter()
+                        vm.translateFiles(["Main.vm"])
+                        translate = time.perf_counter() - start
+                        start = time.perf_counter()
+                        subprocess.run([assembler], stdout=subprocess.DEVNULL, check=True)
+                        cpp = f"{translate + time.perf_counter() - start:.3f}"
+                        with open("Pong.hack") as file:
+                            same = same and file.read() == expected
+                    print(f"{size:>8} {len(words):>9} {direct:>11.3f} {two_step:>11.3f} {cpp:>9} {'yes' if same else 'NO':>5}")
+            finally:
+                os.chdir(cwd)
+
+    def do_oslib(self, line):
+        """Seconds and ROM words of an app build from .jack, with the whole OS and with the precompiled library"""
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+        app = os.path.abspath(line.strip() or os.path.join(root, "9", "HelloWorld"))
+        with tempfile.TemporaryDirectory() as work:
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                os_directory = os.path.join(work, "os")
+                os.mkdir(os_directory)
+                jack_os = [os.path.join(root, "12", name) for name in sorted(os.listdir(os.path.join(root, "12")))
+                           if name.endswith(".jack")]
+                jack_app = [os.path.join(app, name) for name in sorted(os.listdir(app)) if name.endswith(".jack")]
+                for jack_file in jack_os:
+                    with open(jack_file, "rb") as source, open(os.path.join(os_directory, os.path.basename(jack_file)), "wb") as target:
+                        target.write(source.read())
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    start = time.perf_counter()
+                    vm_files = vm.compileJack(jack_os + jack_app, os.path.join(work, "whole"))
+                    vm.translateFiles(vm_files, assemble="hack")
+                    whole = time.perf_counter() - start
+                    whole_words = os.path.getsize("test.hack") // 17
+                    start = time.perf_counter()
+                    library = vm.osLibrary(os_directory)
+                    build_library = time.perf_counter() - start
+                    start = time.perf_counter()
+                    vm_files = vm.compileJack(jack_app, os.path.join(work, "app"))
+                    vm.translateFiles(vm_files, library=os_directory)
+                    linked = time.perf_counter() - start
+                    linked_words = os.path.getsize("test.hack") // 17
+                library_words = sum(len(module.words) for module in library.modules)
+                print(f"app {os.path.basename(app)}: {linked_words - library_words} words of its own, " + \
+                      f"library {library_words} words")
+                print(f"{'build':<32} {'seconds':>8} {'ROM words':>10}")
+                print(f"{'compile and translate everything':<32} {whole:>8.3f} {whole_words:>10}")
+                print(f"{'build the OS library (once)':<32} {build_library:>8.3f} {library_words:>10}")
+                print(f"{'compile app, link the library':<32} {linked:>8.3f} {linked_words:>10}")
+            finally:
+                os.chdir(cwd)
+
+    def do_bulk(self, line):
+        """Boot cycles and ROM words of the 12/ lookup tables without and with -b, the heap must come out the same"""
+        print(f"{'mode':<9} {'ROM before':>10} {'ROM after':>10} {'cycles before':>14} {'cycles after':>13} {'same RAM':>9}")
+        with tempfile.TemporaryDirectory() as work:
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                with open("Boot.vm", "w") as file:
+                    file.write(bootProgram())
+                for mode in vm.WRITERS:
+                    words, cycles, memory = [], [], []
+                    for bulk in (False, True):
+                        vm.translateFiles(["Boot.vm"], mode=mode, bulk=bulk)
+                        with open("test.asm") as file:
+                            assembly = file.read()
+                        ram, count = runHack(assembly)
+                        words.append(vm.romUsage(["Boot.vm"], mode=mode, bulk=bulk))
+                        cycles.append(count)
+                        # everything but R13-R15 and the dead stack above SP
+                        memory.append(ram[:13] + ram[16:ram[0]] + ram[2048:])
+                    same = "yes" if memory[0] == memory[1] else "NO"
+                    print(f"{mode:<9} {words[0]:>10} {words[1]:>10} {cycles[0]:>14} {cycles[1]:>13} {same:>9}")
+            finally:
+                os.chdir(cwd)
+
+    def do_emulator(self, line):
+        """M instructions/s of the emulators against runHack on an app (default 9/HelloWorld) with the 12/ OS"""
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+        words = line.split()
+        app = os.path.abspath(words[0] if words else os.path.join(root, "9", "HelloWorld"))
+        max_cycles = int(words[1]) if len(words) > 1 else 2000000
+        with tempfile.TemporaryDirectory() as work:
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                jack_files = [os.path.join(root, "12", name) for name in sorted(os.listdir(os.path.join(root, "12")))
+                              if name.endswith(".jack")]
+                jack_files += [os.path.join(app, name) for name in sorted(os.listdir(app)) if name.endswith(".jack")]
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    vm_files = vm.compileJack(jack_files, os.path.join(work, "vm"))
+                    vm.translateFiles(vm_files)
+                with open("test.asm") as file:
+                    assembly = file.read()
+                program, leaders = emulator.assemblyLeaders(assembly)
+                print(f"app {os.path.basename(app)}: {len(program)} ROM words, up to {max_cycles} cycles")
+                print(f"{'runner':<26} {'cycles':>9} {'seconds':>8} {'M instr/s':>10} {'RAM':>5}")
+                start = time.perf_counter()
+                reference, cycles = runHack(assembly, max_cycles)
+                seconds = time.perf_counter() - start
+                print(f"{'runHack (asm text)':<26} {cycles:>9} {seconds:>8.3f} {cycles / seconds / 1e6:>10.2f}")
+                for name, machine in (("HackEmulator (predecoded)", emulator.HackEmulator(program)),
+                                      ("BlockEmulator (compiled)", emulator.BlockEmulator(program, leaders))):
+                    start = time.perf_counter()
+                    cycles = machine.run(max_cycles)
+                    seconds = time.perf_counter() - start
+                    same = "same" if list(machine.ram) == list(reference) else "DIFF"
+                    print(f"{name:<26} {cycles:>9} {seconds:>8.3f} {cycles / seconds / 1e6:>10.2f} {same:>5}")
+            finally:
+                os.chdir(cwd)
+
+    def do_interpreter(self, line):
+        """Seconds to run the call benchmarks and the 12/ boot tables at CPU level and directly as VM commands"""
+        programs = dict(CALL_BENCHMARKS, **{"counting loop": FUSION_BENCHMARK, "12/ boot tables": bootProgram()})
+        print(f"{'program':<32} {'cycles':>9} {'commands':>9} {'emulator':>9} {'blocks':>8} {'VM':>8} {'same':>5}")
+        with tempfile.TemporaryDirectory() as work:
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                for name, source in programs.items():
+                    with open("Sys.vm", "w") as file:
+                        file.write(source)
+                    vm.translateFiles(["Sys.vm"])
+                    with open("test.asm") as file:
+                        program, leaders = emulator.assemblyLeaders(file.read())
+                    machines = [emulator.HackEmulator(program), emulator.BlockEmulator(program, leaders),
+                                interpreter.VMInterpreter(["Sys.vm"])]
+                    counts, seconds = [], []
+                    for machine in machines:
+                        start = time.perf_counter()
+                        counts.append(machine.run(100000000))
+                        seconds.append(time.perf_counter() - start)
+                    # registers, statics and heap; the stack holds return addresses, ROM addresses at CPU level
+                    memory = [list(machine.ram[:13]) + list(machine.ram[16:256]) + list(machine.ram[2048:])
+                              for machine in machines]
+                    same = "yes" if memory[0] == memory[1] == memory[2] else "NO"
+                    print(f"{name:<32} {counts[0]:>9} {counts[2]:>9} {seconds[0]:>9.3f} {seconds[1]:>8.3f} " + \
+                          f"{seconds[2]:>8.3f} {same:>5}")
+            finally:
+                os.chdir(cwd)
+
+    def do__translate(self, line):
+        """(internal) translates one file and prints seconds and peak RSS"""
+        mode, source, work = line.split()
+        os.chdir(work)
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            vm.main(source, stream=(mode == "stream"))
+        seconds = time.perf_counter() - start
+        print(seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    def do_quit(self, line):
+        """Exit the CLI."""
+        return True
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        BENCH_CLI().onecmd(" ".join(sys.argv[1:]))
+    else:
+        BENCH_CLI().cmdloop()
@@ -0,0 +1,489 @@
+"""
+Hack CPU Emulator of The Elements of Computing System
+
+author: Arpon Sarker
+date: 15-12-2024
+"""
+
+import cmd
+import os
+import sys
+import time
+from array import array
+
+import vm
+
+
+RAM_WORDS = 32768
+ADDRESS_MASK = 0x7FFF # addressM and pc are 15 bits wide
+
+# operation ids in the order run() tests them, the C-instructions translated code executes most get their
+# own and everything else is GENERIC
+OPERATIONS = ["A", "D=M", "M=D", "A=M", "M=M+1", "A=M+1", "A=A-1", "0;JMP", "A=A+1", "AM=M-1", "D=A", "A=M-1",
+              "D;JEQ", "M=D+M", "M=M-1", "D=D+M", "D=A+1", "AM=M+1", "D;JNE", "M=0", "D=D-M", "A=D-A", "D=D-A",
+              "M=-1", "D=M-D", "M=!M", "D=D&M", "D=M-1", "A=D", "M=D&M", "M=M-D", "A=D+A", "D=D+A", "D;JLT",
+              "D;JGE", "D;JGT", "D;JLE", "GENERIC"]
+OP = {name: i for i, name in enumerate(OPERATIONS)}
+(OP_A, OP_D_M, OP_M_D, OP_A_M, OP_M_INC, OP_A_MINC, OP_A_DEC, OP_JMP, OP_A_INC, OP_AM_DEC, OP_D_A, OP_A_MDEC,
+ OP_JEQ, OP_M_ADDD, OP_M_DEC, OP_D_ADDM, OP_D_AINC, OP_AM_INC, OP_JNE, OP_M_ZERO, OP_D_SUBM, OP_A_DSUBA, OP_D_SUBA,
+ OP_M_TRUE, OP_D_MSUBD, OP_M_NOT, OP_D_ANDM, OP_D_MDEC, OP_A_D, OP_M_ANDD, OP_M_SUBD, OP_A_DADDA, OP_D_ADDA, OP_JLT,
+ OP_JGE, OP_JGT, OP_JLE, OP_GENERIC) = range(len(OPERATIONS))
+
+# computation bits -> the ALU output for (a, d, m), before truncation to 16 bits
+ALU = {vm.COMP_BITS[comp]: function for comp, function in vm.COMP.items()}
+COMP_NAMES = {bits: comp for comp, bits in vm.COMP_BITS.items()}
+JUMP_NAMES = {bits: jump for jump, bits in vm.JUMP_BITS.items()}
+
+CHAIN_LIMIT = 128 # instructions after which a compiled chain ends at the next label
+HOT_ENTRIES = 16 # times an address is entered before its code is compiled
+IN_RANGE = {"0", "1", "D", "A", "M", "D&A", "D&M", "D|A", "D|M"} # computations that never leave 0..0xFFFF
+CONDITIONS = {1: "0 < {v} < 32768", 2: "{v} == 0", 3: "{v} < 32768", 4: "{v} >= 32768", 5: "{v} != 0",
+              6: "{v} == 0 or {v} >= 32768"} # jump bits -> Python test of the ALU output v
+
+
+def jumps(jump: int, value: int) -> bool:
+    """ Whether the jump bits j1 j2 j3 fire for a 16 bit ALU output """
+    negative = value >= 0x8000
+    return bool((jump & 4 and negative) or (jump & 2 and value == 0) or (jump & 1 and not negative and value != 0))
+
+
+class HackEmulator:  # the CPU of 5/CPU.hdl with 32K words of ROM and RAM
+    """
+    Every ROM word is decoded once into parallel arrays: operations holds an id from OPERATIONS, values the
+    15 bit constant of an A-instruction, and comps/dests/jumps the fields of a GENERIC C-instruction.
+    run() executes them in one loop, with A kept twice: a is the full register and address its low 15 bits.
+    """
+    a = d = pc = 0
+    cycles = 0
+    halted = False # the last run stopped at a jump to itself
+
+    def __init__(self, words):
+        self.rom = array("H", words)
+        self.ram = array("H", bytes(2 * RAM_WORDS))
+        self.operations = array("B")
+        self.values = array("H")
+        self.comps = array("B")
+        self.dests = array("B")
+        self.jumps = array("B")
+        for word in self.rom:
+            self.decode(word)
+        self.reset()
+
+    def decode(self, word: int):
+        if word < 0x8000:
+            operation = OP_A
+        else:
+            comp, dest, jump = word >> 6 & 0x7F, word >> 3 & 7, word & 7
+            operation = OP.get(self.instruction(comp, dest, jump), OP_GENERIC)
+            if comp not in ALU:
+                operation = OP_GENERIC # not a Hack computation, run() reports it
+        self.operations.append(operation)
+        self.values.append(word & ADDRESS_MASK)
+        self.comps.append(word >> 6 & 0x7F)
+        self.dests.append(word >> 3 & 7)
+        self.jumps.append(word & 7)
+
+    @staticmethod
+    def instruction(comp: int, dest: int, jump: int) -> str:
+        """ The assembly of a C-instruction, used to find its operation id """
+        if comp not in COMP_NAMES:
+            return ""
+        text = "".join(register for register, bit in (("A", 4), ("M", 1), ("D", 2)) if dest & bit)
+        text = (text + "=" if text else "") + COMP_NAMES[comp]
+        return text + (";" + JUMP_NAMES[jump] if jump else "")
+
+    def reset(self):
+        self.a = self.d = self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    def run(self, max_cycles: int = 10000000) -> int:
+        """ Executes until a jump to itself (the @END / 0;JMP halt loop) or max_cycles, returns the cycles run """
+        operations, values, comps, dests, jump_bits = self.operations, self.values, self.comps, self.dests, self.jumps
+        ram = self.ram
+        a, d, pc = self.a, self.d, self.pc
+        address = a & ADDRESS_MASK
+        size = len(operations)
+        cycles = 0
+        halted = False
+        while cycles < max_cycles and pc < size:
+            operation = operations[pc]
+            cycles += 1
+            if operation == OP_A:
+                a = address = values[pc]
+            elif operation == OP_D_M:
+                d = ram[address]
+            elif operation == OP_M_D:
+                ram[address] = d
+            elif operation == OP_A_M:
+                a = ram[address]
+                address = a & ADDRESS_MASK
+            elif operation == OP_M_INC:
+                ram[address] = (ram[address] + 1) & 0xFFFF
+            elif operation == OP_A_MINC:
+                a = (ram[address] + 1) & 0xFFFF
+                address = a & ADDRESS_MASK
+            elif operation == OP_A_DEC:
+                a = (a - 1) & 0xFFFF
+                address = a & ADDRESS_MASK
+            elif operation == OP_JMP:
+                if address == pc - 1:
+                    halted = True
+                    break # @END / 0;JMP, a taken jump to the @ right before it never ends
+                pc = address
+                continue
+            elif operation == OP_A_INC:
+                a = (a + 1) & 0xFFFF
+                address = a & ADDRESS_MASK
+            elif operation == OP_AM_DEC:
+                a = ram[address] = (ram[address] - 1) & 0xFFFF
+                address = a & ADDRESS_MASK
+            elif operation == OP_D_A:
+                d = a
+            elif operation == OP_A_MDEC:
+                a = (ram[address] - 1) & 0xFFFF
+                address = a & ADDRESS_MASK
+            elif operation == OP_JEQ:
+                if not d:
+                    if address == pc - 1:
+                        halted = True
+                        break
+                    pc = address
+                    continue
+            elif operation == OP_M_ADDD:
+                ram[address] = (ram[address] + d) & 0xFFFF
+            elif operation == OP_M_DEC:
+                ram[address] = (ram[address] - 1) & 0xFFFF
+            elif operation == OP_D_ADDM:
+                d = (d + ram[address]) & 0xFFFF
+            elif operation == OP_D_AINC:
+                d = (a + 1) & 0xFFFF
+            elif operation == OP_AM_INC:
+                a = ram[address] = (ram[address] + 1) & 0xFFFF
+                address = a & ADDRESS_MASK
+            elif operation == OP_JNE:
+                if d:
+                    if address == pc - 1:
+                        halted = True
+                        break
+                    pc = address
+                    continue
+            elif operation == OP_M_ZERO:
+                ram[address] = 0
+            elif operation == OP_D_SUBM:
+                d = (d - ram[address]) & 0xFFFF
+            elif operation == OP_A_DSUBA:
+                a = (d - a) & 0xFFFF
+                address = a & ADDRESS_MASK
+            elif operation == OP_D_SUBA:
+                d = (d - a) & 0xFFFF
+            elif operation == OP_M_TRUE:
+                ram[address] = 0xFFFF
+            elif operation == OP_D_MSUBD:
+                d = (ram[address] - d) & 0xFFFF
+            elif operation == OP_M_NOT:
+                ram[address] ^= 0xFFFF
+            elif operation == OP_D_ANDM:
+                d &= ram[address]
+            elif operation == OP_D_MDEC:
+                d = (ram[address] - 1) & 0xFFFF
+            elif operation == OP_A_D:
+                a = d
+                address = a & ADDRESS_MASK
+            elif operation == OP_M_ANDD:
+                ram[address] &= d
+            elif operation == OP_M_SUBD:
+                ram[address] = (ram[address] - d) & 0xFFFF
+            elif operation == OP_A_DADDA:
+                a = (d + a) & 0xFFFF
+                address = a & ADDRESS_MASK
+            elif operation == OP_D_ADDA:
+                d = (d + a) & 0xFFFF
+            elif operation == OP_JLT:
+                if d >= 0x8000:
+                    if address == pc - 1:
+                        halted = True
+                        break
+                    pc = address
+                    continue
+            elif operation == OP_JGE:
+                if d < 0x8000:
+                    if address == pc - 1:
+                        halted = True
+                        break
+                    pc = address
+                    continue
+            elif operation == OP_JGT:
+                if 0 < d < 0x8000:
+                    if address == pc - 1:
+                        halted = True
+                        break
+                    pc = address
+                    continue
+            elif operation == OP_JLE:
+                if d == 0 or d >= 0x8000:
+                    if address == pc - 1:
+                        halted = True
+                        break
+                    pc = address
+                    continue
+            else:
+                comp = comps[pc]
+                if comp not in ALU:
+                    self.a, self.d, self.pc = a, d, pc
+                    raise ValueError(f"invalid instruction {self.rom[pc]:016b} at ROM[{pc}]")
+                value = ALU[comp](a, d, ram[address]) & 0xFFFF
+                dest = dests[pc]
+                if dest & 1:
+                    ram[address] = value
+                if dest & 2:
+                    d = value
+                target = address # the PC loads A as it was before this instruction
+                if dest & 4:
+                    a = value
+                    address = a & ADDRESS_MASK
+                jump = jump_bits[pc]
+                if jump and jumps(jump, value):
+                    if target == pc - 1:
+                        halted = True
+                        break
+                    pc = target
+                    continue
+            pc += 1
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += cycles
+        self.halted = halted
+        return cycles
+
+
+class BlockEmulator(HackEmulator):
+    """
+    Runs the ROM as generated Python functions, compiled once their address has been entered HOT_ENTRIES times
+    and cached by it; colder code is interpreted one basic block at a time by HackEmulator.run. A function
+    executes the basic block at its address and chains on into the blocks after it while the next address is
+    known when compiling (fall through, the untaken side of a branch, @LABEL / 0;JMP), keeping A and D in locals
+    and folding known A values into RAM indexes. It returns (next pc, A, D, cycles), the pc is ~pc of a halt jump.
+    """
+
+    def __init__(self, words, leaders=()):
+        super().__init__(words)
+        self.ram = [0] * RAM_WORDS # a list indexes faster than an array and the compiled code does little else
+        self.leaders = set(leaders) # label addresses, where long chains are cut so they get reused
+        self.blocks = [None] * len(self.rom)
+        self.entries = [0] * len(self.rom)
+        self.spans = [0] * len(self.rom) # instructions up to and including the next jump
+        span = 0
+        for pc in range(len(self.rom) - 1, -1, -1):
+            span = 1 if self.rom[pc] >= 0x8000 and self.rom[pc] & 7 else span + 1
+            self.spans[pc] = span
+
+    def run(self, max_cycles: int = 10000000) -> int:
+        """ Same as HackEmulator.run, the last cycles before max_cycles are interpreted so it stops exactly there """
+        blocks, entries, spans = self.blocks, self.entries, self.spans
+        a, d, pc = self.a, self.d, self.pc
+        size = len(blocks)
+        start = self.cycles
+        cycles = 0
+        halted = False
+        limit = max_cycles - 2 * CHAIN_LIMIT # a chain runs at most 2 * CHAIN_LIMIT cycles
+        while cycles < limit and pc < size:
+            block = blocks[pc]
+            if block is None:
+                entries[pc] += 1
+                if entries[pc] < HOT_ENTRIES:
+                    self.a, self.d, self.pc = a, d, pc
+                    cycles += HackEmulator.run(self, min(spans[pc], max_cycles - cycles))
+                    a, d, pc = self.a, self.d, self.pc
+                    if self.halted:
+                        halted = True
+                        break
+                    continue
+                block = self.compile(pc)
+            pc, a, d, count = block(a, d)
+            cycles += count
+            if pc < 0:
+                pc = ~pc
+                halted = True
+                break
+        self.a, self.d, self.pc = a, d, pc
+        if not halted and cycles < max_cycles:
+            cycles += HackEmulator.run(self, max_cycles - cycles)
+            halted = self.halted
+        self.cycles = start + cycles
+        self.halted = halted
+        return cycles
+
+    def compile(self, start: int):
+        namespace = {}
+        exec(self.source(start), {"ram": self.ram}, namespace)
+        self.blocks[start] = namespace["block"]
+        return self.blocks[start]
+
+    def source(self, start: int) -> str:
+        """ The Python function for the chain of blocks at start """
+        lines = ["def block(a, d, ram=ram):"]
+        known_a = known_d = None # register values known at compile time, their locals are stale then
+        fresh = False # whether the local at holds a & 0x7FFF
+        visited = set()
+        cycles = 0
+        pc = start
+        size = len(self.operations)
+
+        def registers():
+            return ("a" if known_a is None else str(known_a)) + ", " + ("d" if known_d is None else str(known_d))
+
+        while True:
+            if pc >= size or pc in visited or \
+                    cycles >= CHAIN_LIMIT and (pc in self.leaders or cycles >= 2 * CHAIN_LIMIT):
+                lines.append(f"    return {pc}, {registers()}, {cycles}")
+                break
+            visited.add(pc)
+            cycles += 1
+            if self.operations[pc] == OP_A:
+                known_a = self.values[pc]
+                pc += 1
+                continue
+            comp, dest, jump = self.comps[pc], self.dests[pc], self.jumps[pc]
+            if comp not in ALU:
+                lines.append(f"    raise ValueError('invalid instruction {self.rom[pc]:016b} at ROM[{pc}]')")
+                break
+            name = COMP_NAMES[comp]
+            if known_a is None and not fresh and ("M" in name or dest & 1 or jump):
+                lines.append("    at = a & 32767")
+                fresh = True
+            memory = "ram[at]" if known_a is None else f"ram[{known_a & ADDRESS_MASK}]"
+            target = "at" if known_a is None else known_a & ADDRESS_MASK # the PC loads A from before this instruction
+            if "M" not in name and (known_a is not None or "A" not in name) and (known_d is not None or "D" not in name):
+                value = ALU[comp](known_a or 0, known_d or 0, 0) & 0xFFFF
+                if dest & 1:
+                    lines.append(f"    {memory} = {value}")
+                if dest & 2:
+                    known_d = value
+                if dest & 4:
+                    known_a = value
+                taken = jumps(jump, value)
+            else:
+                operands = {"A": "a" if known_a is None else str(known_a), "D": "d" if known_d is None else str(known_d),
+                            "M": memory, "!": "~"}
+                expression = "".join(operands.get(character, character) for character in name)
+                if name not in IN_RANGE:
+                    expression = f"({expression}) & 65535"
+                names = [memory] if dest & 1 else []
+                if dest & 2:
+                    names.append("d")
+                    known_d = None
+                if dest & 4:
+                    names.append("a")
+                    known_a = None
+                    fresh = False
+                if jump and jump != 7 and name not in ("A", "D", "M"):
+                    names.append("v")
+                    expression_value = "v"
+                else:
+                    expression_value = expression
+                if names:
+                    lines.append("    " + " = ".join(names) + " = " + expression)
+                taken = None if jump != 7 else True
+            if not jump or taken is False:
+                pc += 1
+                continue
+            if taken:
+                if target == "at":
+                    lines.append(f"    return ({~pc} if at == {pc - 1} else at), {registers()}, {cycles}")
+                elif target == pc - 1:
+                    lines.append(f"    return {~pc}, {registers()}, {cycles}") # @END / 0;JMP
+                else:
+                    pc = target
+                    continue
+                break
+            condition = CONDITIONS[jump].format(v=expression_value)
+            if target == "at":
+                lines.append(f"    if {condition}:\n        return ({~pc} if at == {pc - 1} else at), {registers()}, {cycles}")
+            else:
+                lines.append(f"    if {condition}:\n        return {~pc if target == pc - 1 else target}, {registers()}, {cycles}")
+            pc += 1
+        return "\n".join(lines) + "\n"
+
+
+def instructionLines(text: str) -> str:
+    """ Hand-written Hack assembly -> one instruction or label per line, without comments, whitespace or blank lines """
+    lines = ("".join(line.split("//", 1)[0].split()) for line in text.split("\n"))
+    return "".join(line + "\n" for line in lines if line)
+
+
+def assemblyLeaders(text: str) -> tuple:
+    """ Hack assembly text -> (machine words, addresses of its labels), ValueError on an invalid instruction """
+    assembler = vm.HackAssembler()
+    assembler.write(instructionLines(text))
+    leaders = {address for symbol, address in assembler.labels.items() if symbol not in vm.PREDEFINED}
+    assembler.flush()
+    return assembler.words, leaders
+
+
+def loadProgram(path) -> array:
+    """ Machine words from a .hack, .bin (packed little endian) or .asm file, or .vm files / a directory translated in process """
+    if os.path.isdir(path):
+        return vm.assembleProgram(vm.vmFiles(path))
+    if path.endswith(".hack"):
+        with open(path) as file:
+            return array("H", [int(line, 2) for line in file.read().split()])
+    if path.endswith(".bin"):
+        words = array("H")
+        with open(path, "rb") as file:
+            words.frombytes(file.read())
+        if sys.byteorder == "big":
+            words.byteswap()
+        return words
+    if path.endswith(".vm"):
+        return vm.assembleProgram([path])
+    with open(path) as file:
+        return assemblyLeaders(file.read())[0]
+
+
+def signed(value: int) -> int:
+    return value - 0x10000 if value & 0x8000 else value
+
+
+class EMULATOR_CLI(cmd.Cmd):
+    prompt = "emulator> "
+    intro = "Hack CPU emulator"
+
+    def do_run(self, line):
+        """run program [cycles] [first last]: runs a .hack/.bin/.asm/.vm file or .vm directory, prints RAM[first..last]"""
+        self.execute(HackEmulator, line)
+
+    def do_blocks(self, line):
+        """blocks program [cycles] [first last]: same as run, with the ROM compiled to Python functions"""
+        self.execute(BlockEmulator, line)
+
+    def execute(self, engine, line):
+        words = line.split()
+        if not words:
+            print("ERROR: NO PROGRAM")
+            return
+        try:
+            if words[0].endswith(".asm"):
+                with open(words[0]) as file:
+                    program, leaders = assemblyLeaders(file.read())
+            else:
+                program, leaders = loadProgram(words[0]), ()
+        except ValueError as error:
+            print(f"ERROR: {words[0]}: {error}")
+            return
+        max_cycles = int(words[1]) if len(words) > 1 else 10000000
+        first, last = (int(words[2]), int(words[3])) if len(words) > 3 else (0, 15)
+        emulator = engine(program, leaders) if engine is BlockEmulator else engine(program)
+        start = time.perf_counter()
+        cycles = emulator.run(max_cycles)
+        seconds = time.perf_counter() - start
+        print(f"{len(program)} ROM words, {cycles} cycles in {seconds:.3f} s ({cycles / seconds / 1e6:.2f} M instructions/s)")
+        for address in range(first, last + 1):
+            print(f"RAM[{address}] = {signed(emulator.ram[address])}")
+
+    def do_quit(self, line):
+        """Exit the CLI."""
+        return True
+
+
+if __name__ == "__main__":
+    EMULATOR_CLI().cmdloop()
@@ -0,0 +1,277 @@
+"""
+VM Interpreter of The Elements of Computing System
+
+author: Arpon Sarker
+date: 15-12-2024
+"""
+
+import cmd
+import os
+import time
+from array import array
+
+import vm
+
+
+RAM_WORDS = 32768
+STACK_BASE = 256
+BOOT_SP = 261 # where writeInit leaves SP when it jumps to Sys.init
+STATIC_BASE = 16
+BASE_REGISTERS = {segment: vm.PREDEFINED[base] for segment, base in vm.SEGMENT_BASES.items()} # local -> 1 (LCL) ...
+FIXED_BASES = {"pointer": 3, "temp": 5}
+
+# operation ids in the order run() tests them, push/pop of local, argument, this and that are "segment",
+# of pointer, temp and static "address"; multiply and divide are Math.multiply/Math.divide run natively
+OPERATIONS = ["push segment", "push constant", "pop segment", "add", "push address", "pop address", "if-goto",
+              "goto", "call", "function", "return", "sub", "lt", "gt", "eq", "not", "neg", "and", "or",
+              "multiply", "divide", "halt"]
+(OP_PUSH_SEGMENT, OP_PUSH_CONSTANT, OP_POP_SEGMENT, OP_ADD, OP_PUSH_ADDRESS, OP_POP_ADDRESS, OP_IF, OP_GOTO,
+ OP_CALL, OP_FUNCTION, OP_RETURN, OP_SUB, OP_LT, OP_GT, OP_EQ, OP_NOT, OP_NEG, OP_AND, OP_OR, OP_MULTIPLY,
+ OP_DIVIDE, OP_HALT) = range(len(OPERATIONS))
+ARITHMETIC = {"add": OP_ADD, "sub": OP_SUB, "neg": OP_NEG, "eq": OP_EQ, "gt": OP_GT, "lt": OP_LT,
+              "and": OP_AND, "or": OP_OR, "not": OP_NOT}
+NATIVE = {("Math.multiply", 2): OP_MULTIPLY, ("Math.divide", 2): OP_DIVIDE}
+
+
+class VMInterpreter:  # runs .vm command streams on the memory layout of the translated program
+    """
+    The commands of all files are loaded into parallel arrays: operations holds an id from OPERATIONS, args
+    the constant, base register, address, jump target or number of locals, and args2 the segment index or
+    the number of arguments. Labels are resolved to the index of the command after them and calls to the
+    index of the function command, so run() never looks anything up. SP is kept in a local while running.
+    """
+    pc = 0
+    steps = 0
+    halted = False # the last run stopped at a goto to itself
+
+    def __init__(self, input_files, intrinsics=False):
+        self.ram = [0] * RAM_WORDS
+        self.operations = array("B")
+        self.args = array("i")
+        self.args2 = array("i")
+        self.functions = {} # name -> index of its function command
+        self.statics = {} # File.i -> address, in the order the assembler allocates them
+        self.labels = {} # function$label -> index of the command after it
+        self.fixups = [] # (command index, label or function name) resolved once everything is loaded
+        self.intrinsics = intrinsics # run Math.multiply and Math.divide natively, as the translator's -i does
+        for input_file in input_files:
+            self.load(vm.unitName(input_file), vm.parseFile(input_file))
+        self.resolve()
+        self.reset()
+
+    def load(self, file_name: str, table):
+        """ Appends the commands of one InstructionTable, classified by COMMAND_TYPE """
+        function = file_name
+        for i in range(len(table)):
+            command_type, arg1, arg2 = table.command(i)
+            operation, first, second = None, 0, 0
+            if command_type == vm.COMMAND_TYPE.C_ARITHMETIC:
+                operation = ARITHMETIC[arg1]
+            elif command_type == vm.COMMAND_TYPE.C_PUSH or command_type == vm.COMMAND_TYPE.C_POP:
+                push = command_type == vm.COMMAND_TYPE.C_PUSH
+                if arg1 == "constant":
+                    if not push:
+                        print(f"ERROR: CANNOT POP CONSTANT in {function}")
+                        continue
+                    operation, first = OP_PUSH_CONSTANT, arg2 & 0xFFFF
+                elif arg1 in BASE_REGISTERS:
+                    operation, first, second = OP_PUSH_SEGMENT if push else OP_POP_SEGMENT, BASE_REGISTERS[arg1], arg2
+                else:
+                    if arg1 == "static":
+                        address = self.statics.setdefault(file_name + "." + str(arg2), STATIC_BASE + len(self.statics))
+                    else:
+                        address = FIXED_BASES[arg1] + arg2
+                    operation, first = OP_PUSH_ADDRESS if push else OP_POP_ADDRESS, address
+            elif command_type == vm.COMMAND_TYPE.C_LABEL:
+                self.labels[function + "$" + arg1] = len(self.operations)
+                continue
+            elif command_type == vm.COMMAND_TYPE.C_GOTO or command_type == vm.COMMAND_TYPE.C_IF:
+                operation = OP_GOTO if command_type == vm.COMMAND_TYPE.C_GOTO else OP_IF
+                self.fixups.append((len(self.operations), function + "$" + arg1))
+            elif command_type == vm.COMMAND_TYPE.C_FUNCTION:
+                function = arg1
+                self.functions[function] = len(self.operations)
+                operation, first = OP_FUNCTION, arg2
+            elif command_type == vm.COMMAND_TYPE.C_CALL:
+                operation = NATIVE.get((arg1, arg2), OP_CALL) if self.intrinsics else OP_CALL
+                # a native divide still calls Math.divide for the operands its fast path does not cover
+                self.fixups.append((len(self.operations), "Math.divide" if operation == OP_DIVIDE else arg1))
+                second = arg2
+            elif command_type == vm.COMMAND_TYPE.C_RETURN:
+                operation = OP_RETURN
+            self.operations.append(operation)
+            self.args.append(first)
+            self.args2.append(second)
+
+    def resolve(self):
+        """ Jump and call targets become command indexes, a goto to itself becomes halt """
+        size = len(self.operations)
+        for index, key in self.fixups:
+            operation = self.operations[index]
+            if operation == OP_GOTO or operation == OP_IF:
+                target = self.labels.get(key)
+                if target is None:
+                    print("ERROR: UNDEFINED LABEL " + key)
+            else:
+                target = self.functions.get(key)
+                if target is None and operation != OP_MULTIPLY:
+                    print("ERROR: UNDEFINED FUNCTION " + key)
+            self.args[index] = size if target is None else target # running off the end stops the program
+            if operation == OP_GOTO and target == index:
+                self.operations[index] = OP_HALT
+        self.fixups = []
+
+    def reset(self):
+        """ The state writeInit leaves: SP at 261 and Sys.init next, or SP at 256 and the first command """
+        self.ram[:] = [0] * RAM_WORDS
+        if "Sys.init" in self.functions:
+            self.ram[0], self.pc = BOOT_SP, self.functions["Sys.init"]
+        else:
+            self.ram[0], self.pc = STACK_BASE, 0
+        self.steps = 0
+        self.halted = False
+
+    def run(self, max_steps: int = 10000000) -> int:
+        """ Executes until a goto to itself or max_steps, returns the commands run """
+        operations, args, args2, ram = self.operations, self.args, self.args2, self.ram
+        pc, sp = self.pc, ram[0]
+        size = len(operations)
+        steps = 0
+        halted = False
+        while steps < max_steps and pc < size:
+            operation = operations[pc]
+            steps += 1
+            if operation == OP_PUSH_SEGMENT:
+                ram[sp] = ram[ram[args[pc]] + args2[pc]]
+                sp += 1
+            elif operation == OP_PUSH_CONSTANT:
+                ram[sp] = args[pc]
+                sp += 1
+            elif operation == OP_POP_SEGMENT:
+                sp -= 1
+                ram[ram[args[pc]] + args2[pc]] = ram[sp]
+            elif operation == OP_ADD:
+                sp -= 1
+                ram[sp - 1] = (ram[sp - 1] + ram[sp]) & 0xFFFF
+            elif operation == OP_PUSH_ADDRESS:
+                ram[sp] = ram[args[pc]]
+                sp += 1
+            elif operation == OP_POP_ADDRESS:
+                sp -= 1
+                ram[args[pc]] = ram[sp]
+            elif operation == OP_IF:
+                sp -= 1
+                if ram[sp]:
+                    pc = args[pc]
+                    continue
+            elif operation == OP_GOTO:
+                pc = args[pc]
+                continue
+            elif operation == OP_CALL:
+                # the frame of writeCall, with the index of the next command as return address
+                ram[sp] = pc + 1
+                ram[sp + 1], ram[sp + 2], ram[sp + 3], ram[sp + 4] = ram[1], ram[2], ram[3], ram[4]
+                ram[2] = sp - args2[pc]
+                sp += 5
+                ram[1] = sp
+                pc = args[pc]
+                continue
+            elif operation == OP_FUNCTION:
+                locals_ = args[pc]
+                if locals_:
+                    ram[sp:sp + locals_] = [0] * locals_
+                    sp += locals_
+            elif operation == OP_RETURN:
+                frame = ram[1]
+                pc = ram[frame - 5] # read first, with no arguments the return value lands on it
+                ram[ram[2]] = ram[sp - 1]
+                sp = ram[2] + 1
+                ram[4], ram[3], ram[2], ram[1] = ram[frame - 1], ram[frame - 2], ram[frame - 3], ram[frame - 4]
+                continue
+            elif operation == OP_SUB:
+                sp -= 1
+                ram[sp - 1] = (ram[sp - 1] - ram[sp]) & 0xFFFF
+            elif operation == OP_LT:
+                # the sign of x - y, as the translated comparisons test it
+                sp -= 1
+                ram[sp - 1] = 0xFFFF if (ram[sp - 1] - ram[sp]) & 0x8000 else 0
+            elif operation == OP_GT:
+                sp -= 1
+                difference = (ram[sp - 1] - ram[sp]) & 0xFFFF
+                ram[sp - 1] = 0xFFFF if 0 < difference < 0x8000 else 0
+            elif operation == OP_EQ:
+                sp -= 1
+                ram[sp - 1] = 0xFFFF if ram[sp - 1] == ram[sp] else 0
+            elif operation == OP_NOT:
+                ram[sp - 1] ^= 0xFFFF
+            elif operation == OP_NEG:
+                ram[sp - 1] = -ram[sp - 1] & 0xFFFF
+            elif operation == OP_AND:
+                sp -= 1
+                ram[sp - 1] &= ram[sp]
+            elif operation == OP_OR:
+                sp -= 1
+                ram[sp - 1] |= ram[sp]
+            elif operation == OP_MULTIPLY:
+                sp -= 1
+                ram[sp - 1] = ram[sp - 1] * ram[sp] & 0xFFFF
+            elif operation == OP_DIVIDE:
+                x, y = vm.signed(ram[sp - 2]), vm.signed(ram[sp - 1])
+                if -16384 <= x < 16384 and y != 0 and y != -32768:
+                    # where writeMathRoutines divides inline, Math.divide truncates toward zero
+                    sp -= 1
+                    quotient = abs(x) // abs(y)
+                    ram[sp - 1] = (quotient if (x < 0) == (y < 0) else -quotient) & 0xFFFF
+                else:
+                    ram[sp] = pc + 1
+                    ram[sp + 1], ram[sp + 2], ram[sp + 3], ram[sp + 4] = ram[1], ram[2], ram[3], ram[4]
+                    ram[2] = sp - 2
+                    sp += 5
+                    ram[1] = sp
+                    pc = args[pc]
+                    continue
+            else:
+                halted = True
+                break
+            pc += 1
+        ram[0] = sp
+        self.pc = pc
+        self.steps += steps
+        self.halted = halted
+        return steps
+
+
+class VM_INTERPRETER_CLI(cmd.Cmd):
+    prompt = "interpreter> "
+    intro = "VM interpreter"
+
+    def do_run(self, line):
+        """run file.vm|directory [steps] [first last] [-i]: runs VM code, prints RAM[first..last], -i runs Math natively"""
+        words = line.split()
+        intrinsics = "-i" in words
+        words = [word for word in words if word != "-i"]
+        if not words:
+            print("ERROR: NO PROGRAM")
+            return
+        if not os.path.exists(words[0]):
+            print("ERROR: NO SUCH FILE " + words[0])
+            return
+        input_files = vm.vmFiles(words[0]) if os.path.isdir(words[0]) else [words[0]]
+        max_steps = int(words[1]) if len(words) > 1 else 10000000
+        first, last = (int(words[2]), int(words[3])) if len(words) > 3 else (0, 15)
+        interpreter = VMInterpreter(input_files, intrinsics=intrinsics)
+        start = time.perf_counter()
+        steps = interpreter.run(max_steps)
+        seconds = time.perf_counter() - start
+        print(f"{len(interpreter.operations)} commands, {steps} steps in {seconds:.3f} s " + \
+              f"({steps / seconds / 1e6:.2f} M commands/s){', halted' if interpreter.halted else ''}")
+        for address in range(first, last + 1):
+            print(f"RAM[{address}] = {vm.signed(interpreter.ram[address])}")
+
+    def do_quit(self, line):
+        """Exit the CLI."""
+        return True
+
+
+if __name__ == "__main__":
+    VM_INTERPRETER_CLI().cmdloop()
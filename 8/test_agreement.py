@@ -0,0 +1,194 @@
+"""
+The VM interpreter and both Hack emulators must agree on one fixed program, translated under each flag combination
+
+author: Arpon Sarker
+date: 15-12-2024
+"""
+
+import contextlib
+import io
+import os
+
+import pytest
+
+import emulator
+import interpreter
+import vm
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MAX_CYCLES = 20000000
+
+# the app, a bump allocator in place of 12/Memory.jack (whose alloc is unfinished) and a small String;
+# 12/Math.jack and 12/Array.jack are compiled with them
+SOURCES = {
+    "Main.jack": """
+class Main {
+    static Array out;
+    static int count;
+
+    function void main() {
+        var int i, j, sum;
+        var Point p, q;
+        var Array a;
+        var String s;
+        let out = 8000;
+        let count = 0;
+        let i = 0;
+        let sum = 0;
+        while (i < 10) {
+            if ((i & 1) = 0) {
+                let sum = sum + i;
+            } else {
+                if (i > 6) { let sum = sum - 1; } else { let sum = sum + (i * 100); }
+            }
+            let i = i + 1;
+        }
+        do Main.put(sum);
+        let p = Point.new(3, 4);
+        let q = Point.new(10, -20);
+        do p.add(q);
+        do Main.put(p.getX());
+        do Main.put(p.getY());
+        do Main.put(p.sum() + Main.twice(21));
+        let a = Array.new(12);
+        let i = 0;
+        while (i < 12) {
+            let a[i] = Main.fib(i);
+            let i = i + 1;
+        }
+        let a[a[3] - 1] = a[11] * 3;
+        do Main.put(a[1]);
+        do Main.put(a[11]);
+        do Main.put(~(1 = 1));
+        do Main.put(-(7 + 2) * 2);
+        do Main.put(true);
+        do Main.put(null);
+        let i = -300;
+        while (i < 300) {
+            let j = 7;
+            do Main.put((i * j) + (i * 37) - (i * -16));
+            do Main.put((i / j) + (i / -5) + (12345 / (i | 1)));
+            do Main.put(Math.multiply(i, i + 1000) + Math.divide(i * 50, 13));
+            let i = i + 97;
+        }
+        do Main.put(Math.abs(-32767) + Math.max(3, -3) - Math.min(3, -3));
+        let s = "Hack";
+        do Main.put(s.charAt(0) + s.charAt(3));
+        do Main.put(s.length());
+        do a.dispose();
+        return;
+    }
+
+    function void put(int value) {
+        let out[count] = value;
+        let count = count + 1;
+        return;
+    }
+
+    function int twice(int x) { return x + x; }
+
+    function int fib(int n) {
+        if (n < 2) { return n; }
+        return Main.fib(n - 1) + Main.fib(n - 2);
+    }
+}
+""",
+    "Point.jack": """
+class Point {
+    field int x, y;
+    constructor Point new(int ax, int ay) { let x = ax; let y = ay; return this; }
+    method void add(Point other) { let x = x + other.getX(); let y = y + other.getY(); return; }
+    method int getX() { return x; }
+    method int getY() { return y; }
+    method int sum() { return getX() + y; }
+}
+""",
+    "Memory.jack": """
+class Memory {
+    static int next;
+    function void init() { let next = 3000; return; }
+    function int alloc(int size) {
+        var int base;
+        let base = next;
+        let next = next + size;
+        return base;
+    }
+    function void deAlloc(Array o) { return; }
+}
+""",
+    "String.jack": """
+class String {
+    field Array chars;
+    field int length;
+    constructor String new(int max) { let chars = Array.new(max + 1); let length = 0; return this; }
+    method String appendChar(char c) { let chars[length] = c; let length = length + 1; return this; }
+    method char charAt(int j) { return chars[j]; }
+    method int length() { return length; }
+}
+""",
+}
+# Sys.init has no locals, the bootstrap code does not set LCL
+SYS_VM = """function Sys.init 0
+call Memory.init 0
+pop temp 0
+call Math.init 0
+pop temp 0
+call Main.main 0
+pop temp 0
+label HALT
+goto HALT
+"""
+FLAGS = ["", "-O", "-d", "-t", "-f", "-s", "-i", "-b", "-O -d -t -f -s -i -b"]
+MODES = list(vm.WRITERS)
+
+
+@pytest.fixture(scope="module")
+def program(tmp_path_factory) -> list:
+    """ The .vm files of the program, compiled once with 11/compiler.py """
+    work = tmp_path_factory.mktemp("program")
+    jack_files = []
+    for name, source in SOURCES.items():
+        (work / name).write_text(source)
+        jack_files.append(str(work / name))
+    jack_files += [os.path.join(ROOT, "12", "Math.jack"), os.path.join(ROOT, "12", "Array.jack")]
+    vm_files = vm.compileJack(jack_files, str(work / "vm"))
+    (work / "vm" / "Sys.vm").write_text(SYS_VM)
+    return vm_files + [str(work / "vm" / "Sys.vm")]
+
+
+def translate(vm_files, line: str):
+    """ Translates with the options of a VMtranslator command line into test.asm, or test.hack with -a """
+    input_files, options = vm.parseArgs(line)
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm.translateFiles(vm_files, **options)
+
+
+def memory(ram) -> list:
+    """ SP and RAM[2048..], the stack below holds return addresses, which are ROM addresses at CPU level """
+    return [ram[0]] + list(ram[2048:])
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("flags", FLAGS)
+def test_interpreter_and_emulators_agree(program, mode, flags, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    machine = interpreter.VMInterpreter(program, intrinsics="-i" in flags.split())
+    assert machine.run(MAX_CYCLES) < MAX_CYCLES
+    assert list(machine.ram[8000:8004]) == [918, 13, -16 & 0xFFFF, 39] # not all three wrong in the same way
+    expected = memory(machine.ram)
+
+    translate(program, flags + " -m " + mode)
+    with open("test.asm") as file:
+        words, leaders = emulator.assemblyLeaders(file.read())
+    for hack in (emulator.HackEmulator(words), emulator.BlockEmulator(words, leaders)):
+        assert hack.run(MAX_CYCLES) < MAX_CYCLES
+        assert memory(hack.ram) == expected
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_assembling_in_process_matches_the_asm(program, mode, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    translate(program, "-m " + mode)
+    translate(program, "-m " + mode + " -a hack")
+    assert list(emulator.loadProgram("test.hack")) == list(emulator.loadProgram("test.asm"))
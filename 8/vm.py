@@ -6,8 +6,18 @@ date: 15-12-2024
 """
 
 import cmd
+import contextlib
+import hashlib
+import json
 import os
+import subprocess
+import sys
+import zlib
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from functools import partial
 from os.path import isdir
 
 
@@ -34,250 +44,482 @@ class VM_CLI(cmd.Cmd):
 
     def do_VMtranslator(self, line):
         """Converts source .vm file or directory of files to .asm file"""
-        input_file = line
-        if os.path.isdir(input_file):
-            # this is dir
-            temp_commands = ""
-            dir_files = os.listdir(input_file)
-            for dir_file in dir_files:
-                if dir_file[-3:] == ".vm":
-                    print(dir_file)
-                    with open(input_file + dir_file, "r") as file:
-                        for line in file:
-                            temp_commands += line
-            temp_file = open("temporary.txt", "w")
-            temp_file.write(temp_commands)
-            temp_file.close()
-            main("temporary.txt")
-            # temp_file.remove()
-        else:
-            main(line)
+        input_files, options = parseArgs(line)
+        for dir_file in input_files:
+            print(dir_file)
+        try:
+            translateFiles(input_files, **options)
+        except ValueError as error:
+            print(f"ERROR: {error}")
+
+    def do_romusage(self, line):
+        """ROM words needed by .vm files or directories (e.g. 9/HelloWorld 12) in every mode"""
+        input_files, options = parseArgs(line)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            usage = {mode: romUsage(input_files, **{**options, "mode": mode}) for mode in WRITERS}
+        for mode, words in usage.items():
+            fits = "fits" if words <= HACK_ROM_WORDS else "OVERFLOWS"
+            print(f"{mode:>10}: {words:>6} words ({100 * words / HACK_ROM_WORDS:.1f}% of ROM, {fits})")
+
+    def do_oslib(self, line):
+        """Builds the precompiled library of an OS directory (e.g. 12 -t) that -l links into programs"""
+        directory = line.split()[0]
+        input_files, options = parseArgs(line)
+        for option in ("jobs", "cache", "prune", "assemble", "library"):
+            options.pop(option, None)
+        try:
+            library = osLibrary(directory, **options)
+        except ValueError as error:
+            print(f"ERROR: {error}")
+            return
+        for module in library.modules:
+            print(f"{module.name:>10}: {len(module.words):>6} words, {len(module.symbols):>3} functions, " + \
+                  f"{len(module.relocations):>5} relocations, {len(module.references):>5} references")
+        print(f"{'total':>10}: {sum(len(module.words) for module in library.modules):>6} words, imports " + \
+              ", ".join(library.imports))
+
+    def do_verifypeephole(self, line):
+        """Checks the peephole rules against random machine states"""
+        failures = verifyPeepholeRules()
+        for failure in failures:
+            print("FAILED: ", failure)
+        print(f"{len(PEEPHOLE_EXAMPLES) - len(failures)}/{len(PEEPHOLE_EXAMPLES)} rule examples verified")
 
     def do_quit(self, line):
         """Exit the CLI."""
         return True
 
 
-class Parser:  # returns the classification of tokens
-    current_command = ""
-    line = ""
-    tokens = []  # contains each word in current command
-    command_type = None
-    arg_1 = None
-    arg_2 = None
+def parseArgs(line):
+    """ 'path... [-j N] [-c [dir]] [-O] [-m mode] [-d] [-t] [-f] [-s] [-i] [-b] [-a [hack|bin]] [-l osdir]' -> .vm files and the keyword options for translateFiles """
+    words = line.split()
+    options = {}
+    input_files = []
+    i = 0
+    while i < len(words) and not words[i].startswith("-"):
+        if os.path.isdir(words[i]):
+            # this is dir
+            input_files += vmFiles(words[i])
+        else:
+            input_files.append(words[i])
+        i += 1
+    while i < len(words):
+        if words[i] == "-j":
+            i += 1
+            options["jobs"] = int(words[i]) if i < len(words) else os.cpu_count()
+        elif words[i] == "-c":
+            if i + 1 < len(words) and not words[i+1].startswith("-"):
+                i += 1
+                options["cache"] = TranslationCache(words[i])
+            else:
+                options["cache"] = TranslationCache()
+        elif words[i] == "-O":
+            options["optimize"] = True
+        elif words[i] == "-d":
+            options["prune"] = True
+        elif words[i] == "-t":
+            options["fast_calls"] = True
+        elif words[i] == "-f":
+            options["fuse"] = SUPERINSTRUCTIONS
+        elif words[i] == "-s":
+            options["specialize"] = True
+        elif words[i] == "-i":
+            options["intrinsics"] = True
+        elif words[i] == "-l":
+            i += 1
+            options["library"] = words[i]
+        elif words[i] == "-b":
+            options["bulk"] = True
+        elif words[i] == "-a":
+            if i + 1 < len(words) and words[i+1] in ("hack", "bin"):
+                i += 1
+                options["assemble"] = words[i]
+            else:
+                options["assemble"] = "hack"
+        elif words[i] == "-m":
+            i += 1
+            options["mode"] = words[i]
+        else:
+            print("ERROR: UNKNOWN OPTION ", words[i])
+        i += 1
+    return input_files, options
 
-    def __init__(self, in_line: str):
-        self.line = in_line
-        self.advance()
 
-    # TODO: Fix tabs and whitespace at the beginning of no comment line
-    # TODO: Fix tabs and whitespace at the end of no comment line
-    def hasMoreCommands(self) -> bool:  # test if blank line, end of line comment, or start of line comment
-        self.line = self.line.strip()
-        index = self.line.find("//")
+ARITHMETIC_COMMANDS = ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not")
+OPCODES = {name: opcode for opcode, name in enumerate(ARITHMETIC_COMMANDS + \
+    ("push", "pop", "label", "goto", "if-goto", "function", "return", "call"))}
+OP_PUSH = OPCODES["push"]
+OP_POP = OPCODES["pop"]
+OP_LABEL = OPCODES["label"]
+OP_GOTO = OPCODES["goto"]
+OP_IF = OPCODES["if-goto"]
+OP_FUNCTION = OPCODES["function"]
+OP_RETURN = OPCODES["return"]
+OP_CALL = OPCODES["call"]
+# COMMAND_TYPE of every opcode
+OPCODE_TYPES = [COMMAND_TYPE.C_ARITHMETIC] * len(ARITHMETIC_COMMANDS) + [COMMAND_TYPE.C_PUSH,
+    COMMAND_TYPE.C_POP, COMMAND_TYPE.C_LABEL, COMMAND_TYPE.C_GOTO, COMMAND_TYPE.C_IF,
+    COMMAND_TYPE.C_FUNCTION, COMMAND_TYPE.C_RETURN, COMMAND_TYPE.C_CALL]
+SEGMENTS = ("constant", "local", "argument", "this", "that", "temp", "pointer", "static")
+SEGMENT_IDS = {segment: i for i, segment in enumerate(SEGMENTS)}
+SEGMENT_BASES = {"local": "LCL", "argument": "ARG", "this": "THIS", "that": "THAT"}
+SMALL_INDEX = 3 # largest index reached through an A=M+1 / A=A+1 chain instead of @index
+INTRINSICS = {("Math.multiply", 2): "MATH$MULTIPLY", ("Math.divide", 2): "MATH$DIVIDE"}
+STORE_DIRECT = {0: "0", 1: "1", 0xFFFF: "-1"} # values the ALU produces without D
 
-        while index >= 0:
-            if self.line[index-1] == " " or self.line[index-1] == '\t':
-                index -= 1
-            else:
-                self.line = self.line[:index]
-                break
-        if len(self.line) == 0:
-            return False
-        return True
 
-    def advance(self):
-        if self.hasMoreCommands() == False:  # line is not comment or blank
-            return
-        # set current command to current line being read
-        self.current_command = self.line
-        self.commandType()
-        if self.current_command != COMMAND_TYPE.C_RETURN:
-            self.arg_1 = self.arg1()
-        if self.command_type in (
-            COMMAND_TYPE.C_PUSH,
-            COMMAND_TYPE.C_POP,
-            COMMAND_TYPE.C_FUNCTION,
-            COMMAND_TYPE.C_CALL,
-        ):
-            self.arg_2 = self.arg2()
-
-    def commandType(self):
-        arithmetic_commands = [
-            "add",
-            "sub",
-            "neg",
-            "eq",
-            "gt",
-            "lt",
-            "and",
-            "or",
-            "not",
-        ]
-        self.tokens = self.current_command.split(" ")
-        print("TOKENS: ", self.tokens)
-        operator = self.tokens[0]
-        if operator in arithmetic_commands:
-            self.command_type = COMMAND_TYPE.C_ARITHMETIC
-        elif operator == "push":
-            self.command_type = COMMAND_TYPE.C_PUSH
-        elif operator == "pop":
-            self.command_type = COMMAND_TYPE.C_POP
-        elif operator == "label":
-            self.command_type = COMMAND_TYPE.C_LABEL
-        elif operator == "goto":
-            self.command_type = COMMAND_TYPE.C_GOTO
-        elif operator == "if-goto":
-            self.command_type = COMMAND_TYPE.C_IF
-        elif operator == "function":
-            self.command_type = COMMAND_TYPE.C_FUNCTION
-        elif operator == "return":
-            self.command_type = COMMAND_TYPE.C_RETURN
-        elif operator == "call":
-            self.command_type = COMMAND_TYPE.C_CALL
-        else:
-            print("ERROR: COMMAND TYPE IS INVALID for ", operator)
-            self.command_type = None
+class InstructionTable:  # a whole .vm file parsed once into parallel arrays
+    """
+    Instruction i is opcodes[i] with arguments arg1[i] and arg2[i]. arg1 indexes SEGMENTS for
+    push/pop and names for labels, functions and calls. arg2 is the segment index, the number
+    of locals or the number of arguments. Arithmetic commands and return have no arguments.
+    """
+
+    def __init__(self, source: str = "", file_name: str = ""):
+        self.opcodes = array("B")
+        self.arg1 = array("i")
+        self.arg2 = array("i")
+        self.lines = array("i") # source line of every instruction
+        self.names = [] # interned label and function names
+        self.name_ids = {}
+        self.parse(source, file_name)
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+    def intern(self, name: str) -> int:
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def parse(self, source: str, file_name: str = ""):
+        add_opcode, add_arg1, add_arg2, add_line = self.opcodes.append, self.arg1.append, self.arg2.append, self.lines.append
+        for number, line in enumerate(source.splitlines(), 1):
+            words = line.split("//", 1)[0].split()
+            if not words:
+                continue
+            opcode = OPCODES.get(words[0])
+            arg1 = arg2 = 0
+            try:
+                if opcode is None:
+                    raise ValueError("unknown command")
+                if opcode == OP_PUSH or opcode == OP_POP:
+                    arg1 = SEGMENT_IDS[words[1]]
+                    arg2 = int(words[2])
+                elif opcode >= OP_LABEL and opcode != OP_RETURN:
+                    arg1 = self.intern(words[1])
+                    if opcode >= OP_FUNCTION:
+                        arg2 = int(words[2])
+            except (ValueError, KeyError, IndexError):
+                print(f"ERROR: INVALID COMMAND at {file_name}:{number}: ", line.strip())
+                continue
+            add_opcode(opcode)
+            add_arg1(arg1)
+            add_arg2(arg2)
+            add_line(number)
+
+    def command(self, i: int) -> tuple:
+        """ (COMMAND_TYPE, arg1, arg2) of instruction i with its names spelled out """
+        opcode = self.opcodes[i]
+        if opcode < OP_PUSH:
+            return COMMAND_TYPE.C_ARITHMETIC, ARITHMETIC_COMMANDS[opcode], None
+        if opcode == OP_PUSH or opcode == OP_POP:
+            return OPCODE_TYPES[opcode], SEGMENTS[self.arg1[i]], self.arg2[i]
+        if opcode == OP_RETURN:
+            return COMMAND_TYPE.C_RETURN, None, None
+        return OPCODE_TYPES[opcode], self.names[self.arg1[i]], self.arg2[i]
 
-    def arg1(self):
-        arg = ""
-        if self.command_type in (COMMAND_TYPE.C_ARITHMETIC, COMMAND_TYPE.C_RETURN):
-            arg = self.tokens[0]
-        else:
-            arg = self.tokens[1]
-        return arg
 
-    def arg2(self):
-        return self.tokens[2]
+def parseFile(input_file) -> InstructionTable:
+    with open(input_file, "r") as file:
+        return InstructionTable(file.read(), input_file)
 
 
 class CodeWriter:  # returns the assembly encodings
     file_stream = "" # name of file w/ .asm extension
     file_created = False
     file_name = ""
-    assembly = ""
+    current_file = "" # name of the .vm file being translated, used for statics
+    chunks = None # assembly kept in memory when there is no sink
+    sink = None # any writable, every write method emits straight into it
     index = 0
     function = "null"
     static_index = 16
 
-    def __init__(self, ostream):
+    mode = "standard" # which code generation templates, see WRITERS
+    optimize = False
+    peephole = None # PeepholeOptimizer between the write methods and the output
+
+    keep = None # names of the functions to emit, None emits every function
+    skipping = False # inside a function that is not kept
+
+    arities = None # function name -> number of arguments all its call sites pass, enables tail calls
+    light = frozenset() # leaf functions that never pop pointer, called with a 3 word frame
+    light_frame = False # the function being translated is one of light
+
+    fuse = () # names of the SUPERINSTRUCTIONS to use
+    fused = None # Counter of superinstruction hits
+
+    specialize = False # fixed addresses and A=M+1 chains instead of base + index at run time
+    unroll_locals = 8 # functions with more locals than this zero them in a loop
+    intrinsics = False # Math.multiply and Math.divide become jumps to the MATH$ routines
+    bulk = False # runs of constant array stores and constant-argument calls get compact code
+
+    def __init__(self, ostream, sink=None, optimize=False, keep=None, arities=None, light=None, fuse=(),
+                 specialize=False, intrinsics=False, bulk=False):
         self.file_stream = ostream
+        self.sink = sink
+        self.chunks = []
+        self.optimize = optimize
+        self.peephole = PeepholeOptimizer() if optimize else None
+        self.keep = set(keep) if keep is not None else None
+        self.arities = arities
+        self.light = frozenset(light) if light is not None else frozenset()
+        self.fuse = tuple(fuse)
+        self.specialize = specialize
+        self.intrinsics = intrinsics
+        self.bulk = bulk
+        self.fused = Counter()
         if self.file_stream in os.listdir():  # if file already created
             self.file_created = True
 
+    def options(self) -> dict:
+        """ Code generation settings, workers and the cache rebuild writers from these """
+        keep = sorted(self.keep) if self.keep is not None else None
+        return {"mode": self.mode, "optimize": self.optimize, "keep": keep,
+                "arities": self.arities, "light": sorted(self.light), "fuse": list(self.fuse),
+                "specialize": self.specialize, "intrinsics": self.intrinsics, "bulk": self.bulk}
+
+    def stats(self) -> Counter:
+        stats = Counter(self.peephole.stats) if self.peephole is not None else Counter()
+        stats.update({"fused " + pattern: hits for pattern, hits in self.fused.items()})
+        return stats
+
+    @property
+    def assembly(self) -> str:
+        return "".join(self.chunks)
+
+    def emit(self, text: str):
+        if self.skipping:
+            return
+        if self.peephole is not None:
+            text = self.peephole.feed(text)
+        self.output(text)
+
+    def output(self, text: str):
+        """ Writes finished assembly, bypassing the optimizer """
+        if self.sink is not None:
+            self.sink.write(text)
+        else:
+            self.chunks.append(text)
+
+    def finish(self):
+        """ Flushes whatever the optimizer is still holding on to """
+        if self.peephole is not None:
+            self.output(self.peephole.finish())
+
     # Opens and sets up file stream
     def setFilename(self, file_name: str):
         self.file_name += ".asm"
 
-        # All the write methods have been used outside and so self.assembly is already full
+        self.finish()
+        if self.sink is not None:
+            # streaming mode: everything has already been written out
+            self.sink.flush()
+            return
+        # All the write methods have been used outside and so self.chunks is already full
         self.f = open(self.file_stream, "w")
-        self.f.write(self.assembly)
+        self.f.writelines(self.chunks)
         self.Close()
 
+    def setCurrentFile(self, file_name: str):
+        """ Informs the writer that translation of a new .vm file has started """
+        self.current_file = file_name
+        self.skipping = False
+        self.index = 0 # counters restart per file, labels stay unique through the file prefix
+
+    def staticName(self, index) -> str:
+        if self.current_file:
+            return self.current_file + "." + str(index)
+        return self.function.split('.')[0] + "." + str(index)
+
     def writeArithmetic(self, command):
         # bivariate = {"add":"+", "sub":"-"}
         # Labels are ROM addresses not RAM addresses. Therefore, no conflicts.
         if command == "add":
-            self.assembly += "@SP\nA=M-1\nD=M\nA=A-1\nD=D+M\nM=D\nD=A+1\n@SP\nM=D\n"
+            self.emit("@SP\nA=M-1\nD=M\nA=A-1\nD=D+M\nM=D\nD=A+1\n@SP\nM=D\n")
         elif command == "sub":
-            self.assembly += "@SP\nA=M-1\nD=M\nA=A-1\nD=M-D\nM=D\nD=A+1\n@SP\nM=D\n"
+            self.emit("@SP\nA=M-1\nD=M\nA=A-1\nD=M-D\nM=D\nD=A+1\n@SP\nM=D\n")
         elif command == "neg":
-            self.assembly += "@SP\nA=M\nA=A-1\nM=-M\n"
+            self.emit("@SP\nA=M\nA=A-1\nM=-M\n")
         elif command == "eq":
-            self.assembly += "@SP\nD=M\n@2\nD=D-A\n@R13\nM=D\nA=M\nD=M\nA=A+1\nD=D-M\n@EQ" + str(self.index) + "\nD;JEQ\n@R13\nA=M\nM=0\n@END" + "\n0;JMP\n(EQ" + str(self.index) + ")\n@R13\nA=M\nM=-1\n(END" + str(self.index) +")\n@SP\nM=M-1\n"
+            self.writeCompare("EQ", "JEQ")
         elif command == "gt":
-            self.assembly += "@SP\nD=M\n@2\nD=D-A\n@R13\nM=D\nA=M\nD=M\nA=A+1\nD=D-M\n@GT" + str(self.index) + "\nD;JGT\n@R13\nA=M\nM=0\n@END" + str(self.index) + "\n0;JMP\n(GT" + str(self.index) + ")\n@R13\nA=M\nM=-1\n(END" + str(self.index) +")\n@SP\nM=M-1\n"
+            self.writeCompare("GT", "JGT")
         elif command == "lt":
-            self.assembly += "@SP\nD=M\n@2\nD=D-A\n@R13\nM=D\nA=M\nD=M\nA=A+1\nD=D-M\n@LT" + "\nD;JLT\n@R13\nA=M\nM=0\n@END" + "\n0;JMP\n(LT)\n@R13\nA=M\nM=-1\n(END)\n@SP\nM=M-1\n"
+            self.writeCompare("LT", "JLT")
         elif command == "and":
-            self.assembly += "@SP\nM=M-1\nA=M\nD=M\nA=A-1\nM=D&M\n"
+            self.emit("@SP\nM=M-1\nA=M\nD=M\nA=A-1\nM=D&M\n")
         elif command == "or":
-            self.assembly += "@SP\nM=M-1\nA=M\nD=M\nA=A-1\nM=D|M\n"
+            self.emit("@SP\nM=M-1\nA=M\nD=M\nA=A-1\nM=D|M\n")
         elif command == "not":
-            self.assembly += "@SP\nD=M-1\nA=D\nM=!M\n"
+            self.emit("@SP\nD=M-1\nA=D\nM=!M\n")
         else:
             print("NOT VALID COMMAND")
 
         self.index += 1
 
-    def WritePushPop(self, command, segment, index):
-        segment_assembly = {"local": "LCL", "argument":"ARG", "this":"THIS", "that":"THAT", "temp":"R5"}
-        if command == "push" and segment == "constant":
-            print("constant statement")
-            self.assembly += "@" + str(index) + "\nD=A\n@SP\nA=M\nM=D\n@SP\nM=M+1\n"
-            
-
-
-
-        elif command == "push" and segment == "pointer":
-            # reg = "R3" if segment == "pointer" else self.function + "." + str(index)
-            reg = "R3"
-            self.assembly += "@" + reg + "\nD=A\n@" + str(index) + "\nA=D+A\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n"
-        elif command == "push" and segment == "static":
-            func_name = self.function.split('.')[0]
-            reg = func_name + "." + str(index)
-            # reg = self.function + "." + str(index)
+    def writeCompare(self, kind, jump):
+        true_label = self.uniqueLabel(kind)
+        end_label = self.uniqueLabel("END")
+        self.emit("@SP\nD=M\n@2\nD=D-A\n@R13\nM=D\nA=M\nD=M\nA=A+1\nD=D-M\n@" + true_label + "\nD;" + jump + "\n@R13\nA=M\nM=0\n@" + end_label + "\n0;JMP\n(" + true_label + ")\n@R13\nA=M\nM=-1\n(" + end_label +")\n@SP\nM=M-1\n")
 
-            print(f"Static variable reference: ", reg)
-            self.assembly += "@" + reg + "\nD=M\n@SP\nA=M\nM=D\n@SP\n@SP\nM=M+1\n"
-        elif command == "push":
-            print("push statement")
-            self.assembly += "@" + segment_assembly[segment] + "\nD=M\n@" + str(index) + "\nA=D+A\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n"
+    def uniqueLabel(self, name) -> str:
+        """ Generated labels are namespaced by file so each file can be translated on its own """
+        if self.current_file:
+            return self.current_file + "$" + name + str(self.index)
+        return name + str(self.index)
 
+    def WritePushPop(self, command, segment, index):
+        # temp, pointer, static and small indexes are addressed directly when specializing
+        address = self.directAddress(segment, index) if self.specialize or segment == "static" else None
+        if command == "push":
+            if segment == "constant":
+                value = "@" + str(index) + "\nD=A\n"
+            elif address is not None:
+                value = address + "D=M\n"
+            else:
+                value = self.runtimeAddress(segment, index, "A") + "D=M\n"
+            self.emit(value + "@SP\nA=M\nM=D\n@SP\nM=M+1\n")
+        elif address is not None:
+            self.emit("@SP\nAM=M-1\nD=M\n" + address + "M=D\n")
+        else:
+            self.emit(self.runtimeAddress(segment, index, "D") + "@R13\nM=D\n@SP\nA=M-1\nD=M\n@R13\nA=M\nM=D\n@SP\nM=M-1\n")
 
-        # if command == "pop" and segment == "temp":
-        #     self.assembly += "@R5\nD=A\n@" + str(index) + "\nD=D+A\n@R13\nM=D\n@SP\nA=A-1\nD=M\n@R13\nA=M\nM=D\n@SP\nM=M-1\n" 
-        if command == "pop" and segment == "pointer":
-            # reg = "R3" if segment == "pointer" else "16"
-            reg = "R3"
-            self.assembly += "@" + reg + "\nD=A\n@" + str(index) + "\nD=D+A\n@R13\nM=D\n@SP\nA=M-1\nD=M\n@13\nA=M\nM=D\n@SP\nM=M-1\n"
-        # TODO: FIXXXXX
-
+    def runtimeAddress(self, segment, index, register) -> str:
+        """ base + index computed at run time into register A or D """
+        if segment in SEGMENT_BASES:
+            base = "@" + SEGMENT_BASES[segment] + "\nD=M\n"
+        else:
+            base = ("@R5" if segment == "temp" else "@R3") + "\nD=A\n"
+        return base + "@" + str(index) + "\n" + register + "=D+A\n"
 
+    def directAddress(self, segment, index) -> str | None:
+        """ Code that points A at segment[index] without touching D, None if that needs D """
+        if segment == "temp":
+            return "@" + str(5 + int(index)) + "\n"
+        if segment == "pointer":
+            return "@THIS\n" if int(index) == 0 else "@THAT\n"
+        if segment == "static":
+            return "@" + self.staticName(index) + "\n"
+        if segment in SEGMENT_BASES and int(index) <= SMALL_INDEX:
+            index = int(index)
+            return "@" + SEGMENT_BASES[segment] + "\n" + ("A=M\n" if index == 0 else "A=M+1\n" + "A=A+1\n" * (index - 1))
+        return None
 
-        elif command == "pop" and segment == "static":
-            func_name = self.function.split('.')[0]
-            reg = func_name + "." + str(index)
-            print(f"Static variable reference: ", reg)
-            self.assembly += "@SP\nA=M-1\nD=M\n@" + reg + "\nM=D\n@SP\nM=M-1\n"
+    def loadOperand(self, segment, index) -> str:
+        """ Code that sets D to segment[index] """
+        if segment == "constant":
+            return "@" + str(index) + "\nD=A\n"
+        address = self.directAddress(segment, index)
+        if address is not None:
+            return address + "D=M\n"
+        return self.runtimeAddress(segment, index, "A") + "D=M\n"
 
+    def writeIncrement(self, segment, index, delta: int):
+        """ push x / push constant c / add|sub / pop x, without touching the stack """
+        if delta == 0:
+            return
+        address = self.directAddress(segment, index)
+        if address is None:
+            address = self.runtimeAddress(segment, index, "A")
+            if delta not in (1, -1):
+                address = self.runtimeAddress(segment, index, "D") + "@R13\nM=D\n@" + str(abs(delta)) + "\nD=A\n@R13\nA=M\n"
+                self.emit(address + ("M=D+M\n" if delta > 0 else "M=M-D\n"))
+                return
+        if delta == 1:
+            self.emit(address + "M=M+1\n")
+        elif delta == -1:
+            self.emit(address + "M=M-1\n")
+        else:
+            self.emit("@" + str(abs(delta)) + "\nD=A\n" + address + ("M=D+M\n" if delta > 0 else "M=M-D\n"))
 
+    def writeCompareBranch(self, x, y, command, negate, label):
+        """ push x / push y / eq|gt|lt / [not] / if-goto label, jumping on x - y without making -1/0 """
+        jumps = {"eq": ("JEQ", "JNE"), "gt": ("JGT", "JLE"), "lt": ("JLT", "JGE")}
+        if y[0] == "constant":
+            code = self.loadOperand(*x) + ("@" + str(y[1]) + "\nD=D-A\n" if int(y[1]) != 0 else "")
+        elif self.directAddress(*y) is not None:
+            code = self.loadOperand(*x) + self.directAddress(*y) + "D=D-M\n"
+        else:
+            code = self.loadOperand(*y) + "@R13\nM=D\n" + self.loadOperand(*x) + "@R13\nD=D-M\n"
+        self.emit(code + "@" + self.function + "$" + label + "\nD;" + jumps[command][negate] + "\n")
 
-        elif command == "pop" and segment == "temp":
-            self.assembly += "@R5\nD=A\n@" + str(index) + "\nD=D+A\n@13\nM=D\n@SP\nA=M-1\nD=M\n@13\nA=M\nM=D\n@SP\nM=M-1\n"
-        elif command == "pop":
-            print("pop statement")
-            self.assembly += "@" + segment_assembly[segment] + "\nD=M\n@" + str(index) + "\nD=D+A\n@R13\nM=D\n@SP\nA=M-1\nD=M\n@R13\nA=M\nM=D\n@SP\nM=M-1\n" 
+    def writeNotBranch(self, label):
+        """ not / if-goto label, ~x is nonzero exactly when x + 1 is """
+        self.emit("@SP\nAM=M-1\nD=M+1\n@" + self.function + "$" + label + "\nD;JNE\n")
 
-            
     def writeLabel(self, label : str):
-        self.assembly += "(" + self.function + "$" + label + ")\n"# function_name$label
+        self.emit("(" + self.function + "$" + label + ")\n")  # function_name$label
 
     def writeGoto(self, label : str):
         label_  = self.function + "$" + label
-        self.assembly += "@" + label_ + "\n0;JMP\n"
+        self.emit("@" + label_ + "\n0;JMP\n")
 
     def writeIf(self, label : str):
-        print("if-goto reached")
         label_ = self.function + "$" + label
-        self.assembly += "@SP\nM=M-1\nA=M\nD=M\n@" + label_ + "\nD;JNE\n"
+        self.emit("@SP\nM=M-1\nA=M\nD=M\n@" + label_ + "\nD;JNE\n")
 
     def writeFunction(self, functionName:str, numLocals:int):
         self.function = functionName
-        self.assembly += "(" + functionName + ")\n" + "@" + str(numLocals) + "\nD=A\n@" + functionName + ".END\nD;JEQ\n(" + functionName + ".LOOP)\n@SP\nA=M\nM=0\n@SP\nM=M+1\nD=D-1\n@" + functionName + ".LOOP\nD;JNE\n(" + functionName + ".END)\n"
+        # unreachable bodies are dropped here, before any of their code is generated
+        self.skipping = self.keep is not None and functionName not in self.keep
+        self.light_frame = functionName in self.light
+        self.emit("(" + functionName + ")\n" + self.prologue(functionName, int(numLocals)))
         self.index += 1
 
+    def prologue(self, functionName:str, numLocals:int) -> str:
+        """ Pushes numLocals zeros: nothing, straight-line code, or a loop above unroll_locals """
+        if numLocals == 0:
+            return ""
+        if numLocals == 1:
+            return "@SP\nAM=M+1\nA=A-1\nM=0\n"
+        if numLocals <= self.unroll_locals:
+            return "@SP\nA=M\n" + "M=0\nA=A+1\n" * (numLocals - 1) + "M=0\nD=A+1\n@SP\nM=D\n"
+        return "@" + str(numLocals) + "\nD=A\n(" + functionName + ".LOOP)\n@SP\nAM=M+1\nA=A-1\nM=0\nD=D-1\n@" + \
+            functionName + ".LOOP\nD;JNE\n"
+
     def writeReturn(self): 
-        self.assembly += "@LCL\nD=M\n@5\nA=D-A\nD=M\n@R14\nM=D\n@SP\nA=M-1\nD=M\n@ARG\nA=M\nM=D\nD=A+1\n@SP\nM=D\n" + \
+        if self.light_frame:
+            # frame is return address, LCL, ARG
+            self.emit("@LCL\nD=M\n@3\nA=D-A\nD=M\n@R14\nM=D\n@SP\nA=M-1\nD=M\n@ARG\nA=M\nM=D\nD=A+1\n@SP\nM=D\n" + \
+                "@LCL\nAM=M-1\nD=M\n@ARG\nM=D\n" + \
+                "@LCL\nAM=M-1\nD=M\n@LCL\nM=D\n" + \
+                "@R14\nA=M\n0;JMP\n")
+            return
+        self.emit("@LCL\nD=M\n@5\nA=D-A\nD=M\n@R14\nM=D\n@SP\nA=M-1\nD=M\n@ARG\nA=M\nM=D\nD=A+1\n@SP\nM=D\n" + \
             "@LCL\nD=M\n@1\nA=D-A\nD=M\n@THAT\nM=D\n" + \
             "@LCL\nD=M\n@2\nA=D-A\nD=M\n@THIS\nM=D\n" + \
             "@LCL\nD=M\n@3\nA=D-A\nD=M\n@ARG\nM=D\n"  + \
             "@LCL\nD=M\n@4\nA=D-A\nD=M\n@LCL\nM=D\n"  + \
-            "@R14\nA=M\n0;JMP\n"
+            "@R14\nA=M\n0;JMP\n")
     
     def writeCall(self, functionName:str, numArgs: int):
-        return_address = "return." + functionName + str(self.index)
-        self.assembly += "@" + return_address + "\nD=A\n@SP\nA=M\nM=D\n@SP\nM=M+1\n" + \
+        if self.writeIntrinsic(functionName, numArgs):
+            return
+        return_address = self.uniqueLabel("return." + functionName)
+        if functionName in self.light:
+            # THIS and THAT cannot change in the callee, so they are not saved
+            self.emit("@" + return_address + "\nD=A\n@SP\nA=M\nM=D\n@SP\nM=M+1\n" + \
+                "@LCL\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n"  + \
+                "@ARG\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n"  + \
+                "@SP\nD=M\n@LCL\nM=D\n@" + str(numArgs + 3) + "\nD=D-A\n@ARG\nM=D\n" + \
+                "@" + functionName + "\n0;JMP\n(" + return_address + ")\n")
+            self.index += 1
+            return
+        self.emit("@" + return_address + "\nD=A\n@SP\nA=M\nM=D\n@SP\nM=M+1\n" + \
             "@LCL\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n"  + \
             "@ARG\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n"  + \
             "@THIS\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n" + \
@@ -285,52 +527,1373 @@ class CodeWriter:  # returns the assembly encodings
             "@SP\nD=M\n@" + str(numArgs) + "\nD=D-A\n@5\nD=D-A\n@ARG\nM=D\n" + \
             "@SP\nD=M\n@LCL\nM=D\n" + \
             "@" + functionName + "\n" + \
-            "0;JMP\n" + "(" + return_address + ")\n"
+            "0;JMP\n" + "(" + return_address + ")\n")
 
         self.index += 1
 
+    def writeTailCall(self, functionName:str, numArgs: int) -> bool:
+        """ call + return as a jump that reuses the current frame, False when that is not possible """
+        arity = self.arities.get(self.function) if self.arities is not None else None
+        if arity is None or numArgs > arity or self.light_frame or functionName in self.light:
+            return False
+        if self.intrinsics and (functionName, numArgs) in INTRINSICS:
+            return False
+        # the arguments replace the current ones, ARG[k] = SP[k - numArgs]
+        for k in range(numArgs):
+            source = "@SP\nD=M\n@" + str(numArgs - k) + "\nA=D-A\nD=M\n"
+            if k < 3:
+                self.emit(source + "@ARG\nA=M\n" + "A=A+1\n" * k + "M=D\n")
+            else:
+                self.emit("@ARG\nD=M\n@" + str(k) + "\nD=D+A\n@R13\nM=D\n" + source + "@R13\nA=M\nM=D\n")
+        if numArgs < arity:
+            # the saved frame moves down next to the new arguments
+            for j in range(5):
+                self.emit("@ARG\nD=M\n@" + str(numArgs + j) + "\nD=D+A\n@R13\nM=D\n" + \
+                    "@LCL\nD=M\n@" + str(5 - j) + "\nA=D-A\nD=M\n@R13\nA=M\nM=D\n")
+            self.emit("@ARG\nD=M\n@" + str(numArgs + 5) + "\nD=D+A\n@LCL\nM=D\n")
+        self.emit("@LCL\nD=M\n@SP\nM=D\n@" + functionName + "\n0;JMP\n")
+        return True
+
     def writeInit(self):
-        self.assembly += "@256\nD=A\n@SP\nM=D\n" + \
+        self.emit("@256\nD=A\n@SP\nM=D\n" + \
             "@261\nD=A\n@SP\nM=D\n" + \
-            "@Sys.init\n0;JMP\n"
+            "@Sys.init\n0;JMP\n")
+        if self.intrinsics:
+            self.writeMathRoutines()
+
+    def writeIntrinsic(self, functionName:str, numArgs: int) -> bool:
+        """ Replaces a call of an INTRINSICS function by a jump to its routine """
+        if not self.intrinsics or (functionName, numArgs) not in INTRINSICS:
+            return False
+        return_address = self.uniqueLabel("return." + functionName)
+        self.emit("@" + return_address + "\nD=A\n@" + INTRINSICS[functionName, numArgs] + "\n0;JMP\n(" + return_address + ")\n")
+        self.index += 1
+        return True
+
+    def writeMultiplyConstant(self, constant: int):
+        """ push constant c / call Math.multiply 2: the top of the stack times c by shifts and adds """
+        if constant == 1:
+            return
+        if constant == 0:
+            self.emit("@SP\nA=M-1\nM=0\n")
+            return
+        bits = bin(constant)[3:] # below the leading one
+        # the ALU cannot compute D+D, so D is doubled through a memory word: M=D, D=D+M
+        if "1" not in bits:
+            self.emit("@SP\nA=M-1\nD=M\n" + "M=D\nD=D+M\n" * len(bits) + "M=D\n")
+            return
+        code = "@SP\nA=M-1\nD=M\n@R13\nM=D\n@R14\n"
+        for bit in bits:
+            code += "M=D\nD=D+M\n" + ("@R13\nD=D+M\n@R14\n" if bit == "1" else "")
+        self.emit(code + "@SP\nA=M-1\nM=D\n")
+
+    def loadConstant(self, value: int) -> str:
+        """ Code that sets D to any 16 bit value, A-instructions only hold 15 bits """
+        if value < 0x8000:
+            return "@" + str(value) + "\nD=A\n"
+        return "@" + str(~value & 0x7FFF) + "\nD=!A\n"
+
+    def storeConstant(self, value: int, address: str) -> str:
+        """ Code that stores a 16 bit value where address leaves A, 0, 1 and -1 need no D """
+        if value in STORE_DIRECT:
+            return address + "M=" + STORE_DIRECT[value] + "\n"
+        return self.loadConstant(value) + address + "M=D\n"
+
+    def pushConstants(self, values, label=None) -> str:
+        """ Code that pushes the label's address and then the values, R13 walks the stack and SP is set once """
+        code = "@SP\nD=M-1\n@R13\nM=D\n"
+        if label is not None:
+            code += "@" + label + "\nD=A\n@R13\nAM=M+1\nM=D\n"
+        for value in values:
+            code += self.storeConstant(value, "@R13\nAM=M+1\n")
+        return code + "@R13\nD=M+1\n@SP\nM=D\n"
+
+    def writeArrayFill(self, segment, index, entries):
+        """
+        A run of let a[k] = c with the same array and constant k and c, as (k, c) entries. R13 walks the
+        array instead of each store going through the stack, THAT and temp 0 end up as the last store left them
+        """
+        start = (entries[0][0] - 1) & 0xFFFF
+        code = self.loadOperand(segment, index) + ("D=D-1\n" if start == 0xFFFF else "") + "@R13\nM=D\n"
+        if start not in (0, 0xFFFF):
+            code += self.loadConstant(start) + "@R13\nM=D+M\n"
+        position = start
+        for offset, value in entries:
+            delta = (offset - position) & 0xFFFF
+            position = offset
+            if delta == 1:
+                code += self.storeConstant(value, "@R13\nAM=M+1\n")
+                continue
+            if delta:
+                code += self.loadConstant(delta) + "@R13\nM=D+M\n"
+            code += self.storeConstant(value, "@R13\nA=M\n")
+        code += "@R13\nD=M\n" + self.directAddress("pointer", 1) + "M=D\n"
+        self.emit(code + self.storeConstant(entries[-1][1], self.directAddress("temp", 0)))
+
+    def writeConstantCalls(self, functionName: str, numArgs: int, rows):
+        """
+        A run of call f n / pop temp 0 whose arguments are constants, one list of values per row. Each row
+        pushes the address of the next row under its arguments and jumps to one shared copy of the call,
+        which pops temp 0 and then jumps to that address
+        """
+        call = self.uniqueLabel("CALLS")
+        self.index += 1
+        returns = []
+        for row in rows:
+            returns.append(self.uniqueLabel("ROW"))
+            self.index += 1
+        for k, values in enumerate(rows):
+            self.emit(self.pushConstants(values, returns[k]) + ("@" + call + "\n0;JMP\n" if k + 1 < len(rows) else ""))
+            if k + 1 < len(rows):
+                self.emit("(" + returns[k] + ")\n")
+        self.emit("(" + call + ")\n")
+        self.writeCall(functionName, numArgs)
+        self.WritePushPop("pop", "temp", 0)
+        self.emit("@SP\nAM=M-1\nA=M\n0;JMP\n(" + returns[-1] + ")\n")
+
+    def writeMathRoutines(self):
+        """
+        MATH$MULTIPLY and MATH$DIVIDE are entered with x, y on the stack and the return address
+        in D, and leave the result in place of x. Multiply is shift-and-add over the set bits of
+        y, the same 16 bit product as Math.multiply. Divide is long division over the 15 bit
+        magnitude of x when -16384 <= x < 16384 and y is neither 0 nor -32768; there the
+        recursive Math.divide is exact. Other operands go through a real call of Math.divide,
+        so the result is always the one Math.divide computes.
+        """
+        self.emit("(MATH$MULTIPLY)\n@SP\nA=M\nM=D\n" + \
+            "@SP\nA=M-1\nD=M\n@R14\nM=D\n" + \
+            "@SP\nA=M-1\nA=A-1\nD=M\n@R13\nM=D\n" + \
+            "@SP\nA=M-1\nA=A-1\nM=0\n@R15\nM=1\n" + \
+            "(MATH$MULTIPLY.LOOP)\n@R14\nD=M\n@MATH$MULTIPLY.END\nD;JEQ\n" + \
+            "@R15\nD=D&M\n@MATH$MULTIPLY.SKIP\nD;JEQ\n" + \
+            "@R14\nM=M-D\n@R13\nD=M\n@SP\nA=M-1\nA=A-1\nM=D+M\n" + \
+            "(MATH$MULTIPLY.SKIP)\n@R13\nD=M\nM=D+M\n@R15\nD=M\nM=D+M\n@MATH$MULTIPLY.LOOP\n0;JMP\n" + \
+            "(MATH$MULTIPLY.END)\n@SP\nAM=M-1\nA=A+1\nA=M\n0;JMP\n")
+        # R13 remainder, R14 magnitude of x shifted left behind a marker bit, R15 quotient,
+        # y slot |y|, RAM[SP] return address, RAM[SP+1] -1 when the signs differ
+        self.emit("(MATH$DIVIDE)\n@R13\nM=D\n" + \
+            "@SP\nA=M-1\nD=M\n@MATH$DIVIDE.SLOW\nD;JEQ\n@32767\nD=D+A\n@MATH$DIVIDE.SLOW\nD+1;JEQ\n" + \
+            "@SP\nA=M-1\nA=A-1\nD=M\n@16384\nD=D+A\n@MATH$DIVIDE.SLOW\nD;JLT\n" + \
+            "@R13\nD=M\n@SP\nA=M\nM=D\nA=A+1\nM=0\n" + \
+            "@SP\nA=M-1\nD=M\n@MATH$DIVIDE.YPOS\nD;JGE\n@SP\nA=M-1\nM=-D\nA=A+1\nA=A+1\nM=!M\n" + \
+            "(MATH$DIVIDE.YPOS)\n@SP\nA=M-1\nA=A-1\nD=M\n@MATH$DIVIDE.XPOS\nD;JGE\n@SP\nA=M+1\nM=!M\nD=-D\n" + \
+            "(MATH$DIVIDE.XPOS)\n@R14\nM=D\nM=D+M\nM=M+1\n@R13\nM=0\n@R15\nM=0\n" + \
+            "(MATH$DIVIDE.LOOP)\n@R14\nD=M\nM=D+M\n@MATH$DIVIDE.ZERO\nD;JGE\n" + \
+            "@R14\nD=M\n@MATH$DIVIDE.DONE\nD;JEQ\n@R13\nD=M\nM=D+M\nM=M+1\n@MATH$DIVIDE.TEST\n0;JMP\n" + \
+            "(MATH$DIVIDE.ZERO)\n@R13\nD=M\nM=D+M\n" + \
+            "(MATH$DIVIDE.TEST)\n@R15\nD=M\nM=D+M\n@R13\nD=M\n@SP\nA=M-1\nD=D-M\n@MATH$DIVIDE.LOOP\nD;JLT\n" + \
+            "@R13\nM=D\n@R15\nM=M+1\n@MATH$DIVIDE.LOOP\n0;JMP\n" + \
+            "(MATH$DIVIDE.DONE)\n@SP\nA=M+1\nD=M\n@MATH$DIVIDE.SIGNED\nD;JEQ\n@R15\nM=-M\n" + \
+            "(MATH$DIVIDE.SIGNED)\n@R15\nD=M\n@SP\nAM=M-1\nA=A-1\nM=D\n@SP\nA=M+1\nA=M\n0;JMP\n")
+        # the general case is an ordinary call of Math.divide returning straight to the call site
+        frame = ("LCL", "ARG") if "Math.divide" in self.light else ("LCL", "ARG", "THIS", "THAT")
+        self.emit("(MATH$DIVIDE.SLOW)\n@R13\nD=M\n@SP\nAM=M+1\nA=A-1\nM=D\n" + \
+            "".join("@" + pointer + "\nD=M\n@SP\nAM=M+1\nA=A-1\nM=D\n" for pointer in frame) + \
+            "@SP\nD=M\n@LCL\nM=D\n@" + str(3 + len(frame)) + "\nD=D-A\n@ARG\nM=D\n@Math.divide\n0;JMP\n")
 
     def Close(self):
         self.f.close()
 
-def main(file):  
-    input_file = file  
 
-    # this is single file
-    i = 0
-    coder = CodeWriter("test.asm")
-    with open(input_file, "r") as file:
-        coder.writeInit()
-        for line in file:
-            if line[-1] == "\n":
-                line = line[:-1]
+class TosCodeWriter(CodeWriter):  # keeps the top of the stack in D between commands
+    """
+    While cached is True the top of the stack lives only in D and SP points just below it.
+    The value is spilled to RAM before labels, jumps, calls and returns, so every jump
+    target sees the same memory-only stack as the standard templates.
+    """
+    mode = "tos"
+    cached = False
+
+    def spill(self):
+        if self.cached:
+            self.emit("@SP\nAM=M+1\nA=A-1\nM=D\n")
+            self.cached = False
+
+    def load(self):
+        """ Makes sure the top of the stack is in D, popping it off RAM if needed """
+        if not self.cached:
+            self.emit("@SP\nAM=M-1\nD=M\n")
+            self.cached = True
+
+    def finish(self):
+        self.spill()
+        super().finish()
+
+    def setCurrentFile(self, file_name: str):
+        self.spill()
+        super().setCurrentFile(file_name)
+
+    def writeArithmetic(self, command):
+        binary = {"add": "D=D+M", "sub": "D=M-D", "and": "D=D&M", "or": "D=D|M"}
+        unary = {"neg": "-", "not": "!"}
+        compare = {"eq": "JEQ", "gt": "JGT", "lt": "JLT"}
+        if command in binary:
+            self.load()
+            self.emit("@SP\nAM=M-1\n" + binary[command] + "\n")
+        elif command in unary:
+            if self.cached:
+                self.emit("D=" + unary[command] + "D\n")
+            else:
+                self.emit("@SP\nA=M-1\nM=" + unary[command] + "M\n")
+        elif command in compare:
+            self.load()
+            true_label = self.uniqueLabel(command.upper())
+            end_label = self.uniqueLabel("END")
+            self.emit("@SP\nAM=M-1\nD=M-D\n@" + true_label + "\nD;" + compare[command] + "\nD=0\n@" + end_label + "\n0;JMP\n(" + true_label + ")\nD=-1\n(" + end_label + ")\n")
+        else:
+            print("NOT VALID COMMAND")
+        self.index += 1
+
+    def WritePushPop(self, command, segment, index):
+        if command == "push":
+            self.spill()
+            if segment == "constant":
+                self.emit("@" + str(index) + "\nD=A\n")
+            else:
+                self.emit(self.address(segment, index) + "D=M\n")
+            self.cached = True
+        else:
+            self.load()
+            if self.directAddress(segment, index) is None:
+                # D holds the value, R13 keeps a copy so the address can be taken back out of D
+                self.emit("@R13\nM=D\n@" + SEGMENT_BASES[segment] + "\nD=D+M\n@" + str(index) + "\nD=D+A\n@R13\nA=D-M\nM=D-A\n")
+            else:
+                self.emit(self.address(segment, index) + "M=D\n")
+            self.cached = False
+
+    def address(self, segment, index) -> str:
+        """ Assembly leaving the address of segment[index] in A, without touching D if it can """
+        address = self.directAddress(segment, index)
+        if address is not None:
+            return address
+        # only reached for push, where D is free
+        return self.runtimeAddress(segment, index, "A")
+
+    def writeLabel(self, label : str):
+        self.spill()
+        super().writeLabel(label)
+
+    def writeGoto(self, label : str):
+        self.spill()
+        super().writeGoto(label)
+
+    def writeIf(self, label : str):
+        self.load()
+        self.emit("@" + self.function + "$" + label + "\nD;JNE\n")
+        self.cached = False
+
+    def writeMultiplyConstant(self, constant: int):
+        self.spill()
+        super().writeMultiplyConstant(constant)
+
+    def writeArrayFill(self, segment, index, entries):
+        self.spill()
+        super().writeArrayFill(segment, index, entries)
+
+    def writeConstantCalls(self, functionName: str, numArgs: int, rows):
+        self.spill()
+        super().writeConstantCalls(functionName, numArgs, rows)
+
+    def writeIncrement(self, segment, index, delta: int):
+        self.spill()
+        super().writeIncrement(segment, index, delta)
+
+    def writeCompareBranch(self, x, y, command, negate, label):
+        self.spill()
+        super().writeCompareBranch(x, y, command, negate, label)
+
+    def writeNotBranch(self, label):
+        self.load()
+        self.emit("D=D+1\n@" + self.function + "$" + label + "\nD;JNE\n")
+        self.cached = False
+
+    def writeFunction(self, functionName:str, numLocals:int):
+        self.spill()
+        super().writeFunction(functionName, numLocals)
+
+    def writeReturn(self):
+        self.spill()
+        super().writeReturn()
+
+    def writeCall(self, functionName:str, numArgs: int):
+        self.spill()
+        super().writeCall(functionName, numArgs)
+
+    def writeTailCall(self, functionName:str, numArgs: int) -> bool:
+        self.spill()
+        return super().writeTailCall(functionName, numArgs)
+
+
+class SizeCodeWriter(CodeWriter):  # one shared copy of call, return and the comparisons
+    """
+    Call sites load the callee into R14, the argument count into R15 and the return
+    address into D before jumping to VM$CALL, returns jump to VM$RETURN, and eq/gt/lt
+    jump to VM$EQ/VM$GT/VM$LT with the return address in D (kept in R13 by the routine).
+    The routines are emitted once, right after the bootstrap code. Every call uses the
+    full frame, light frames would need their own inline code.
+    """
+    mode = "size"
+    unroll_locals = 2 # straight-line zeroing is only smaller than the loop up to here
+
+    def __init__(self, ostream, sink=None, **options):
+        super().__init__(ostream, sink, **options)
+        self.light = frozenset() # every callee returns through VM$RETURN
+
+    def writeCompare(self, kind, jump):
+        return_address = self.uniqueLabel(kind)
+        self.emit("@" + return_address + "\nD=A\n@VM$" + kind + "\n0;JMP\n(" + return_address + ")\n")
+
+    def writeReturn(self):
+        self.emit("@VM$RETURN\n0;JMP\n")
+
+    def writeCall(self, functionName:str, numArgs: int):
+        if self.writeIntrinsic(functionName, numArgs):
+            return
+        return_address = self.uniqueLabel("return." + functionName)
+        self.emit("@" + str(numArgs) + "\nD=A\n@R15\nM=D\n" + \
+            "@" + functionName + "\nD=A\n@R14\nM=D\n" + \
+            "@" + return_address + "\nD=A\n@VM$CALL\n0;JMP\n(" + return_address + ")\n")
+        self.index += 1
+
+    def writeInit(self):
+        super().writeInit()
+        self.emit("(VM$CALL)\n@SP\nAM=M+1\nA=A-1\nM=D\n" + \
+            "@LCL\nD=M\n@SP\nAM=M+1\nA=A-1\nM=D\n" + \
+            "@ARG\nD=M\n@SP\nAM=M+1\nA=A-1\nM=D\n" + \
+            "@THIS\nD=M\n@SP\nAM=M+1\nA=A-1\nM=D\n" + \
+            "@THAT\nD=M\n@SP\nAM=M+1\nA=A-1\nM=D\n" + \
+            "@R15\nD=M\n@5\nD=D+A\n@SP\nD=M-D\n@ARG\nM=D\n" + \
+            "@SP\nD=M\n@LCL\nM=D\n" + \
+            "@R14\nA=M\n0;JMP\n")
+        self.emit("(VM$RETURN)\n")
+        super().writeReturn()
+        for kind, jump in (("EQ", "JEQ"), ("GT", "JGT"), ("LT", "JLT")):
+            self.emit("(VM$" + kind + ")\n@R13\nM=D\n" + \
+                "@SP\nAM=M-1\nD=M\nA=A-1\nD=M-D\nM=-1\n" + \
+                "@VM$" + kind + ".TRUE\nD;" + jump + "\n@SP\nA=M-1\nM=0\n" + \
+                "(VM$" + kind + ".TRUE)\n@R13\nA=M\n0;JMP\n")
+
+
+WRITERS = {"standard": CodeWriter, "tos": TosCodeWriter, "size": SizeCodeWriter}
+
+
+def makeCodeWriter(ostream, sink=None, mode="standard", **options) -> CodeWriter:
+    return WRITERS[mode](ostream, sink, **options)
+
+
+# Hack ALU computations, used to check the peephole rules
+COMP = {
+    "0": lambda a, d, m: 0, "1": lambda a, d, m: 1, "-1": lambda a, d, m: -1,
+    "D": lambda a, d, m: d, "A": lambda a, d, m: a, "M": lambda a, d, m: m,
+    "!D": lambda a, d, m: ~d, "!A": lambda a, d, m: ~a, "!M": lambda a, d, m: ~m,
+    "-D": lambda a, d, m: -d, "-A": lambda a, d, m: -a, "-M": lambda a, d, m: -m,
+    "D+1": lambda a, d, m: d + 1, "A+1": lambda a, d, m: a + 1, "M+1": lambda a, d, m: m + 1,
+    "D-1": lambda a, d, m: d - 1, "A-1": lambda a, d, m: a - 1, "M-1": lambda a, d, m: m - 1,
+    "D+A": lambda a, d, m: d + a, "D+M": lambda a, d, m: d + m,
+    "D-A": lambda a, d, m: d - a, "D-M": lambda a, d, m: d - m,
+    "A-D": lambda a, d, m: a - d, "M-D": lambda a, d, m: m - d,
+    "D&A": lambda a, d, m: d & a, "D&M": lambda a, d, m: d & m,
+    "D|A": lambda a, d, m: d | a, "D|M": lambda a, d, m: d | m,
+}
+PREDEFINED = {"SP": 0, "LCL": 1, "ARG": 2, "THIS": 3, "THAT": 4, "SCREEN": 16384, "KBD": 24576}
+PREDEFINED.update({"R" + str(i): i for i in range(16)})
+
+
+def splitInstruction(line):
+    """ 'dest=comp;jump' -> (dest, comp, jump) """
+    dest, comp, jump = "", line, ""
+    if "=" in comp:
+        dest, comp = comp.split("=", 1)
+    if ";" in comp:
+        comp, jump = comp.split(";", 1)
+    return dest, comp, jump
+
+
+def simulateStraightLine(lines, a, d, ram):
+    """ Runs jump-free Hack code, ram is a dict that fills in missing words through ram.load """
+    for line in lines:
+        if line[0] == "@":
+            value = line[1:]
+            # other symbols get a fixed address derived from their name
+            a = int(value) if value.isdigit() else PREDEFINED.get(value, 16 + zlib.crc32(value.encode()) % 16000)
+            continue
+        dest, comp, jump = splitInstruction(line)
+        m = ram[a] if a in ram else ram.load(a)
+        value = COMP[comp](a, d, m) & 0xFFFF
+        if "M" in dest:
+            ram[a] = value
+        if "A" in dest:
+            a = value
+        if "D" in dest:
+            d = value
+    return a, d, ram
+
+
+class RandomRAM(dict):  # every word reads as a fixed pseudo random value until written
+    def __init__(self, seed):
+        super().__init__()
+        self.seed = seed
+
+    def load(self, address):
+        value = hash((self.seed, address)) & 0xFFFF
+        self[address] = value
+        return value
+
+
+# Windows of generated code that each trigger one rule, used by verifyPeepholeRules
+PEEPHOLE_EXAMPLES = [
+    ["@SP", "@SP", "M=M+1"],
+    ["@Foo.3", "@SP", "A=M", "M=D"],
+    ["@SP", "M=M+1", "@SP", "A=M-1", "D=M"],
+    ["@SP", "M=M+1", "@SP", "M=M-1", "A=M", "D=M"],
+    ["@SP", "M=M-1", "M=M+1", "D=M"],
+    ["@R13", "A=M", "M=D", "D=M", "@SP"],
+    ["@SP", "M=M-1", "A=M", "D=M", "A=A-1", "M=D&M"],
+    ["@SP", "A=M", "A=A-1", "M=-M"],
+    ["@SP", "D=M-1", "A=D", "M=!M"],
+    ["@SP", "A=M", "M=D", "@SP", "M=M+1", "@SP", "M=M-1", "A=M", "D=M"],
+    ["@7", "D=A", "@SP", "A=M", "M=D", "@SP", "M=M+1", "@LCL"],
+]
+
+
+class PeepholeOptimizer:  # rewrites the emitted instruction stream one basic block at a time
+    block = None # instructions since the last label or jump
+    partial = "" # text after the last newline fed in
+    stats = None
+    max_block = 256 # keeps memory bounded on long straight-line runs
+
+    def __init__(self):
+        self.block = []
+        self.partial = ""
+        self.stats = Counter()
+
+    def feed(self, text: str) -> str:
+        """ Takes emitted assembly, returns whatever is ready to go out """
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        out = []
+        for line in lines:
+            if not line:
+                continue
+            if line[0] == "(":
+                # a label can be jumped to, so nothing is known about the machine state after it
+                out += self.optimizeBlock()
+                out.append(line)
+                continue
+            self.block.append(line)
+            if ";" in line or len(self.block) >= self.max_block:
+                out += self.optimizeBlock()
+        return "".join(line + "\n" for line in out)
+
+    def finish(self) -> str:
+        text = self.feed("\n") if self.partial else ""
+        return text + "".join(line + "\n" for line in self.optimizeBlock())
+
+    def optimizeBlock(self) -> list:
+        lines = self.block
+        self.block = []
+        self.stats["words_in"] += len(lines)
+        changed = True
+        while changed:
+            lines, changed = self.rewrite(lines)
+        # last, since it would hide push/pop pairs from the rules above
+        lines = self.rewritePush(lines)
+        self.stats["words_out"] += len(lines)
+        return lines
+
+    def rewrite(self, lines):
+        """ One pass of every rule, each rule keeps A, D and RAM exactly the same """
+        out = []
+        loaded = None # the A-instruction whose value A still holds
+        changed = False
+        for line in lines:
+            if line[0] == "@":
+                if line == loaded:
+                    # A already holds this value
+                    self.stats["redundant-load"] += 1
+                    changed = True
+                    continue
+                if out and out[-1][0] == "@":
+                    # @X followed by @Y: the first load is never used
+                    out.pop()
+                    self.stats["dead-load"] += 1
+                    changed = True
+                loaded = line
+                out.append(line)
+                continue
+            prev = out[-1] if out else ""
+            if (prev, line) in (("M=M+1", "M=M-1"), ("M=M-1", "M=M+1")):
+                # push followed by pop: the stack pointer goes up and straight back down
+                out.pop()
+                self.stats["inc-dec"] += 1
+                changed = True
+                continue
+            if prev == "M=D" and line == "D=M":
+                # D was just stored at M
+                self.stats["store-reload"] += 1
+                changed = True
+                continue
+            fused = PEEPHOLE_FUSE.get((prev, line))
+            if fused is not None:
+                out[-1] = fused
+                self.stats["fuse"] += 1
+                changed = True
+                line = fused
+            else:
+                out.append(line)
+            if "A" in splitInstruction(line)[0]:
+                loaded = None
+        return out, changed
+
+    def rewritePush(self, lines):
+        """ @SP A=M M=D @SP M=M+1 -> @SP AM=M+1 A=A-1 M=D, only where the next instruction reloads A """
+        out = []
+        i = 0
+        while i < len(lines):
+            if lines[i:i+5] == PUSH_D and i + 5 < len(lines) and lines[i+5][0] == "@":
+                out += PUSH_D_SHORT
+                self.stats["push"] += 1
+                i += 5
+                continue
+            out.append(lines[i])
             i += 1
-            parser = Parser(line)
-            
-            if parser.command_type == COMMAND_TYPE.C_ARITHMETIC:
-                coder.writeArithmetic(parser.tokens[0])
-            elif (
-                parser.command_type == COMMAND_TYPE.C_PUSH
-                or parser.command_type == COMMAND_TYPE.C_POP
-            ):
-                coder.WritePushPop(parser.tokens[0], parser.arg_1, parser.arg_2)
-            elif parser.command_type == COMMAND_TYPE.C_LABEL:
-                coder.writeLabel(parser.tokens[1])
-            elif parser.command_type == COMMAND_TYPE.C_GOTO:
-                coder.writeGoto(parser.tokens[1])
-            elif parser.command_type == COMMAND_TYPE.C_IF:
-                coder.writeIf(parser.tokens[1])
-            elif parser.command_type == COMMAND_TYPE.C_FUNCTION:
-                coder.writeFunction(parser.arg_1, parser.arg_2)
-            elif parser.command_type == COMMAND_TYPE.C_RETURN:
-                coder.writeReturn()
-            elif parser.command_type == COMMAND_TYPE.C_CALL:
-                coder.writeCall(parser.arg_1, parser.arg_2)
+        return out
+
+
+PUSH_D = ["@SP", "A=M", "M=D", "@SP", "M=M+1"]
+PUSH_D_SHORT = ["@SP", "AM=M+1", "A=A-1", "M=D"]
+
+# two instructions that compute the same thing as one
+PEEPHOLE_FUSE = {
+    ("M=M-1", "A=M"): "AM=M-1",
+    ("M=M+1", "A=M"): "AM=M+1",
+    ("A=M", "A=A-1"): "A=M-1",
+    ("A=M", "A=A+1"): "A=M+1",
+    ("D=M-1", "A=D"): "AD=M-1",
+    ("D=M+1", "A=D"): "AD=M+1",
+}
+
+
+def verifyPeepholeRules(trials=500) -> list:
+    """ Checks every rule on the examples against random machine states, returns failures """
+    failures = []
+    for example in PEEPHOLE_EXAMPLES:
+        optimizer = PeepholeOptimizer()
+        optimizer.block = list(example)
+        optimized = optimizer.optimizeBlock()
+        if optimized == example:
+            failures.append((example, "no rule applied"))
+            continue
+        for seed in range(trials):
+            a, d = (seed * 7919) & 0xFFFF, (seed * 104729) & 0xFFFF
+            before = simulateStraightLine(example, a, d, RandomRAM(seed))
+            after = simulateStraightLine(optimized, a, d, RandomRAM(seed))
+            if not sameState(before, after):
+                failures.append((example, optimized, seed))
+                break
+    return failures
+
+
+def sameState(before, after) -> bool:
+    if before[:2] != after[:2]:
+        return False
+    ram_before, ram_after = before[2], after[2]
+    for address in set(ram_before) | set(ram_after):
+        value_before = ram_before[address] if address in ram_before else ram_before.load(address)
+        value_after = ram_after[address] if address in ram_after else ram_after.load(address)
+        if value_before != value_after:
+            return False
+    return True
+
+
+def peepholeReport(stats):
+    saved = stats["words_in"] - stats["words_out"]
+    print(f"peephole: {stats['words_in']} -> {stats['words_out']} ROM words, {saved} saved")
+    # every rule only removes straight-line instructions, one cycle each
+    print(f"estimated cycles saved: {saved} per execution of every rewritten block")
+    for rule in ("dead-load", "redundant-load", "inc-dec", "store-reload", "fuse", "push"):
+        print(f"  {rule:>15}: {stats[rule]}")
+
+
+def fusionReport(stats):
+    """ Histogram of superinstruction hits """
+    hits = {pattern: stats["fused " + pattern] for pattern in SUPERINSTRUCTIONS}
+    most = max(hits.values()) or 1
+    print("superinstructions:")
+    for pattern, count in hits.items():
+        print(f"  {pattern:>15}: {count:>6} " + "#" * round(40 * count / most))
+
+
+STREAM_BUFFER_SIZE = 1 << 16
+TRANSLATOR_VERSION = "8.6" # bump whenever generated assembly changes, invalidates cached fragments
+
+
+class TranslationCache:  # on-disk assembly fragments keyed by .vm content hash and options
+    directory = ".vmcache"
+    max_bytes = 64 << 20
+    hits = 0
+    misses = 0
+
+    def __init__(self, directory=".vmcache", max_bytes=64 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, input_file, options) -> str:
+        digest = hashlib.sha256()
+        digest.update(TRANSLATOR_VERSION.encode() + b"\0")
+        digest.update(json.dumps(options, sort_keys=True).encode() + b"\0")
+        # the unit name is part of every static and generated label
+        digest.update(unitName(input_file).encode() + b"\0")
+        with open(input_file, "rb") as file:
+            digest.update(file.read())
+        return digest.hexdigest()
+
+    def get(self, key) -> tuple | None:
+        path = os.path.join(self.directory, key + ".json")
+        try:
+            with open(path, "r") as file:
+                entry = json.load(file)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(path) # most recently used entries survive eviction
+        self.hits += 1
+        return entry["assembly"], Counter(entry["stats"])
+
+    def put(self, key, unit: tuple):
+        fragment, stats = unit
+        path = os.path.join(self.directory, key + ".json")
+        with open(path + ".tmp", "w") as file:
+            json.dump({"assembly": fragment, "stats": stats}, file)
+        os.replace(path + ".tmp", path)
+
+    def evict(self):
+        """ Removes least recently used fragments until the cache fits in max_bytes """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+        entries.sort()
+        while total > self.max_bytes and entries:
+            mtime, size, name = entries.pop(0)
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def report(self):
+        print(f"cache: {self.hits} hits, {self.misses} misses")
+
+
+class RomCounter:  # a sink that only counts instructions
+    words = 0
+
+    def __init__(self):
+        self.words = 0
+
+    def write(self, text: str):
+        self.words += text.count("\n") - text.count("(")
+
+    def flush(self):
+        pass
+
+
+HACK_ROM_WORDS = 32768
+
+# Hack machine code fields, 'a' bit included in the computation
+COMP_BITS = {
+    "0": 0b0101010, "1": 0b0111111, "-1": 0b0111010, "D": 0b0001100, "A": 0b0110000, "M": 0b1110000,
+    "!D": 0b0001101, "!A": 0b0110001, "!M": 0b1110001, "-D": 0b0001111, "-A": 0b0110011, "-M": 0b1110011,
+    "D+1": 0b0011111, "A+1": 0b0110111, "M+1": 0b1110111, "D-1": 0b0001110, "A-1": 0b0110010, "M-1": 0b1110010,
+    "D+A": 0b0000010, "D+M": 0b1000010, "D-A": 0b0010011, "D-M": 0b1010011, "A-D": 0b0000111, "M-D": 0b1000111,
+    "D&A": 0b0000000, "D&M": 0b1000000, "D|A": 0b0010101, "D|M": 0b1010101,
+}
+DEST_BITS = {"A": 4, "D": 2, "M": 1}
+JUMP_BITS = {"": 0, "JGT": 1, "JEQ": 2, "JGE": 3, "JLT": 4, "JNE": 5, "JLE": 6, "JMP": 7}
+VARIABLE_BASE = 16
+
+
+def encodeInstruction(line) -> int:
+    """ 'dest=comp;jump' -> its 16 bit C-instruction, None if it is not one """
+    dest, comp, jump = splitInstruction(line)
+    if comp not in COMP_BITS or jump not in JUMP_BITS or any(register not in DEST_BITS for register in dest):
+        return None
+    return 0b111 << 13 | COMP_BITS[comp] << 6 | sum(DEST_BITS[register] for register in set(dest)) << 3 | JUMP_BITS[jump]
+
+
+class HackAssembler:  # a sink that encodes the instruction stream into Hack machine words as it arrives
+    def __init__(self, modules=()):
+        self.words = array("H")
+        self.symbols = dict(PREDEFINED)
+        self.labels = self.symbols # labels are known program-wide, references to them resolve on sight
+        self.fixups = [] # (word index, symbol) for @symbol not yet defined when it was seen
+        self.encoded = {} # a program uses only a few hundred distinct C-instructions
+        self.partial = ""
+        self.modules = list(modules) # ObjectModules placed after the stream
+
+    def write(self, text: str):
+        lines = text.split("\n")
+        lines[0] = self.partial + lines[0]
+        self.partial = lines.pop()
+        words = self.words
+        append = words.append
+        symbols = self.symbols
+        labels = self.labels
+        encoded = self.encoded
+        for line in lines:
+            if line in encoded:
+                append(encoded[line])
+                continue
+            if not line:
+                continue
+            first = line[0]
+            if first == "@":
+                value = line[1:]
+                if value.isdigit():
+                    append(int(value) & 0x7FFF)
+                elif value in symbols:
+                    append(symbols[value])
+                else:
+                    self.fixups.append((len(words), value))
+                    append(0)
+            elif first == "(":
+                # A-instructions hold 15 bits, so past the ROM a label wraps around as it would in the CPU
+                labels[line[1:-1]] = len(words) & 0x7FFF
+            else:
+                word = encodeInstruction(line)
+                if word is None:
+                    raise ValueError(f"invalid instruction '{line}' at ROM address {len(words)}")
+                encoded[line] = word
+                append(word)
+
+    def flush(self):
+        """ End of the stream: forward labels are patched and the rest become variables from RAM[16] on """
+        if self.partial:
+            self.write("\n")
+        for module in self.modules:
+            self.link(module)
+        self.modules = []
+        if len(self.words) > HACK_ROM_WORDS:
+            print("ERROR: PROGRAM NEEDS " + str(len(self.words)) + " ROM WORDS, THE ROM HAS " + str(HACK_ROM_WORDS))
+        variable = VARIABLE_BASE
+        for index, symbol in self.fixups:
+            if symbol not in self.symbols:
+                self.symbols[symbol] = variable
+                variable += 1
+            self.words[index] = self.symbols[symbol]
+        self.fixups = []
+
+    def link(self, module):
+        """ Appends a relocatable module: its own labels move by where it lands, its symbols join the program """
+        base = len(self.words)
+        self.words.extend(module.words)
+        words = self.words
+        for index in module.relocations:
+            words[base + index] = (words[base + index] + base) & 0x7FFF
+        for symbol, offset in module.symbols.items():
+            self.symbols[symbol] = (base + offset) & 0x7FFF
+        for index, symbol in module.references:
+            self.fixups.append((base + index, symbol))
+
+    def save(self, file_name: str):
+        """ .hack text, one 16 character binary line per word, or else packed little endian words """
+        if file_name.endswith(".hack"):
+            with open(file_name, "w") as f:
+                f.write(hackText(self.words))
+            return
+        words = array("H", self.words)
+        if sys.byteorder == "big":
+            words.byteswap()
+        with open(file_name, "wb") as f:
+            words.tofile(f)
+
+
+class ObjectAssembler(HackAssembler):  # assembles one unit on its own into an ObjectModule
+    def __init__(self):
+        super().__init__()
+        self.labels = {} # kept apart, so every label reference is seen again at the end
+        self.relocations = array("H")
+        self.references = []
+
+    def flush(self):
+        """ References to the unit's own labels become relocations, all other symbols are left to the linker """
+        if self.partial:
+            self.write("\n")
+        for index, symbol in self.fixups:
+            if symbol in self.labels:
+                self.words[index] = self.labels[symbol]
+                self.relocations.append(index)
+            else:
+                self.references.append((index, symbol))
+        self.fixups = []
+
+
+class ObjectModule:  # relocatable machine code of one translated .vm file
+    def __init__(self, name, words, symbols, relocations, references, stats):
+        self.name = name
+        self.words = words # assembled as if the module started at ROM address 0
+        self.symbols = symbols # function name -> entry offset, what other modules may refer to
+        self.relocations = relocations # indexes of the words that hold one of the module's own offsets
+        self.references = references # (index, symbol) for functions, statics and runtime routines defined elsewhere
+        self.stats = stats
+
+    def toJson(self) -> dict:
+        return {"name": self.name, "words": self.words.tobytes().hex(), "symbols": self.symbols,
+                "relocations": self.relocations.tobytes().hex(), "references": self.references, "stats": self.stats}
+
+    @staticmethod
+    def fromJson(entry):
+        words = array("H", bytes.fromhex(entry["words"]))
+        relocations = array("H", bytes.fromhex(entry["relocations"]))
+        references = [(index, symbol) for index, symbol in entry["references"]]
+        return ObjectModule(entry["name"], words, entry["symbols"], relocations, references, Counter(entry["stats"]))
+
+
+class ObjectLibrary:  # modules translated once with one set of options, linked into many programs
+    def __init__(self, modules=(), arities=None, light=(), imports=()):
+        self.modules = list(modules)
+        self.arities = arities or {} # call protocol facts app builds must agree with
+        self.light = list(light)
+        self.imports = list(imports) # functions the library calls but does not define, e.g. Main.main
+
+    def functions(self) -> set:
+        return {name for module in self.modules for name in module.symbols}
+
+    def save(self, path):
+        with open(path + ".tmp", "w") as file:
+            json.dump({"modules": [module.toJson() for module in self.modules], "arities": self.arities,
+                       "light": self.light, "imports": self.imports}, file)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load(path):
+        with open(path) as file:
+            entry = json.load(file)
+        return ObjectLibrary([ObjectModule.fromJson(module) for module in entry["modules"]], entry["arities"],
+                             entry["light"], entry["imports"])
+
+
+LIBRARY_DIRECTORY = ".oslib"
+JACK_COMPILER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "11", "compiler.py")
+
+
+def buildLibrary(input_files, fast_calls=False, **options) -> ObjectLibrary:
+    """ Translates and assembles every file on its own, the call protocol only looks at the library itself """
+    tables = [parseFile(input_file) for input_file in input_files]
+    arities = callArities(tables) if fast_calls else {}
+    light = leafFunctions(tables) if fast_calls else []
+    if fast_calls:
+        options = {**options, "arities": arities, "light": light}
+    modules = []
+    for input_file, table in zip(input_files, tables):
+        assembler = ObjectAssembler()
+        coder = makeCodeWriter("test.asm", assembler, **options)
+        coder.setCurrentFile(unitName(input_file))
+        writeInstructions(coder, table)
+        coder.finish()
+        assembler.flush()
+        functions = [name for name, start, stop in functionRanges(table) if name is not None]
+        modules.append(ObjectModule(unitName(input_file), assembler.words,
+                                    {name: assembler.labels[name] for name in functions},
+                                    assembler.relocations, assembler.references, coder.stats()))
+    graph = callGraph(tables)
+    called = set().union(*graph.values()) if graph else set()
+    return ObjectLibrary(modules, arities, light, sorted(called - set(graph)))
+
+
+def compileJack(jack_files, directory, intrinsics=False) -> list:
+    """
+    Runs 11/compiler.py over copies of the files in directory, where it writes Xxx.vm. With intrinsics the
+    compiler leaves products with constants as push constant c / call Math.multiply 2 for writeMultiplyConstant.
+    ValueError if the compiler reports an ERROR or leaves out a .vm file
+    """
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    vm_files = []
+    for jack_file in jack_files:
+        names.append(os.path.basename(jack_file))
+        with open(jack_file, "rb") as source, open(os.path.join(directory, names[-1]), "wb") as target:
+            target.write(source.read())
+        vm_files.append(os.path.join(directory, os.path.splitext(names[-1])[0] + ".vm"))
+        if os.path.exists(vm_files[-1]):
+            os.remove(vm_files[-1]) # a .vm left by an earlier build must not stand in for a failed compile
+    flags = " -v -i" if intrinsics else " -v"
+    commands = "".join("j " + name + flags + "\n" for name in names) + "q\n"
+    result = subprocess.run([sys.executable, os.path.abspath(JACK_COMPILER)], input=commands, cwd=directory,
+                            capture_output=True, text=True, check=True)
+    errors = [line[line.index("ERROR"):] for line in result.stdout.splitlines() if "ERROR" in line]
+    errors += ["no " + os.path.basename(vm_file) + " was written" for vm_file in vm_files if not os.path.exists(vm_file)]
+    if errors:
+        raise ValueError("11/compiler.py failed:\n" + "\n".join(errors))
+    return vm_files
+
+
+def osLibrary(directory, fast_calls=False, **options) -> ObjectLibrary:
+    """
+    The library of the .vm files in directory, or of its .jack files through 11/compiler.py. It is built
+    once and kept in directory/.oslib, keyed by the translator version, the options and the sources, and for
+    .jack sources also by the text of 11/compiler.py
+    """
+    sources = vmFiles(directory) or \
+        [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".jack")]
+    digest = hashlib.sha256()
+    digest.update(TRANSLATOR_VERSION.encode() + b"\0")
+    if sources and sources[0].endswith(".jack"):
+        with open(JACK_COMPILER, "rb") as file:
+            digest.update(file.read() + b"\0")
+    digest.update(json.dumps({**options, "fast_calls": fast_calls}, sort_keys=True).encode() + b"\0")
+    for source in sources:
+        digest.update(os.path.basename(source).encode() + b"\0")
+        with open(source, "rb") as file:
+            digest.update(file.read())
+    library_directory = os.path.join(directory, LIBRARY_DIRECTORY)
+    path = os.path.join(library_directory, digest.hexdigest() + ".json")
+    if os.path.exists(path):
+        return ObjectLibrary.load(path)
+    if sources and sources[0].endswith(".jack"):
+        sources = compileJack(sources, os.path.join(library_directory, "vm"), options.get("intrinsics", False))
+    library = buildLibrary(sources, fast_calls, **options)
+    os.makedirs(library_directory, exist_ok=True)
+    library.save(path)
+    return library
+
+
+BYTE_BITS = [format(byte, "08b") for byte in range(256)]
+
+
+def hackText(words) -> str:
+    """ Machine words -> .hack file contents """
+    return "".join([BYTE_BITS[word >> 8] + BYTE_BITS[word & 0xFF] + "\n" for word in words])
+
+
+def assembleText(text: str) -> array:
+    """ Hack assembly text -> machine words """
+    assembler = HackAssembler()
+    assembler.write(text)
+    assembler.flush()
+    return assembler.words
+
+
+def assembleProgram(input_files, prune=False, fast_calls=False, **options) -> array:
+    """ Machine words of the translated program, nothing is written to disk """
+    options = programOptions(input_files, options, prune, fast_calls)
+    assembler = HackAssembler()
+    build(input_files, makeCodeWriter("test.asm", assembler, **options))
+    return assembler.words
+
+
+def romUsage(input_files, prune=False, fast_calls=False, **options) -> int:
+    """ ROM words the translated program needs, nothing is written to disk """
+    options = programOptions(input_files, options, prune, fast_calls)
+    counter = RomCounter()
+    build(input_files, makeCodeWriter("test.asm", counter, **options))
+    return counter.words
+
+
+def vmFiles(directory) -> list:
+    """ Every .vm file in directory, in a deterministic order """
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".vm")]
+
+
+def unitName(input_file) -> str:
+    """ Xxx.vm -> Xxx, the prefix used for the file's static variables """
+    return os.path.splitext(os.path.basename(input_file))[0]
+
+
+def main(file, stream=True):
+    translateFiles([file], stream)
+
+
+def translateFiles(input_files, stream=True, jobs=1, cache=None, prune=False, fast_calls=False, assemble=None,
+                   library=None, **options):
+    """
+    Translates one or more .vm files into a single test.asm, or test.hack / test.bin when assemble is 'hack' / 'bin',
+    options go to CodeWriter. library is an OS directory whose precompiled modules are linked in, which needs assemble
+    """
+    modules = []
+    if library is not None:
+        library = osLibrary(library, fast_calls, **options)
+        units = {unitName(input_file) for input_file in input_files}
+        # classes the program defines itself replace the library's
+        modules = [module for module in library.modules if module.name not in units]
+        assemble = assemble or "hack"
+    options = programOptions(input_files, options, prune, fast_calls, library)
+    if assemble is not None:
+        # encoded as the stream arrives, there is no test.asm to assemble afterwards
+        assembler = HackAssembler(modules)
+        stats = build(input_files, makeCodeWriter("test.asm", assembler, **options), jobs, cache)
+        for module in modules:
+            stats.update(module.stats)
+        assembler.save("test." + assemble)
+    elif stream:
+        # bounded memory: assembly goes straight to a buffered file
+        with open("test.asm", "w", buffering=STREAM_BUFFER_SIZE) as sink:
+            stats = build(input_files, makeCodeWriter("test.asm", sink, **options), jobs, cache)
+    else:
+        stats = build(input_files, makeCodeWriter("test.asm", **options), jobs, cache)
+    if cache is not None:
+        cache.report()
+    if options.get("optimize"):
+        peepholeReport(stats)
+    if options.get("fuse"):
+        fusionReport(stats)
+    return stats
+
+
+def build(input_files, coder, jobs=1, cache=None) -> Counter:
+    if cache is not None:
+        return link(translateCached(input_files, cache, coder.options(), jobs), coder)
+    if jobs > 1:
+        return link(translateParallel(input_files, coder.options(), jobs), coder)
+    return translate(input_files, coder)
+
+
+def translate(input_files, coder) -> Counter:
+    coder.writeInit()
+    for input_file in input_files:
+        # each file is parsed into an InstructionTable and goes straight to CodeWriter
+        coder.setCurrentFile(unitName(input_file))
+        translateCommands(input_file, coder)
+    coder.setFilename("test")
+    return coder.stats()
+
+
+def translateUnit(input_file, options) -> tuple:
+    """ Translates a single .vm file on its own into an assembly fragment and its stats """
+    coder = makeCodeWriter("test.asm", **options)
+    coder.setCurrentFile(unitName(input_file))
+    translateCommands(input_file, coder)
+    coder.finish()
+    return coder.assembly, coder.stats()
+
+
+def translateParallel(input_files, options, jobs=None) -> list:
+    """ Translates every file in a process pool, fragments come back in input order """
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(partial(translateUnit, options=options), input_files))
+
+
+def translateCached(input_files, cache, options, jobs=1) -> list:
+    """ Fragments for every file, only files whose contents changed are retranslated """
+    keys = [cache.key(input_file, options) for input_file in input_files]
+    units = [cache.get(key) for key in keys]
+    missing = [i for i in range(len(units)) if units[i] is None]
+    changed_files = [input_files[i] for i in missing]
+    if jobs > 1:
+        translated = translateParallel(changed_files, options, jobs)
+    else:
+        translated = [translateUnit(input_file, options) for input_file in changed_files]
+    for i, unit in zip(missing, translated):
+        cache.put(keys[i], unit)
+        units[i] = unit
+    cache.evict()
+    return units
+
+
+def link(units, coder) -> Counter:
+    """ Places the fragments behind the bootstrap code """
+    coder.writeInit()
+    coder.finish()
+    stats = coder.stats()
+    for fragment, unit_stats in units:
+        coder.output(fragment)
+        stats.update(unit_stats)
     coder.setFilename("test")
+    return stats
+
+
+def translateCommands(input_file, coder):
+    writeInstructions(coder, parseFile(input_file))
+
+
+def writeInstructions(coder, table, start=0, stop=None):
+    """ Generates code for instructions start..stop of an InstructionTable """
+    opcodes, arg1, arg2, names = table.opcodes, table.arg1, table.arg2, table.names
+    i = start
+    stop = len(table) if stop is None else stop
+    while i < stop:
+        if coder.bulk:
+            covered = writeBulkInit(coder, table, i, stop)
+            if covered:
+                i += covered
+                continue
+        if coder.fuse:
+            fused = writeSuperinstruction(coder, table, i, stop)
+            if fused:
+                i += fused
+                continue
+        opcode = opcodes[i]
+        if coder.intrinsics and opcode == OP_PUSH and arg1[i] == SEGMENT_IDS["constant"] and i + 1 < stop and \
+                opcodes[i + 1] == OP_CALL and names[arg1[i + 1]] == "Math.multiply" and arg2[i + 1] == 2:
+            coder.writeMultiplyConstant(arg2[i])
+            i += 2
+            continue
+        if opcode < OP_PUSH:
+            coder.writeArithmetic(ARITHMETIC_COMMANDS[opcode])
+        elif opcode == OP_PUSH:
+            coder.WritePushPop("push", SEGMENTS[arg1[i]], arg2[i])
+        elif opcode == OP_POP:
+            coder.WritePushPop("pop", SEGMENTS[arg1[i]], arg2[i])
+        elif opcode == OP_LABEL:
+            coder.writeLabel(names[arg1[i]])
+        elif opcode == OP_GOTO:
+            coder.writeGoto(names[arg1[i]])
+        elif opcode == OP_IF:
+            coder.writeIf(names[arg1[i]])
+        elif opcode == OP_FUNCTION:
+            coder.writeFunction(names[arg1[i]], arg2[i])
+        elif opcode == OP_RETURN:
+            coder.writeReturn()
+        elif i + 1 < stop and opcodes[i + 1] == OP_RETURN and coder.writeTailCall(names[arg1[i]], arg2[i]):
+            i += 1 # the return is part of the tail call
+        else:
+            coder.writeCall(names[arg1[i]], arg2[i])
+        i += 1
+
+
+SUPERINSTRUCTIONS = ("increment", "compare-branch", "not-branch")
+OP_ADD, OP_SUB, OP_NEG, OP_EQ, OP_GT, OP_LT, OP_NOT = \
+    (OPCODES[name] for name in ("add", "sub", "neg", "eq", "gt", "lt", "not"))
+
+
+def writeSuperinstruction(coder, table, i, stop) -> int:
+    """ Emits the fused sequence starting at instruction i, returns how many instructions it covered """
+    opcodes, arg1, arg2, names = table.opcodes, table.arg1, table.arg2, table.names
+    constant = SEGMENT_IDS["constant"]
+    if opcodes[i] == OP_PUSH and i + 2 < stop and opcodes[i + 1] == OP_PUSH:
+        operator = opcodes[i + 2]
+        if "increment" in coder.fuse and i + 3 < stop and (operator == OP_ADD or operator == OP_SUB) and \
+                arg1[i + 1] == constant and opcodes[i + 3] == OP_POP and arg1[i] != constant and \
+                arg1[i + 3] == arg1[i] and arg2[i + 3] == arg2[i]:
+            delta = arg2[i + 1] if operator == OP_ADD else -arg2[i + 1]
+            coder.writeIncrement(SEGMENTS[arg1[i]], arg2[i], delta)
+            coder.fused["increment"] += 1
+            return 4
+        if "compare-branch" in coder.fuse and (operator == OP_EQ or operator == OP_GT or operator == OP_LT):
+            negate = i + 3 < stop and opcodes[i + 3] == OP_NOT
+            branch = i + 3 + negate
+            if branch < stop and opcodes[branch] == OP_IF:
+                coder.writeCompareBranch((SEGMENTS[arg1[i]], arg2[i]), (SEGMENTS[arg1[i + 1]], arg2[i + 1]),
+                                         ARITHMETIC_COMMANDS[operator], negate, names[arg1[branch]])
+                coder.fused["compare-branch"] += 1
+                return branch + 1 - i
+    if "not-branch" in coder.fuse and opcodes[i] == OP_NOT and i + 1 < stop and opcodes[i + 1] == OP_IF:
+        coder.writeNotBranch(names[arg1[i + 1]])
+        coder.fused["not-branch"] += 1
+        return 2
+    return 0
+
+
+def signed(value: int) -> int:
+    return value - 0x10000 if value & 0x8000 else value
+
+
+# arithmetic on 16 bit words the way the templates compute it, comparisons look at the sign of x - y
+FOLD = {
+    OPCODES["add"]: lambda x, y: (x + y) & 0xFFFF,
+    OPCODES["sub"]: lambda x, y: (x - y) & 0xFFFF,
+    OPCODES["neg"]: lambda x: -x & 0xFFFF,
+    OPCODES["eq"]: lambda x, y: 0xFFFF if x == y else 0,
+    OPCODES["gt"]: lambda x, y: 0xFFFF if signed((x - y) & 0xFFFF) > 0 else 0,
+    OPCODES["lt"]: lambda x, y: 0xFFFF if signed((x - y) & 0xFFFF) < 0 else 0,
+    OPCODES["and"]: lambda x, y: x & y,
+    OPCODES["or"]: lambda x, y: x | y,
+    OPCODES["not"]: lambda x: ~x & 0xFFFF,
+}
+MIN_BULK_RUN = 2
+
+
+def constantPushes(table, i, stop) -> tuple:
+    """ ([values], end): what the push constant and arithmetic commands from i on leave on the stack """
+    opcodes, arg1, arg2 = table.opcodes, table.arg1, table.arg2
+    constant = SEGMENT_IDS["constant"]
+    values = []
+    while i < stop:
+        opcode = opcodes[i]
+        if opcode == OP_PUSH and arg1[i] == constant:
+            values.append(arg2[i] & 0xFFFF)
+        elif opcode == OP_NEG or opcode == OP_NOT:
+            if not values:
+                break
+            values.append(FOLD[opcode](values.pop()))
+        elif opcode < OP_PUSH:
+            if len(values) < 2:
+                break
+            y = values.pop()
+            values.append(FOLD[opcode](values.pop(), y))
+        else:
+            break
+        i += 1
+    return values, i
+
+
+def arrayStore(table, i, stop) -> tuple | None:
+    """ let a[k] = c with constant k and c starting at i: ((segment, index) of a, k, c, end) or None """
+    opcodes, arg1, arg2 = table.opcodes, table.arg1, table.arg2
+    constant = SEGMENT_IDS["constant"]
+    if i + 2 >= stop or opcodes[i] != OP_PUSH or opcodes[i + 1] != OP_PUSH or opcodes[i + 2] != OP_ADD:
+        return None
+    if arg1[i] == constant and arg1[i + 1] != constant:
+        base, offset = i + 1, arg2[i] & 0xFFFF
+    elif arg1[i + 1] == constant and arg1[i] != constant:
+        base, offset = i, arg2[i + 1] & 0xFFFF
+    else:
+        return None
+    array = (SEGMENTS[arg1[base]], arg2[base])
+    if array[0] == "that" or array in (("temp", 0), ("pointer", 1)):
+        return None # the stores themselves change these
+    values, j = constantPushes(table, i + 3, stop)
+    tail = ((OP_POP, "temp", 0), (OP_POP, "pointer", 1), (OP_PUSH, "temp", 0), (OP_POP, "that", 0))
+    if len(values) != 1 or j + len(tail) > stop:
+        return None
+    for k, (opcode, segment, index) in enumerate(tail):
+        if opcodes[j + k] != opcode or SEGMENTS[arg1[j + k]] != segment or arg2[j + k] != index:
+            return None
+    return array, offset, values[0], j + len(tail)
+
+
+def writeBulkInit(coder, table, i, stop) -> int:
+    """ Emits a run of constant array stores or of constant-argument calls starting at i, returns how many instructions it covered """
+    store = arrayStore(table, i, stop)
+    if store is not None:
+        array, entries, end = store[0], [], i
+        while store is not None and store[0] == array:
+            entries.append((store[1], store[2]))
+            end = store[3]
+            store = arrayStore(table, end, stop)
+        if len(entries) < MIN_BULK_RUN:
+            return 0
+        coder.writeArrayFill(array[0], array[1], entries)
+        return end - i
+    opcodes, arg1, arg2, names = table.opcodes, table.arg1, table.arg2, table.names
+    temp = SEGMENT_IDS["temp"]
+    rows, target, end = [], None, i
+    while True:
+        values, j = constantPushes(table, end, stop)
+        if j + 1 >= stop or opcodes[j] != OP_CALL or arg2[j] != len(values) or \
+                opcodes[j + 1] != OP_POP or arg1[j + 1] != temp or arg2[j + 1] != 0:
+            break
+        if target is None:
+            target = (names[arg1[j]], arg2[j])
+        elif target != (names[arg1[j]], arg2[j]):
+            break
+        rows.append(values)
+        end = j + 2
+    if len(rows) < MIN_BULK_RUN:
+        return 0
+    coder.writeConstantCalls(target[0], target[1], rows)
+    return end - i
+
+
+def functionRanges(table) -> list:
+    """ [(function name, start, stop)], instructions before the first function belong to None """
+    starts = [i for i in range(len(table)) if table.opcodes[i] == OP_FUNCTION]
+    ranges = [(None, 0, starts[0] if starts else len(table))]
+    for start, stop in zip(starts, starts[1:] + [len(table)]):
+        ranges.append((table.names[table.arg1[start]], start, stop))
+    return ranges
+
+
+def callGraph(tables, replaced=()) -> dict:
+    """ function name -> names of the functions it calls, calls of replaced functions are left out """
+    graph = {}
+    for table in tables:
+        for name, start, stop in functionRanges(table):
+            if name is not None:
+                graph[name] = {table.names[table.arg1[i]] for i in range(start, stop) if table.opcodes[i] == OP_CALL} - \
+                    set(replaced)
+    return graph
+
+
+def reachableFunctions(graph, roots=("Sys.init",)) -> set:
+    reached = set()
+    pending = [root for root in roots if root in graph]
+    while pending:
+        name = pending.pop()
+        if name not in reached:
+            reached.add(name)
+            pending += graph.get(name, ())
+    return reached
+
+
+def functionSizes(input_files, tables, options) -> dict:
+    """ function name -> ROM words of its body, translated on its own """
+    sizes = {}
+    for input_file, table in zip(input_files, tables):
+        for name, start, stop in functionRanges(table):
+            counter = RomCounter()
+            coder = makeCodeWriter("test.asm", counter, **options)
+            coder.setCurrentFile(unitName(input_file))
+            writeInstructions(coder, table, start, stop)
+            coder.finish()
+            if name is not None:
+                sizes[name] = counter.words
+    return sizes
+
+
+def callArities(tables) -> dict:
+    """ function name -> number of arguments, for the functions whose call sites all agree """
+    arities = {}
+    for table in tables:
+        for i in range(len(table)):
+            if table.opcodes[i] == OP_CALL:
+                arities.setdefault(table.names[table.arg1[i]], set()).add(table.arg2[i])
+    return {name: counts.pop() for name, counts in arities.items() if len(counts) == 1}
+
+
+def leafFunctions(tables) -> list:
+    """ Functions that call nothing and never pop pointer, so THIS and THAT survive them """
+    leaves = []
+    pop_pointer = SEGMENT_IDS["pointer"]
+    for table in tables:
+        for name, start, stop in functionRanges(table):
+            if name is not None and not any(table.opcodes[i] == OP_CALL or \
+                    (table.opcodes[i] == OP_POP and table.arg1[i] == pop_pointer) for i in range(start, stop)):
+                leaves.append(name)
+    return sorted(leaves)
+
+
+def programOptions(input_files, options, prune=False, fast_calls=False, library=None) -> dict:
+    """ Adds the writer options that need every input file: call protocols and the kept functions """
+    if prune or fast_calls:
+        tables = [parseFile(input_file) for input_file in input_files]
+        if fast_calls:
+            options["arities"] = callArities(tables)
+            options["light"] = leafFunctions(tables)
+            if library is not None:
+                # the library was compiled against its own facts and a standard frame for what it calls
+                options["arities"] = {**options["arities"], **library.arities}
+                options["light"] = sorted(set(options["light"]) - set(library.imports) | set(library.light))
+        if prune:
+            options["keep"] = pruneFunctions(input_files, tables, options, library)
+    return options
+
+
+def pruneFunctions(input_files, tables, options, library=None) -> list | None:
+    """ Functions reachable from Sys.init, or from what a linked library calls, through call commands, prints what is kept and removed """
+    # MATH$MULTIPLY never calls back into Math.multiply, MATH$DIVIDE can call Math.divide
+    graph = callGraph(tables, ("Math.multiply",) if options.get("intrinsics") else ())
+    roots = ["Sys.init"] + (library.imports if library is not None else [])
+    if not any(root in graph for root in roots):
+        print("dead-function elimination: no Sys.init, keeping every function")
+        return None
+    keep = reachableFunctions(graph, roots) & set(graph) # calls into a library are not the program's to keep
+    sizes = functionSizes(input_files, tables, options)
+    kept_words = removed_words = 0
+    for name in graph:
+        status = "kept" if name in keep else "removed"
+        print(f"{status:>9} {name:<40} {sizes[name]:>6} words")
+        if name in keep:
+            kept_words += sizes[name]
+        else:
+            removed_words += sizes[name]
+    print(f"dead-function elimination: kept {len(keep)} functions ({kept_words} words), " + \
+          f"removed {len(graph) - len(keep)} ({removed_words} words)")
+    return sorted(keep)
 
 
 if __name__ == "__main__":